@@ -8,6 +8,8 @@ USRLOC="$USRDIR/$CKPTDIR/$NAME"
 OPTLOC="$OPTDIR/$NAME"
 DEBFOLDER="debian"
 PIP_INSTALL="$OPTLOC/pip_install.sh"
+SERVICE="$NAME-cli.service"
+SERVICEDIR="/etc/systemd/system"
 
 minify_install () {
     echo "Installing and compiling files"
@@ -40,6 +42,14 @@ if [ "$1" == "-u" ] || [ "$1" == "-U" ]
 then
 	echo "$LNAME uninstall script"
 
+    if [ -f "$SERVICEDIR/$SERVICE" ]; then
+        echo "Removing service"
+        systemctl stop "$SERVICE"
+        systemctl disable "$SERVICE"
+        rm -f "$SERVICEDIR/$SERVICE"
+        systemctl daemon-reload
+    fi
+
     echo "Removing files"
 	if [ -d "$USRLOC" ]; then
         rm -rf "$USRLOC"
@@ -93,4 +103,12 @@ else
     if [ -f "$PIP_INSTALL" ]; then
         $PIP_INSTALL
     fi
+
+    if [ -f "$OPTLOC/$SERVICE" ]; then
+        echo "Installing service"
+        cp "$OPTLOC/$SERVICE" "$SERVICEDIR/$SERVICE"
+        systemctl daemon-reload
+        systemctl enable "$SERVICE"
+        systemctl restart "$SERVICE"
+    fi
 fi
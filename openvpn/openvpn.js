@@ -31,17 +31,15 @@ class ovpnSettings {
     }
 
     getSettings(callback) {
-        var optCb = function(oData) {
-            var getCb = function(aData) {
-                this.pane.setButtonDisabled(this.btnUpdate, (Object.keys(this.update).length == 0));
-                var ioData = JSON.parse(oData);
-                var iaData = JSON.parse(aData);
-                this.buildEditForm(iaData, ioData);
+        var snapCb = function(sData) {
+            this.pane.setButtonDisabled(this.btnUpdate, (Object.keys(this.update).length == 0));
+            var isData = JSON.parse(sData);
+            if (("settings" in isData) && ("options" in isData)) {
+                this.buildEditForm(isData.settings, isData.options);
             }
-            runCmd.call(this, getCb, ['get']);
         }
         this.update = [];
-        runCmd.call(this, optCb, ['getopt']);
+        runCmd.call(this, snapCb, ['snapshot']);
     }
 
     buildEditForm(aData, oData) {
@@ -59,11 +57,19 @@ class ovpnSettings {
         //"loglevel": "Errors and info", "vpn_network": "10.8.0.0", "vpn_mask": "255.255.255.0",
         //"gateway_interface": "wlan0", "default_gateway": true, "default_route": true,
         //"client_to_client": false, "dns_server": "Google", "dns": "", "dns_domains": "",
-        //"wins": "", "public_address": ""}
+        //"wins": "", "public_address": "", "dh_params": "Generated",
+        //"key_pool_size": 0, "pki_backend": "easyrsa",
+        //"crl_mode": "CRL file", "firewall": "Automatic",
+        //"instances": 1, "instance_mode": "Port range", "public_addresses": "", "remote_random": true,
+        //"server_poll_timeout": 10, "egress_addresses": "", "snat_ports": "",
+        //"static_addresses": false, "vpn_network6": ""}
         //oData={"protocol": ["tcp", "udp"], "device": ["tun", "tap"],
         //"loglevel": ["No output except fatal errors", "Normal usage output", "Log each packet", "Debug"],
         //"DNS_server": ["None", "Current system resolvers", "Google", "1.1.1.1", "OpenDNS", "Quad9", "AdGuard"],
-        //"gateway": ["lo", "wlan0", "eth0"],  "users": ["xxxx"]}
+        //"gateway": ["lo", "wlan0", "eth0"],  "users": ["xxxx"],
+        //"dh_params": ["Generated", "ffdhe2048", "ffdhe3072", "ffdhe4096", "None (ECDHE only)"],
+        //"pki_backend": ["easyrsa", "python (cryptography)"], "crl_mode": ["CRL file", "CRL directory"],
+        //"firewall": ["Automatic", "nftables", "iptables"], "instance_mode": ["Port range", "UDP and TCP"], "cpus": 4}
         var dlgData = [{
                 param: "enable_ipv6",
                 text: "Enable IPv6",
@@ -95,6 +101,28 @@ class ovpnSettings {
                 disabled: false,
                 readonly: false,
                 comment: "Protocol to use for OpenVPN."
+            }, {
+                param: "instances",
+                text: "Server instances",
+                value: aData.instances,
+                type: "number",
+                min: 0,
+                max: 64,
+                step: 1,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Number of OpenVPN server processes, each using one CPU core (0 is one per core, " + oData.cpus + " cores). The VPN network is split between the instances."
+            }, {
+                param: "instance_mode",
+                text: "Instance mode",
+                value: aData.instance_mode,
+                type: "select",
+                opts: oData.instance_mode,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Instances on consecutive ports (port range), or alternating UDP and TCP on consecutive ports."
             }, {
                 param: "deviceovpn",
                 text: "Device",
@@ -123,6 +151,15 @@ class ovpnSettings {
                 disabled: false,
                 readonly: false,
                 comment: "Simultaneous login per CN."
+            }, {
+                param: "static_addresses",
+                text: "Static addresses",
+                value: aData.static_addresses,
+                type: "boolean",
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Give every client a fixed address from the VPN network (not with duplicate CN)."
             }, {
                 param: "pam_authentication",
                 text: "PAM authentication",
@@ -132,6 +169,58 @@ class ovpnSettings {
                 disabled: false,
                 readonly: false,
                 comment: "Authenticate with server using username/password (client certificate and key are still required)."
+            }, {
+                param: "dh_params",
+                text: "DH parameters",
+                value: aData.dh_params,
+                type: "select",
+                opts: oData.dh_params,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Diffie Hellman parameters. Generated parameters are taken from a pool generated in the background, predefined ffdhe groups (RFC 7919) or none (ECDHE only) don't need generation."
+            }, {
+                param: "key_pool_size",
+                text: "Key pool size",
+                value: aData.key_pool_size,
+                type: "number",
+                min: 0,
+                max: 1000,
+                step: 1,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Number of client keys generated in advance, which makes adding certificates faster (0 is disabled)."
+            }, {
+                param: "pki_backend",
+                text: "PKI backend",
+                value: aData.pki_backend,
+                type: "select",
+                opts: oData.pki_backend,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Certificate management by easyrsa or in-process (python cryptography package). Both use the same files, so they can be switched."
+            }, {
+                param: "crl_mode",
+                text: "Revocation check",
+                value: aData.crl_mode,
+                type: "select",
+                opts: oData.crl_mode,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Check revoked certificates in the CRL file or in a directory with a file per revoked certificate (faster for long revocation lists)."
+            }, {
+                param: "firewall",
+                text: "Firewall",
+                value: aData.firewall,
+                type: "select",
+                opts: oData.firewall,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Firewall backend for the NAT and forward rules. Automatic uses nftables when available and no other firewall filters, iptables otherwise."
             }, {
                 param: "extra_options",
                 text: "Extra options",
@@ -171,6 +260,15 @@ class ovpnSettings {
                 readonly: false,
                 showmask: false,
                 comment: "VPN network mask"
+            }, {
+                param: "vpn_network6",
+                text: "VPN IPv6 network",
+                value: aData.vpn_network6,
+                type: "text",
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "VPN IPv6 network with prefix length (empty derives a /64 from the port)"
             }, {
                 param: "gateway_interface",
                 text: "Gateway interface",
@@ -181,6 +279,24 @@ class ovpnSettings {
                 disabled: false,
                 readonly: false,
                 comment: "Gateway interface for OpenVPN connection."
+            }, {
+                param: "egress_addresses",
+                text: "Egress addresses",
+                value: aData.egress_addresses,
+                type: "multi",
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Addresses (IPv4 and IPv6) to masquerade VPN clients behind (separate by ,), 'all' for all addresses of the gateway interface. Empty uses the first address of the gateway interface."
+            }, {
+                param: "snat_ports",
+                text: "Egress ports",
+                value: aData.snat_ports,
+                type: "text",
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Source port range per egress address, e.g. 1024-65535. Empty uses 1024-65535 for more than one egress address and any port otherwise."
             }, {
                 param: "default_gateway",
                 text: "Default gateway",
@@ -257,6 +373,36 @@ class ovpnSettings {
                 disabled: false,
                 readonly: false,
                 comment: "This is the address which external clients can connect to your VPN with. This is automatically used in the generated configuration."
+            }, {
+                param: "public_addresses",
+                text: "Extra public addresses",
+                value: aData.public_addresses,
+                type: "multi",
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Extra addresses for the generated configuration (separate by ,), as 'host' for all server instances or as 'host port [protocol]'."
+            }, {
+                param: "remote_random",
+                text: "Random remote",
+                value: aData.remote_random,
+                type: "boolean",
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Clients pick a random address and server instance, which spreads the load when there is more than one."
+            }, {
+                param: "server_poll_timeout",
+                text: "Server poll timeout",
+                value: aData.server_poll_timeout,
+                type: "number",
+                min: 1,
+                max: 120,
+                step: 1,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Seconds before a client tries the next address or server instance."
             }
         ];
         this.pane.getSettingsEditForm().setData(dlgData);
@@ -266,9 +412,15 @@ class ovpnSettings {
         var cbYes = function() {
             var settings = {};
             settings = this.update;
+            var steps = {};
+            var cbProgress = function(event) {
+                steps[event.step] = event.state;
+                this.displaySettings("Updating settings...<br>" + Object.keys(steps).map(step =>
+                    (setupSteps[step] || step) + ": " + steps[step]).join("<br>"));
+            };
             this.pane.dispose();
             this.displaySettings("Updating settings...");
-            runCmd.call(this, this.getSettings, ['setup'], settings);
+            runCmd.call(this, this.getSettings, ['setup'], settings, undefined, cbProgress);
         };
         if (Object.keys(this.update).length > 0) {
             var txt = "Are you sure to update settings and restart OpenVPN services?"
@@ -289,6 +441,7 @@ class ovpnCertificates {
             {name : "Delete", disable: "!allowed", disableValue: false, callback: this.delete}
         ];
         this.certs = [];
+        this.users = null;
     }
 
     displayContent(el) {
@@ -304,7 +457,12 @@ class ovpnCertificates {
     getCertificates() {
         var cbThen = function(user) {
             var cb = function(data) {
-                var lData = JSON.parse(data);
+                var sData = JSON.parse(data);
+                var lData = [];
+                if ("clients" in sData) {
+                    lData = sData.clients;
+                    this.users = sData.options.users;
+                }
                 this.certs = [];
                 lData.forEach(datum => {
                     if (datum.users.length > 0) {
@@ -316,7 +474,7 @@ class ovpnCertificates {
                 });
                 this.pane.getTable().setData(lData);
             }
-            runCmd.call(this, cb);
+            runCmd.call(this, cb, ['snapshot']);
         }
         cockpit.user().then(cbThen.bind(this));
     }
@@ -342,6 +500,7 @@ class ovpnCertificates {
         }
         var optCb = function(oData) {
             var users = JSON.parse(oData).users;
+            this.users = users;
             var dlgData = [{
                     param: "users",
                     text: "Users",
@@ -383,7 +542,11 @@ class ovpnCertificates {
             }
             dialog.build(title, dlgData, cbOk);
         }
-        runCmd.call(this, optCb, ['getopt']);
+        if (this.users) {
+            optCb.call(this, JSON.stringify({users: this.users}));
+        } else {
+            runCmd.call(this, optCb, ['getopt']);
+        }
     }
 
     tryName(users) {
@@ -446,28 +609,18 @@ class ovpnCertificates {
     download(data) {
         var cbDl = function(result) {
             var iResult = JSON.parse(result);
-            var filename = "";
-            var zipname = "";
-            if ('zip' in iResult) {
-                filename = iResult.zip;
+            if (('name' in iResult) && ('data' in iResult)) {
+                this.downloadFile(iResult.name, iResult.data);
             }
-            zipname = filename.substring(filename.lastIndexOf('/')+1);
-            cockpit.file(filename, { binary: true }).read()
-            .done(function (content, tag) {
-                this.downloadFile(zipname, btoa(String.fromCharCode.apply(null, content)));
-            }.bind(this))
-            .fail(function (error) {
-                new msgBox(this, "Download failed", "Command error: " + error.message + ", " + error.problem);
-            }.bind(this));
             this.getCertificates();
         }
         this.pane.showSpinner("Downloading...");
-        runCmd.call(this, cbDl, ["download"], {"name": data.name});
+        runCmd.call(this, cbDl, ["download"], {"name": data.name, "stream": "base64"});
     }
 
     downloadFile(filename, data) {
         var element = document.createElement('a');
-        element.setAttribute('href', 'data:text/plain;base64,' + data);
+        element.setAttribute('href', 'data:application/zip;base64,' + data);
         element.setAttribute('download', filename);
         element.style.display = 'none';
         document.body.appendChild(element);
@@ -486,11 +639,68 @@ class ovpnCertificates {
     }
 }
 
+class ovpnStatus {
+    constructor(el) {
+        this.el = el;
+        this.name = "OpenVPN status";
+        this.pane = new tabPane(this, el, this.name);
+    }
+
+    displayContent(el) {
+        this.pane.dispose();
+        this.pane.build();
+        this.pane.getTitle().innerHTML = this.name.charAt(0).toUpperCase() + this.name.slice(1);
+        this.pane.addButton("refresh", "Refresh", this.getStatus, true, false, false);
+        this.getStatus();
+        statusTimer = setInterval(this.getStatus.bind(this), statusInterval);
+    }
+
+    getStatus() {
+        var cb = function(data) {
+            var sData = JSON.parse(data);
+            var lData = [];
+            if ("clients" in sData) {
+                sData.clients.forEach(client => {
+                    lData.push({
+                        name: client.name,
+                        real_address: client.real_address,
+                        virtual_address: client.virtual_address,
+                        bytes_received: client.bytes_received,
+                        bytes_sent: client.bytes_sent,
+                        connected_since: client.connected_since
+                    });
+                });
+            }
+            this.pane.getTable().setData(lData);
+        }
+        runCmd.call(this, cb, ['status']);
+    }
+}
+
 /////////////////////
 // Common functions //
 //////////////////////
 
-function runCmd(callback, args = [], json = null, cmd = "/opt/openvpn/openvpn-cli.py") {
+var statusTimer = null;
+var statusInterval = 10000;
+
+var setupSteps = {
+    "init-pki": "Initializing PKI",
+    "build-ca": "Building CA",
+    "build-server-full": "Building server certificate",
+    "gen-crl": "Generating CRL",
+    "gen-dh": "Generating DH parameters",
+    "dh-pool": "DH parameters from pool",
+    "configure": "Writing configuration",
+    "services": "Restarting services"
+};
+
+var cliSocket = "/run/openvpn-cli.sock";
+var cliSocketAvailable = true;
+var cliRequestId = 0;
+var cliReadCmds = ["list", "get", "getopt", "snapshot", "status"];
+
+function runCmd(callback, args = [], json = null, cmd = "/opt/openvpn/openvpn-cli.py", progress = null) {
     var cbDone = function(data) {
         callback.call(this, data);
     };
@@ -498,14 +708,107 @@ function runCmd(callback, args = [], json = null, cmd = "/opt/openvpn/openvpn-cl
         callback.call(this, "[]");
         new msgBox(this, "OpenVPN command failed", "Command error: " + (data ? data : message + "<br>Please check the log file"));
     };
-    var command = [cmd];
-    command = command.concat(args);
+    var cbProgress = function(event) {
+        if (progress) {
+            progress.call(this, event);
+        }
+    };
+    var cbSpawn = function() {
+        var command = [cmd];
+        if (progress) {
+            command.push("--progress");
+        }
+        command = command.concat(args);
+        if (json) {
+            command = command.concat(JSON.stringify(json));
+        }
+        var proc = cockpit.spawn(command, { err: "out", superuser: "require" });
+        if (!progress) {
+            return proc.done(cbDone.bind(this)).fail(cbFail.bind(this));
+        }
+        // progress lines come before the result, split them off while streaming
+        var buffer = "";
+        var output = "";
+        return proc.stream(function(data) {
+            buffer += data;
+            var lines = buffer.split("\n");
+            buffer = lines.pop();
+            lines.forEach(line => {
+                var event = null;
+                try {
+                    event = JSON.parse(line);
+                } catch (e) {}
+                if ((event) && ("step" in event)) {
+                    cbProgress.call(this, event);
+                } else {
+                    output += line + "\n";
+                }
+            });
+        }.bind(this))
+            .done(function() { cbDone.call(this, output + buffer); }.bind(this))
+            .fail(cbFail.bind(this));
+    };
+    if (cliSocketAvailable) {
+        return runSocketCmd(args, json, cbDone.bind(this), cbFail.bind(this), cbSpawn.bind(this), cbProgress.bind(this));
+    }
+    return cbSpawn.call(this);
+}
+
+function runSocketCmd(args, json, cbDone, cbFail, cbUnavailable, cbProgress = null) {
+    var channel = cockpit.channel({ payload: "stream", unix: cliSocket, superuser: "require" });
+    var buffer = "";
+    var replied = false;
+    var connected = false;
+    var method = (args.length > 0) ? args[0] : "list";
+    var params = args.slice(1);
     if (json) {
-        command = command.concat(JSON.stringify(json));
+        params.push(JSON.stringify(json));
     }
-    return cockpit.spawn(command, { err: "out", superuser: "require" })
-        .done(cbDone.bind(this))
-        .fail(cbFail.bind(this));
+    channel.addEventListener("ready", function(event, options) {
+        connected = true;
+    });
+    channel.addEventListener("message", function(event, data) {
+        connected = true;
+        buffer += data;
+        var nl = buffer.indexOf("\n");
+        while ((nl >= 0) && (!replied)) {
+            var response = JSON.parse(buffer.substring(0, nl));
+            buffer = buffer.substring(nl + 1);
+            nl = buffer.indexOf("\n");
+            if (!("id" in response)) {
+                // notification, progress of the request
+                if ((cbProgress) && (response.method == "progress")) {
+                    cbProgress(response.params);
+                }
+                continue;
+            }
+            replied = true;
+            channel.close();
+            if ("error" in response) {
+                cbFail(response.error.message, response.error.message);
+            } else {
+                cbDone(response.result);
+            }
+        }
+    });
+    channel.addEventListener("close", function(event, options) {
+        if (replied) {
+            return;
+        }
+        if (!connected) {
+            // daemon not running, fall back to spawning the cli
+            cliSocketAvailable = false;
+            cbUnavailable();
+        } else if (cliReadCmds.includes(method)) {
+            cbUnavailable();
+        } else {
+            // the daemon may have done (part of) the change, running it again could repeat it
+            cbFail("Connection to the openvpn-cli daemon closed before the reply", null);
+        }
+    });
+    cliRequestId++;
+    channel.send(JSON.stringify({jsonrpc: "2.0", id: cliRequestId, method: method, params: params}) + "\n");
+    return channel;
 }
 
 function buildOpts(data, refData = {}, exclude = []) {
@@ -585,6 +888,10 @@ function clickTab() {
 }
 
 function displayContent(el) {
+    if (statusTimer) {
+        clearInterval(statusTimer);
+        statusTimer = null;
+    }
     if (el.id.search("settings") >= 0) {
         let Settings = new ovpnSettings(el);
         Settings.displayContent();
@@ -595,7 +902,7 @@ function displayContent(el) {
         let Logger = new logger(el, "/var/log/openvpn.log", true);
         Logger.displayContent();
     } else if (el.id.search("status") >= 0) {
-        let Status = new logger(el, "/var/log/openvpn-status.log", true, false, false);
+        let Status = new ovpnStatus(el);
         Status.displayContent();
     }
 }
@@ -18,9 +18,37 @@ from zipfile import ZipFile
 import json
 import subprocess
 import netifaces
+try:
+    import dbus
+except ImportError:
+    dbus = None
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+except ImportError:
+    x509 = None
 import socket
 import random
 import string
+import io
+import socketserver
+import tempfile
+import re
+import shlex
+import hashlib
+import base64
+import time
+import shutil
+import asyncio
+import threading
+import concurrent.futures
+import multiprocessing
+import fcntl
+import datetime
+import ipaddress
+from contextlib import redirect_stdout, contextmanager, nullcontext
 
 #########################################################
 
@@ -34,6 +62,7 @@ SYSTEMDDIR     = "/etc/systemd/system/"
 SYSTEMDOVPNIPT = SYSTEMDDIR + DAEMONOVPNIPT + ".service"
 CMDNOTEXIST    = 127
 CMDTIMEOUT     = 124
+CMDSKIPPED     = -1
 SYSTEMCTL      = "systemctl"
 CTLSTART       = SYSTEMCTL + " start"
 CTLSTOP        = SYSTEMCTL + " stop"
@@ -44,6 +73,16 @@ CTLDISABLE     = SYSTEMCTL + " disable"
 CTLSTATUS      = SYSTEMCTL + " status"
 CTLISACTIVE    = SYSTEMCTL + " is-active"
 CTLISENABLED   = SYSTEMCTL + " is-enabled"
+CTLDAEMONRELOAD = SYSTEMCTL + " daemon-reload"
+CTLSHOW        = SYSTEMCTL + " show"
+SYSTEMDBUS     = "org.freedesktop.systemd1"
+SYSTEMDPATH    = "/org/freedesktop/systemd1"
+SYSTEMDMANAGER = SYSTEMDBUS + ".Manager"
+SYSTEMDUNIT    = SYSTEMDBUS + ".Unit"
+DBUSPROPERTIES = "org.freedesktop.DBus.Properties"
+SYSTEMDENABLED = ["enabled", "enabled-runtime", "static", "alias", "indirect", "generated", "transient"]
+SYSTEMDSUFFIXES = [".service", ".socket", ".target", ".timer", ".path", ".mount", ".automount", ".swap",
+                   ".slice", ".scope", ".device"]
 XML_FILENAME   = OVPNNAME + ".xml"
 ENCODING       = 'utf-8'
 
@@ -53,11 +92,34 @@ SERVICE_FORWARD_PROC_IP6 = "/proc/sys/net/ipv6/conf/all/forwarding"
 #SERVICE_IPTABLES_CONF = "/etc/network/if-pre-up.d/" + OVPNNAME
 SERVICE_OPENVPN_DIR      = "/etc/" + OVPNNAME
 SERVICE_OPENVPN_CONF     = SERVICE_OPENVPN_DIR + "/server.conf"
+SERVICE_NFT_CONF         = SERVICE_OPENVPN_DIR + "/" + OVPNNAME + ".nft"
+NFT_TABLE                = "inet " + OVPNNAME
+SERVICE_STATUS_LOG       = "/var/log/" + OVPNNAME + "-status.log"
+SERVICE_MANAGEMENT       = "/run/" + OVPNNAME + "-server.sock"
+SERVICE_LOG              = "/var/log/" + OVPNNAME + ".log"
+SERVICE_CCD_DIR          = SERVICE_OPENVPN_DIR + "/ccd"
 USR_DIR                  = "/usr/share"
 TMP_DIR                  = "/tmp"
+RUN_DIR                  = "/run"
+CACHE_DIR                = "/var/cache/" + OVPNNAME + "-cli"
+CACHE_XML                = CACHE_DIR + "/" + OVPNNAME + ".json"
+CACHE_VERSION            = 1
+CACHE_BUNDLES            = CACHE_DIR + "/bundles"
+CACHE_STATUS             = CACHE_DIR + "/status.json"
+DH_POOL_DIR              = CACHE_DIR + "/dh"
+DH_POOL_SIZE             = 2
+KEY_POOL_DIR             = SERVICE_OPENVPN_DIR + "/keypool"
+SERVICE_SOCKET           = RUN_DIR + "/" + OVPNNAME + "-cli.sock"
 EASY_RSA_DIR             = USR_DIR + "/easy-rsa"
 EASY_RSA_CMD             = EASY_RSA_DIR + "/easyrsa"
 EASY_RSA_KEY_DIR         = SERVICE_OPENVPN_DIR + "/pki"
+CRL_DIR                  = SERVICE_OPENVPN_DIR + "/crl.d" # outside the pki (0700), read by openvpn as nobody
+EASY_RSA_DH_SIZE         = 2048
+EASY_RSA_KEY_SIZE        = 2048
+EASY_RSA_CA_DAYS         = 3650
+EASY_RSA_CERT_DAYS       = 825
+EASY_RSA_CRL_DAYS        = 180
+OPENSSL_CMD              = "openssl"
 
 OVPN_PROTOCOL = ["tcp", "udp"]
 OVPN_DEVICE   = ["tun", "tap"]
@@ -73,7 +135,68 @@ OVPN_DNS      = {"None": [],
 	             "Quad9" : ["9.9.9.9","149.112.112.112"],
 	             "AdGuard" : ["94.140.14.14","94.140.15.15"]}
 
-LISTKEYS       = ["extra_options", "dns", "dns_domains", "wins"]
+OVPN_DH       = {"Generated": "dh.pem", # from pool, generated in background
+                 "ffdhe2048": "ffdhe2048",
+                 "ffdhe3072": "ffdhe3072",
+                 "ffdhe4096": "ffdhe4096",
+                 "None (ECDHE only)": "none"}
+
+# RFC 7919 groups (PKCS#3 PEM), openssl 1.1.1 can't write them with genpkey
+FFDHE_GROUPS  = {"ffdhe2048": """-----BEGIN DH PARAMETERS-----
+MIIBCAKCAQEA//////////+t+FRYortKmq/cViAnPTzx2LnFg84tNpWp4TZBFGQz
++8yTnc4kmz75fS/jY2MMddj2gbICrsRhetPfHtXV/WVhJDP1H18GbtCFY2VVPe0a
+87VXE15/V8k1mE8McODmi3fipona8+/och3xWKE2rec1MKzKT0g6eXq8CrGCsyT7
+YdEIqUuyyOP7uWrat2DX9GgdT0Kj3jlN9K5W7edjcrsZCwenyO4KbXCeAvzhzffi
+7MA0BM0oNC9hkXL+nOmFg/+OTxIy7vKBg8P+OxtMb61zO7X8vC7CIAXFjvGDfRaD
+ssbzSibBsu/6iGtCOGEoXJf//////////wIBAg==
+-----END DH PARAMETERS-----
+""",
+                 "ffdhe3072": """-----BEGIN DH PARAMETERS-----
+MIIBiAKCAYEA//////////+t+FRYortKmq/cViAnPTzx2LnFg84tNpWp4TZBFGQz
++8yTnc4kmz75fS/jY2MMddj2gbICrsRhetPfHtXV/WVhJDP1H18GbtCFY2VVPe0a
+87VXE15/V8k1mE8McODmi3fipona8+/och3xWKE2rec1MKzKT0g6eXq8CrGCsyT7
+YdEIqUuyyOP7uWrat2DX9GgdT0Kj3jlN9K5W7edjcrsZCwenyO4KbXCeAvzhzffi
+7MA0BM0oNC9hkXL+nOmFg/+OTxIy7vKBg8P+OxtMb61zO7X8vC7CIAXFjvGDfRaD
+ssbzSibBsu/6iGtCOGEfz9zeNVs7ZRkDW7w09N75nAI4YbRvydbmyQd62R0mkff3
+7lmMsPrBhtkcrv4TCYUTknC0EwyTvEN5RPT9RFLi103TZPLiHnH1S/9croKrnJ32
+nuhtK8UiNjoNq8Uhl5sN6todv5pC1cRITgq80Gv6U93vPBsg7j/VnXwl5B0rZsYu
+N///////////AgEC
+-----END DH PARAMETERS-----
+""",
+                 "ffdhe4096": """-----BEGIN DH PARAMETERS-----
+MIICCAKCAgEA//////////+t+FRYortKmq/cViAnPTzx2LnFg84tNpWp4TZBFGQz
++8yTnc4kmz75fS/jY2MMddj2gbICrsRhetPfHtXV/WVhJDP1H18GbtCFY2VVPe0a
+87VXE15/V8k1mE8McODmi3fipona8+/och3xWKE2rec1MKzKT0g6eXq8CrGCsyT7
+YdEIqUuyyOP7uWrat2DX9GgdT0Kj3jlN9K5W7edjcrsZCwenyO4KbXCeAvzhzffi
+7MA0BM0oNC9hkXL+nOmFg/+OTxIy7vKBg8P+OxtMb61zO7X8vC7CIAXFjvGDfRaD
+ssbzSibBsu/6iGtCOGEfz9zeNVs7ZRkDW7w09N75nAI4YbRvydbmyQd62R0mkff3
+7lmMsPrBhtkcrv4TCYUTknC0EwyTvEN5RPT9RFLi103TZPLiHnH1S/9croKrnJ32
+nuhtK8UiNjoNq8Uhl5sN6todv5pC1cRITgq80Gv6U93vPBsg7j/VnXwl5B0rZp4e
+8W5vUsMWTfT7eTDp5OWIV7asfV9C1p9tGHdjzx1VA0AEh/VbpX4xzHpxNciG77Qx
+iu1qHgEtnmgyqQdgCpGBMMRtx3j5ca0AOAkpmaMzy4t6Gh25PXFAADwqTs6p+Y0K
+zAqCkc3OyX3Pjsm1Wn+IpGtNtahR9EGC4caKAH5eZV9q//////////8CAQI=
+-----END DH PARAMETERS-----
+"""}
+
+OVPN_PKI      = {"easyrsa": "easyrsa",
+                 "python": "python (cryptography)"}
+
+OVPN_CRL      = {"CRL file": "file",
+                 "CRL directory": "dir"} # crl-verify <dir> dir, one file per revoked serial
+
+OVPN_FIREWALL = ["Automatic", "nftables", "iptables"]
+OVPN_INSTANCES = ["Port range", "UDP and TCP"] # instance i on port + i, or alternating protocols per port
+OVPN_MIN_PREFIX = 29 # smallest network an instance can serve
+SNAT_ALL       = "all" # every address of the gateway interface
+SNAT_PORTS     = "1024-65535" # source ports per egress address when using a pool
+SNAT_PROTOCOLS = ["tcp", "udp"] # protocols with ports
+
+LISTKEYS       = ["extra_options", "dns", "dns_domains", "wins", "public_addresses", "egress_addresses"]
+BUNDLEKEYS     = ["public_address", "port", "protocol", "deviceovpn", "compression", "pam_authentication",
+                  "public_addresses", "remote_random", "server_poll_timeout", "instances", "instance_mode"]
+CERTNAME       = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$")
+NOSOCKETCMDS   = ["serve", "dhpool fill", "keypool fill"] # fill runs for minutes, the daemon refills itself
+SOCKETREADCMDS = ["list", "get", "getopt", "snapshot", "status"] # share the daemon lock with other reads
 
 #########################################################
 
@@ -83,24 +206,64 @@ LISTKEYS       = ["extra_options", "dns", "dns_domains", "wins"]
 # Class : shell                                         #
 #########################################################
 class shell(object):
+    # Commands given as list are executed without shell, strings run in a shell.
+    # Duration of every command is recorded in the timings of the thread that
+    # created the shell, so threaded requests keep their own timings.
+    local = threading.local()
+
     def __init__(self):
-        pass
+        self.timings = shell.getTimings()
+
+    @staticmethod
+    def getTimings():
+        if not hasattr(shell.local, "timings"):
+            shell.local.timings = []
+        return shell.local.timings
+
+    @staticmethod
+    def resetTimings():
+        shell.local.timings = []
 
     def __del__(self):
         pass
 
     def runCommand(self, cmd, input = None, timeout = None):
         retval = CMDNOTEXIST, "", ""
+        start = time.monotonic()
         if input:
             input = input.encode("utf-8")
+        if timeout == 0:
+            timeout = None
         try:
-            if timeout == 0:
-                timout = None
-            out = subprocess.run(cmd, shell=True, capture_output=True, input = input, timeout = timeout)
+            out = subprocess.run(cmd, shell = not isinstance(cmd, list), capture_output=True, input = input, timeout = timeout)
             retval = out.returncode, out.stdout.decode("utf-8"), out.stderr.decode("utf-8")
         except subprocess.TimeoutExpired:
             retval = CMDTIMEOUT, "", ""
+        except (FileNotFoundError, PermissionError):
+            pass
+
+        self.addTiming(cmd, retval[0], start)
+        return retval
 
+    def runCommands(self, cmds, timeout = None, limit = None):
+        # runs independent commands concurrently, at most limit at the same time
+        # returns (returncode, stdout, stderr) per command
+        if not cmds:
+            return []
+        if timeout == 0:
+            timeout = None
+        return asyncio.run(self.runCommandsAsync(cmds, timeout, limit))
+
+    def commands(self, cmds, retcode = 0, timeout = None, limit = None):
+        # concurrent version of command, returns stdout or the exception per command
+        retval = []
+        for returncode, stdout, stderr in self.runCommands(cmds, timeout, limit):
+            try:
+                if retcode != returncode:
+                    self.handleError(returncode, stderr)
+                retval.append(stdout)
+            except Exception as e:
+                retval.append(e)
         return retval
 
     def command(self, cmd, retcode = 0, input = None, timeout = None, timeoutError = False):
@@ -118,18 +281,91 @@ class shell(object):
 
         return returncode != CMDNOTEXIST
 
+    def runGraph(self, steps, callback = None, timeout = None):
+        # steps: {name: (dependencies, cmd)}, a step starts as soon as all its
+        # dependencies succeeded and is skipped when one of them failed
+        # callback(name, state, returncode, time) reports progress
+        # returns (returncode, stdout, stderr) per step
+        if timeout == 0:
+            timeout = None
+        return asyncio.run(self.runGraphAsync(steps, callback, timeout))
+
     def handleError(self, returncode, stderr):
         exc = ("External command failed.\n"
                "Command returned: {}\n"
                "Error message:\n{}").format(returncode, stderr)
         raise Exception(exc)
 
+################## INTERNAL FUNCTIONS ###################
+
+    async def runCommandsAsync(self, cmds, timeout, limit):
+        semaphore = asyncio.Semaphore(limit if limit else len(cmds))
+        async def run(cmd):
+            async with semaphore:
+                return await self.runCommandAsync(cmd, timeout)
+        return await asyncio.gather(*[run(cmd) for cmd in cmds])
+
+    async def runCommandAsync(self, cmd, timeout):
+        retval = CMDNOTEXIST, "", ""
+        start = time.monotonic()
+        try:
+            if isinstance(cmd, list):
+                proc = await asyncio.create_subprocess_exec(*cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+            else:
+                proc = await asyncio.create_subprocess_shell(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+                retval = proc.returncode, stdout.decode("utf-8"), stderr.decode("utf-8")
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                retval = CMDTIMEOUT, "", ""
+        except (FileNotFoundError, PermissionError):
+            pass
+        self.addTiming(cmd, retval[0], start)
+        return retval
+
+    async def runGraphAsync(self, steps, callback, timeout):
+        tasks = {}
+        async def run(name):
+            deps, cmd = steps[name]
+            for dep in deps:
+                if (await tasks[dep])[0] != 0:
+                    if callback:
+                        callback(name, "skipped", CMDSKIPPED, 0)
+                    return CMDSKIPPED, "", "Skipped, {} failed".format(dep)
+            if callback:
+                callback(name, "running", None, 0)
+            start = time.monotonic()
+            retval = await self.runCommandAsync(cmd, timeout)
+            if callback:
+                callback(name, "done" if retval[0] == 0 else "failed", retval[0], round(time.monotonic() - start, 3))
+            return retval
+        for name in steps:
+            tasks[name] = asyncio.ensure_future(run(name))
+        results = {}
+        for name in steps:
+            results[name] = await tasks[name]
+        return results
+
+    def addTiming(self, cmd, returncode, start):
+        timing = {}
+        timing['cmd'] = " ".join(cmd) if isinstance(cmd, list) else cmd
+        timing['returncode'] = returncode
+        timing['time'] = round(time.monotonic() - start, 6)
+        self.timings.append(timing)
+
 #########################################################
 # Class : systemdctl                                    #
 #########################################################
 class systemdctl(object):
-    def __init__(self):
+    # Talks to the systemd manager over D-Bus when python3-dbus is available,
+    # otherwise calls systemctl once for all units of a request.
+    # Another bus object (e.g. a stub) with get_object may be passed in.
+    def __init__(self, bus = None):
         self.hasSystemd = False
+        self.bus = bus
+        self.manager = None
         try:
             self.hasSystemd = self.checkInstalled()
         except Exception as e:
@@ -144,66 +380,55 @@ class systemdctl(object):
         return self.hasSystemd
 
     def start(self, service):
-        retval = False
-        if self.available():
-            cmd = "{} {}".format(CTLSTART, service)
-            try:
-                shell().command(cmd)
-                retval = True
-            except:
-                pass
-        return retval
+        return self.control("start", "StartUnit", service)
 
     def stop(self, service):
-        retval = False
-        if self.available():
-            cmd = "{} {}".format(CTLSTOP, service)
-            try:
-                shell().command(cmd)
-                retval = True
-            except:
-                pass
-        return retval
+        return self.control("stop", "StopUnit", service)
 
     def reload(self, service):
-        retval = False
-        if self.available():
-            cmd = "{} {}".format(CTLRELOAD, service)
-            try:
-                shell().command(cmd)
-                retval = True
-            except:
-                pass
-        return retval
+        return self.control("reload", "ReloadUnit", service)
 
     def restart(self, service):
+        return self.control("restart", "RestartUnit", service)
+
+    def enable(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLRESTART, service)
+            services = self.getList(service, self.manager != None)
             try:
-                shell().command(cmd)
+                if self.manager:
+                    self.manager.EnableUnitFiles(services, False, True, dbus_interface = SYSTEMDMANAGER)
+                    self.manager.Reload(dbus_interface = SYSTEMDMANAGER)
+                else:
+                    shell().command(CTLENABLE.split() + services)
                 retval = True
             except:
                 pass
         return retval
 
-    def enable(self, service):
+    def disable(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLENABLE, service)
+            services = self.getList(service, self.manager != None)
             try:
-                shell().command(cmd)
+                if self.manager:
+                    self.manager.DisableUnitFiles(services, False, dbus_interface = SYSTEMDMANAGER)
+                    self.manager.Reload(dbus_interface = SYSTEMDMANAGER)
+                else:
+                    shell().command(CTLDISABLE.split() + services)
                 retval = True
             except:
                 pass
         return retval
 
-    def disable(self, service):
+    def daemonReload(self):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLDISABLE, service)
             try:
-                shell().command(cmd)
+                if self.manager:
+                    self.manager.Reload(dbus_interface = SYSTEMDMANAGER)
+                else:
+                    shell().command(CTLDAEMONRELOAD.split())
                 retval = True
             except:
                 pass
@@ -220,32 +445,90 @@ class systemdctl(object):
                 pass
         return retval
 
+    def show(self, service):
+        # state object per unit, for all units in one round trip
+        states = {}
+        services = self.getList(service)
+        for name in services:
+            states[name] = {'active': "unknown", 'sub': "unknown", 'enabled': "unknown"}
+        if not self.available():
+            return states
+        try:
+            if self.manager:
+                for name in services:
+                    states[name] = self.showBus(self.getList(name, True)[0])
+            else:
+                cmd = CTLSHOW.split() + ["-p", "Id,ActiveState,SubState,UnitFileState"] + services
+                retcode, stdout, stderr = shell().runCommand(cmd)
+                for name, block in zip(services, stdout.split("\n\n")):
+                    props = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+                    for service in services:
+                        if props.get("Id") in [service, service + ".service"]:
+                            name = service
+                            break
+                    states[name] = self.getState(props.get("ActiveState"), props.get("SubState"), props.get("UnitFileState"))
+        except:
+            pass
+        return states
+
     def isActive(self, service):
+        return all(state['active'] == "active" for state in self.show(service).values())
+
+    def isEnabled(self, service):
+        return all(state['enabled'] in SYSTEMDENABLED for state in self.show(service).values())
+
+################## INTERNAL FUNCTIONS ###################
+
+    def checkInstalled(self):
         retval = False
-        if self.available():
-            cmd = "{} {}".format(CTLISACTIVE, service)
-            try:
-                shell().command(cmd)
-                retval = True
-            except:
-                pass
+        try:
+            if not self.bus and dbus:
+                self.bus = dbus.SystemBus()
+            if self.bus:
+                self.manager = self.bus.get_object(SYSTEMDBUS, SYSTEMDPATH)
+        except:
+            self.manager = None
+        if self.manager:
+            retval = True
+        else:
+            retval = shutil.which(SYSTEMCTL) != None
         return retval
 
-    def isEnabled(self, service):
+    def control(self, verb, method, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLISENABLED, service)
+            services = self.getList(service, self.manager != None)
             try:
-                shell().command(cmd)
+                if self.manager:
+                    for name in services:
+                        getattr(self.manager, method)(name, "replace", dbus_interface = SYSTEMDMANAGER)
+                else:
+                    shell().command([SYSTEMCTL, verb] + services)
                 retval = True
             except:
                 pass
         return retval
 
-################## INTERNAL FUNCTIONS ###################
-
-    def checkInstalled(self):
-        return shell().commandExists(SYSTEMCTL)
+    def showBus(self, name):
+        unit = self.bus.get_object(SYSTEMDBUS, self.manager.LoadUnit(name, dbus_interface = SYSTEMDMANAGER))
+        active = unit.Get(SYSTEMDUNIT, "ActiveState", dbus_interface = DBUSPROPERTIES)
+        sub = unit.Get(SYSTEMDUNIT, "SubState", dbus_interface = DBUSPROPERTIES)
+        enabled = unit.Get(SYSTEMDUNIT, "UnitFileState", dbus_interface = DBUSPROPERTIES)
+        return self.getState(active, sub, enabled)
+
+    def getState(self, active, sub, enabled):
+        state = {}
+        state['active'] = str(active) if active else "unknown"
+        state['sub'] = str(sub) if sub else "unknown"
+        state['enabled'] = str(enabled) if enabled else "unknown"
+        return state
+
+    def getList(self, service, unit = False):
+        # unit = True adds .service to bare names, systemctl does this itself, the D-Bus api doesn't
+        services = service if isinstance(service, list) else [service]
+        if unit:
+            services = [name if os.path.splitext(name)[1] in SYSTEMDSUFFIXES else name + ".service" for name in services]
+        return services
 
 #########################################################
 # Class : database                                      #
@@ -253,6 +536,10 @@ class systemdctl(object):
 class database(object):
     def __init__(self):
         self.db = {}
+        self.stat = None
+        self.clients = None
+        self.comment = ""
+        self.signature = None
         if not self.getXMLpath(False):
             # only create xml if super user, otherwise keep empty
             self.createXML()
@@ -273,8 +560,12 @@ class database(object):
     def reload(self):
         del self.db
         self.db = {}
+        self.clients = None
         self.getXML()
 
+    def changed(self):
+        return self.stat != self.getXMLstat()
+
     def bl(self, val):
         retval = False
         try:
@@ -323,10 +614,17 @@ class database(object):
 
     def getXML(self):
         XMLpath = self.getXMLpath()
+        self.stat = self.getXMLstat()
+        if self.getCache():
+            return
         try:
-            tree = ET.parse(XMLpath)
-            root = tree.getroot()
+            with open(XMLpath, 'rb') as xml_file:
+                content = xml_file.read()
+            root = ET.fromstring(content)
             self.db = self.parseKids(root, True)
+            self.comment = self.getXMLcomment(content.decode(ENCODING), "settings")
+            self.signature = self.getSignature()
+            self.setCache()
         except Exception as e:
             print("Error parsing xml file")
             print("Check XML file syntax for errors")
@@ -353,17 +651,85 @@ class database(object):
         return retval
 
     def updateXML(self):
+        # skip writing when nothing changed since reading or last writing
+        signature = self.getSignature()
+        if signature == self.signature:
+            return
         db = ET.Element('settings')
-        pcomment = self.getXMLcomment("settings")
-        if pcomment:
-            comment = ET.Comment(pcomment)
+        if self.comment:
+            comment = ET.Comment(self.comment)
             db.append(comment)
         self.buildXML(db, self.db)
 
         XMLpath = self.getXMLpath(dowrite = True)
 
-        with open(XMLpath, "w") as xml_file:
-            xml_file.write(self.prettify(db))
+        self.writeXML(XMLpath, db)
+        self.signature = signature
+
+    def writeXML(self, XMLpath, elem):
+        # write to temporary file and rename, so the file is never half written
+        content = self.prettify(elem)
+        fd, tmpPath = tempfile.mkstemp(dir = os.path.dirname(XMLpath), prefix = "." + XML_FILENAME + ".")
+        try:
+            with os.fdopen(fd, "w", encoding = ENCODING) as xml_file:
+                xml_file.write(content)
+                xml_file.flush()
+                os.fsync(xml_file.fileno())
+            mode = 0o644
+            if os.path.isfile(XMLpath):
+                mode = os.stat(XMLpath).st_mode & 0o7777
+            os.chmod(tmpPath, mode)
+            os.replace(tmpPath, XMLpath)
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        self.stat = self.getXMLstat()
+        self.setCache()
+
+    def getCache(self):
+        # parsed database, valid as long as mtime, size and inode of the XML file match
+        retval = False
+        try:
+            with open(CACHE_XML, 'r', encoding = ENCODING) as cache_file:
+                cache = json.load(cache_file)
+            if cache['version'] == CACHE_VERSION and self.stat and list(self.stat) == cache['stat']:
+                self.db = cache['db']
+                self.comment = cache['comment']
+                self.signature = self.getSignature()
+                retval = True
+        except:
+            pass
+        return retval
+
+    def setCache(self):
+        if not self.stat:
+            return
+        cache = {}
+        cache['version'] = CACHE_VERSION
+        cache['stat'] = list(self.stat)
+        cache['comment'] = self.comment
+        cache['db'] = self.db
+        tmpPath = ""
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR, mode=0o700)
+            fd, tmpPath = tempfile.mkstemp(dir = CACHE_DIR, prefix = ".cache.")
+            with os.fdopen(fd, "w", encoding = ENCODING) as cache_file:
+                json.dump(cache, cache_file, separators = (",", ":"))
+            os.replace(tmpPath, CACHE_XML)
+        except:
+            # cache is optional, e.g. not writable when not super user
+            if tmpPath and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    def getSignature(self):
+        retval = None
+        try:
+            retval = json.dumps(self.db, sort_keys = True)
+        except:
+            pass
+        return retval
 
     def buildXML(self, xmltree, item):
         if isinstance(item, dict):
@@ -376,37 +742,39 @@ class database(object):
     def createXML(self):
         #print("Creating new XML file")
         db = ET.Element('settings')
-        comment = ET.Comment("This XML file contains the settings for openvpn automation.\n"
+        # kept for the cache written with the file, updates write it again
+        self.comment = ("This XML file contains the settings for openvpn automation.\n"
         "            Do not edit this file manually!!!")
+        comment = ET.Comment(self.comment)
         db.append(comment)
 
         XMLpath = self.getNewXMLpath()
 
-        with open(XMLpath, "w") as xml_file:
-            xml_file.write(self.prettify(db))
+        self.writeXML(XMLpath, db)
 
-    def getXMLcomment(self, tag):
+    def getXMLcomment(self, content, tag):
         comment = ""
-        XMLpath = self.getXMLpath()
-        with open(XMLpath, 'r') as xml_file:
-            content = xml_file.read()
-            if tag:
-                xmltag = "<{}>".format(tag)
-                xmlend = "</{}>".format(tag)
-                begin = content.find(xmltag)
-                end = content.find(xmlend)
-                content = content[begin:end]
-            cmttag = "<!--"
-            cmtend = "-->"
-            begin = content.find(cmttag)
-            end = content.find(cmtend)
-            if (begin > -1) and (end > -1):
-                comment = content[begin+len(cmttag):end]
+        if tag:
+            xmltag = "<{}>".format(tag)
+            xmlend = "</{}>".format(tag)
+            begin = content.find(xmltag)
+            end = content.find(xmlend)
+            content = content[begin:end]
+        cmttag = "<!--"
+        cmtend = "-->"
+        begin = content.find(cmttag)
+        end = content.find(cmtend)
+        if (begin > -1) and (end > -1):
+            comment = content[begin+len(cmttag):end]
         return comment
 
     def prettify(self, elem):
         """Return a pretty-printed XML string for the Element.
         """
+        if hasattr(ET, "indent"):
+            # serialize once, without reparsing
+            ET.indent(elem, space="\t")
+            return '<?xml version="1.0" encoding="%s"?>\n' % ENCODING + ET.tostring(elem, encoding="unicode") + "\n"
         rough_string = ET.tostring(elem, ENCODING)
         reparsed = parseString(rough_string)
         return reparsed.toprettyxml(indent="\t").replace('<?xml version="1.0" ?>','<?xml version="1.0" encoding="%s"?>' % ENCODING)
@@ -428,6 +796,15 @@ class database(object):
                 exit(1)
         return XMLpath
 
+    def getXMLstat(self):
+        retval = None
+        try:
+            st = os.stat(os.path.join("/etc/",XML_FILENAME))
+            retval = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except:
+            pass
+        return retval
+
     def getNewXMLpath(self):
         etcpath = "/etc/"
         XMLpath = ""
@@ -441,6 +818,1449 @@ class database(object):
             exit(1)
         return XMLpath
 
+#########################################################
+# Class : clientstore                                   #
+#########################################################
+class clientstore(object):
+    # Indexed layer over the <clients> block of the database.
+    # Clients are kept under random keys in the XML, the indexes map
+    # names to keys and users to names.
+    def __init__(self, db):
+        self.db = db
+        self.names = {}
+        self.users = {}
+        self.build()
+
+    def __del__(self):
+        pass
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def exists(self, name):
+        return name in self.names
+
+    def get(self, name):
+        retval = None
+        if name in self.names:
+            retval = self.clients()[self.names[name]]
+        return retval
+
+    def add(self, name, users = []):
+        key = self.getKey()
+        client = {}
+        client['name'] = name
+        client['users'] = self.userString(users)
+        self.clients()[key] = client
+        self.names[name] = key
+        self.indexUsers(name, client['users'])
+        return client
+
+    def setUsers(self, name, users = []):
+        client = self.get(name)
+        if client != None:
+            self.unindexUsers(name, client['users'])
+            client['users'] = self.userString(users)
+            self.indexUsers(name, client['users'])
+        return client
+
+    def remove(self, name):
+        client = None
+        if name in self.names:
+            client = self.clients().pop(self.names.pop(name))
+            self.unindexUsers(name, client['users'])
+        return client
+
+    def clear(self):
+        self.db()['clients'] = {}
+        self.names = {}
+        self.users = {}
+
+    def byUser(self, user):
+        return sorted(self.users.get(user, set()))
+
+    def list(self, user = None):
+        vals = []
+        if user != None:
+            names = self.byUser(user)
+        else:
+            names = self.names.keys()
+        for name in names:
+            val = {}
+            val['name'] = name
+            val['users'] = self.userList(self.get(name)['users'])
+            vals.append(val)
+        return vals
+
+################## INTERNAL FUNCTIONS ###################
+
+    def clients(self):
+        if not 'clients' in self.db() or not isinstance(self.db()['clients'], dict):
+            self.db()['clients'] = {}
+        return self.db()['clients']
+
+    def build(self):
+        # Migrate old style entries while indexing: an empty <clients> block,
+        # clients without name and users stored as python list
+        migrate = False
+        clients = self.clients()
+        for key in list(clients.keys()):
+            client = clients[key]
+            if not isinstance(client, dict) or not 'name' in client or not client['name'] or client['name'] in self.names:
+                clients.pop(key)
+                migrate = True
+                continue
+            client['name'] = str(client['name'])
+            users = client.get('users', "")
+            client['users'] = self.userString(users)
+            if isinstance(users, list) or (isinstance(users, str) and users != client['users']):
+                migrate = True
+            self.names[client['name']] = key
+            self.indexUsers(client['name'], client['users'])
+        if migrate:
+            self.db.update()
+
+    def indexUsers(self, name, users):
+        for user in self.userList(users):
+            self.users.setdefault(user, set()).add(name)
+
+    def unindexUsers(self, name, users):
+        for user in self.userList(users):
+            if user in self.users:
+                self.users[user].discard(name)
+                if not self.users[user]:
+                    del self.users[user]
+
+    def userString(self, users):
+        if isinstance(users, list):
+            users = ",".join([str(user).strip() for user in users])
+        elif users == None or isinstance(users, bool):
+            users = ""
+        else:
+            users = str(users)
+            if users.startswith("[") and users.endswith("]"):
+                users = ",".join([user.strip().strip("'\"") for user in users[1:-1].split(",")])
+        return users
+
+    def userList(self, users):
+        retval = []
+        if users:
+            retval = [user for user in users.split(",") if user]
+        return retval
+
+    def getKey(self):
+        # Random string with the combination of lower and upper case
+        letters = string.ascii_letters
+        key = ''.join(random.choice(letters) for i in range(16))
+        while key in self.clients():
+            key = ''.join(random.choice(letters) for i in range(16))
+        return key
+
+#########################################################
+# Class : bundlecache                                   #
+#########################################################
+class bundlecache(object):
+    # Client bundles (zip) cached as <name>-<hash>.zip, the hash covers
+    # the settings used in the client config and the certificate mtimes
+    def __init__(self, cacheDir = CACHE_BUNDLES):
+        self.cacheDir = cacheDir
+
+    def __del__(self):
+        pass
+
+    def get(self, name, key):
+        retval = None
+        try:
+            with open(self.getPath(name, key), 'rb') as bundle_file:
+                retval = bundle_file.read()
+        except:
+            pass
+        return retval
+
+    def set(self, name, key, data):
+        tmpPath = ""
+        # only one bundle per client, older ones are stale
+        self.evict(name)
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir, mode=0o700)
+            fd, tmpPath = tempfile.mkstemp(dir = self.cacheDir, prefix = ".bundle.")
+            with os.fdopen(fd, "wb") as bundle_file:
+                bundle_file.write(data)
+            os.replace(tmpPath, self.getPath(name, key))
+        except:
+            # cache is optional
+            if tmpPath and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    def evict(self, name = None):
+        try:
+            for file in os.listdir(self.cacheDir):
+                if name == None or self.getName(file) == name:
+                    os.remove(os.path.join(self.cacheDir, file))
+        except:
+            pass
+
+    def getKey(self, db, files):
+        settings = {}
+        for key in BUNDLEKEYS:
+            settings[key] = db.get(key)
+        stamps = []
+        for file in files:
+            try:
+                stamps.append(os.stat(file).st_mtime_ns)
+            except:
+                stamps.append(None)
+        return hashlib.sha256(json.dumps([settings, stamps], sort_keys = True).encode(ENCODING)).hexdigest()[:16]
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getPath(self, name, key):
+        return os.path.join(self.cacheDir, "{}-{}.zip".format(name, key))
+
+    def getName(self, file):
+        retval = None
+        if file.endswith(".zip") and len(file) > 21 and file[-21] == "-":
+            retval = file[:-21]
+        return retval
+
+#########################################################
+# Class : ovpnstatus                                    #
+#########################################################
+class ovpnstatus(object):
+    # Parses the openvpn status file (status-version 1, 2 and 3) line by
+    # line. The result is cached in memory and on disk, keyed on the file
+    # stat, so an unchanged file is never parsed twice.
+    def __init__(self, statusFile = SERVICE_STATUS_LOG, cacheFile = CACHE_STATUS):
+        self.statusFile = statusFile
+        self.cacheFile = cacheFile
+        self.stat = None
+        self.status = None
+
+    def __del__(self):
+        pass
+
+    def get(self):
+        stat = self.getStat()
+        if self.status != None and stat == self.stat:
+            return self.status
+        if not self.getCache(stat):
+            self.status = self.parseFile()
+            self.stat = stat
+            self.setCache()
+        return self.status
+
+    def parse(self, lines):
+        status = self.newStatus()
+        section = ""
+        headers = {}
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            sep = "\t" if "\t" in line else ","
+            fields = line.split(sep)
+            tag = fields[0]
+            # status-version 2 and 3
+            if tag == "HEADER" and len(fields) > 1:
+                headers[fields[1]] = fields[2:]
+            elif tag == "TIME" and len(fields) > 1:
+                status['updated'] = fields[1]
+            elif tag == "CLIENT_LIST":
+                status['clients'].append(self.getClient(dict(zip(headers.get(tag, []), fields[1:]))))
+            elif tag == "ROUTING_TABLE":
+                status['routes'].append(self.getRoute(dict(zip(headers.get(tag, []), fields[1:]))))
+            # status-version 1
+            elif line == "OpenVPN CLIENT LIST":
+                section = "clients"
+            elif line == "ROUTING TABLE":
+                section = "routes"
+            elif line == "GLOBAL STATS":
+                section = "stats"
+            elif tag == "Updated" and section == "clients" and not section in headers:
+                status['updated'] = sep.join(fields[1:])
+            elif tag in ["Common Name", "Virtual Address"]:
+                headers[section] = fields
+            elif section in ["clients", "routes"] and tag != "END":
+                values = dict(zip(headers.get(section, []), fields))
+                if section == "clients":
+                    status['clients'].append(self.getClient(values))
+                else:
+                    status['routes'].append(self.getRoute(values))
+        self.addRoutes(status)
+        return status
+
+################## INTERNAL FUNCTIONS ###################
+
+    def newStatus(self):
+        status = {}
+        status['updated'] = ""
+        status['clients'] = []
+        status['routes'] = []
+        return status
+
+    def parseFile(self):
+        status = self.newStatus()
+        try:
+            with open(self.statusFile, 'r', encoding = ENCODING, errors = 'replace') as status_file:
+                status = self.parse(status_file)
+        except:
+            pass
+        return status
+
+    def getClient(self, values):
+        client = {}
+        client['name'] = values.get("Common Name", "")
+        client['real_address'] = values.get("Real Address", "")
+        client['virtual_address'] = values.get("Virtual Address", "")
+        client['virtual_address6'] = values.get("Virtual IPv6 Address", "")
+        client['bytes_received'] = self.getInt(values.get("Bytes Received", 0))
+        client['bytes_sent'] = self.getInt(values.get("Bytes Sent", 0))
+        client['connected_since'] = values.get("Connected Since", "")
+        return client
+
+    def getRoute(self, values):
+        route = {}
+        route['virtual_address'] = values.get("Virtual Address", "")
+        route['name'] = values.get("Common Name", "")
+        route['real_address'] = values.get("Real Address", "")
+        route['last_ref'] = values.get("Last Ref", "")
+        return route
+
+    def addRoutes(self, status):
+        # version 1 has no virtual addresses in the client list
+        clients = {}
+        for client in status['clients']:
+            clients[(client['name'], client['real_address'])] = client
+        for route in status['routes']:
+            client = clients.get((route['name'], route['real_address']))
+            if client != None and not client['virtual_address'] and not ":" in route['virtual_address']:
+                client['virtual_address'] = route['virtual_address']
+
+    def getInt(self, value):
+        retval = 0
+        try:
+            retval = int(value)
+        except:
+            pass
+        return retval
+
+    def getStat(self):
+        retval = None
+        try:
+            st = os.stat(self.statusFile)
+            retval = [st.st_mtime_ns, st.st_size, st.st_ino]
+        except:
+            pass
+        return retval
+
+    def getCache(self, stat):
+        retval = False
+        try:
+            with open(self.cacheFile, 'r', encoding = ENCODING) as cache_file:
+                cache = json.load(cache_file)
+            if stat and cache['stat'] == stat:
+                self.status = cache['status']
+                self.stat = stat
+                retval = True
+        except:
+            pass
+        return retval
+
+    def setCache(self):
+        if not self.stat:
+            return
+        tmpPath = ""
+        try:
+            cacheDir = os.path.dirname(self.cacheFile)
+            if not os.path.isdir(cacheDir):
+                os.makedirs(cacheDir, mode=0o700)
+            fd, tmpPath = tempfile.mkstemp(dir = cacheDir, prefix = ".status.")
+            with os.fdopen(fd, "w", encoding = ENCODING) as cache_file:
+                json.dump({'stat': self.stat, 'status': self.status}, cache_file, separators = (",", ":"))
+            os.replace(tmpPath, self.cacheFile)
+        except:
+            # cache is optional
+            if tmpPath and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+#########################################################
+# Class : management                                    #
+#########################################################
+class management(object):
+    # Client for the openvpn management interface on a unix socket.
+    # The interface only accepts one client at a time, so connections are
+    # kept short. Real-time notifications (>...) are collected in events.
+    def __init__(self, socketPath = SERVICE_MANAGEMENT, timeout = 5):
+        self.socketPath = socketPath
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b""
+        self.events = []
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def available(self):
+        return os.path.exists(self.socketPath)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+        # wait for the greeting, >INFO:OpenVPN Management Interface ...
+        line = self.readLine()
+        while not line.startswith(">INFO:"):
+            self.addEvent(line)
+            line = self.readLine()
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.sendall(b"quit\n")
+            except:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    def command(self, cmd, multiLine = False):
+        # single line commands return SUCCESS: or ERROR:, multi line commands end with END
+        lines = []
+        self.sock.sendall((cmd + "\n").encode(ENCODING))
+        while True:
+            line = self.readLine()
+            if line.startswith(">"):
+                self.addEvent(line)
+            elif line.startswith("ERROR:"):
+                raise Exception("Management command '{}' failed: {}".format(cmd, line[6:].strip()))
+            elif not multiLine and line.startswith("SUCCESS:"):
+                lines.append(line[8:].strip())
+                break
+            elif multiLine and line == "END":
+                break
+            else:
+                lines.append(line)
+        return lines
+
+    def status(self):
+        status = ovpnstatus().parse(self.command("status 2", True))
+        status['source'] = "management"
+        return status
+
+    def kill(self, name):
+        return self.command("kill {}".format(name))[0]
+
+    def signal(self, sig):
+        return self.command("signal {}".format(sig))[0]
+
+    def bytecount(self, interval):
+        return self.command("bytecount {}".format(interval))[0]
+
+    def listen(self, seconds):
+        # collect real-time notifications for a number of seconds
+        end = time.time() + seconds
+        while time.time() < end:
+            self.sock.settimeout(max(end - time.time(), 0.01))
+            try:
+                self.addEvent(self.readLine())
+            except socket.timeout:
+                break
+        self.sock.settimeout(self.timeout)
+        return self.events
+
+################## INTERNAL FUNCTIONS ###################
+
+    def readLine(self):
+        while not b"\n" in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise Exception("Management interface closed connection")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode(ENCODING, errors = 'replace').rstrip("\r")
+
+    def addEvent(self, line):
+        # >CLIENT:CONNECT|REAUTH|ESTABLISHED|DISCONNECT,cid[,kid] followed by
+        # >CLIENT:ENV,name=value lines until >CLIENT:ENV,END
+        # >BYTECOUNT_CLI:cid,bytes_in,bytes_out
+        if not line.startswith(">"):
+            return
+        tag, _, data = line[1:].partition(":")
+        fields = data.split(",")
+        if tag == "CLIENT" and fields[0] == "ENV":
+            if self.events and self.events[-1]['type'] == "client" and fields[1:] != ["END"]:
+                name, _, value = ",".join(fields[1:]).partition("=")
+                self.events[-1]['env'][name] = value
+        elif tag == "CLIENT":
+            event = {}
+            event['type'] = "client"
+            event['event'] = fields[0].lower()
+            event['cid'] = fields[1] if len(fields) > 1 else ""
+            event['env'] = {}
+            self.events.append(event)
+        elif tag == "BYTECOUNT_CLI" and len(fields) > 2:
+            event = {}
+            event['type'] = "bytecount"
+            event['cid'] = fields[0]
+            event['bytes_received'] = ovpnstatus().getInt(fields[1])
+            event['bytes_sent'] = ovpnstatus().getInt(fields[2])
+            self.events.append(event)
+        else:
+            event = {}
+            event['type'] = tag.lower()
+            event['data'] = data
+            self.events.append(event)
+
+#########################################################
+# Class : easyrsa                                       #
+#########################################################
+class easyrsa(object):
+    def __init__(self, pkiDir = EASY_RSA_KEY_DIR):
+        self.pkiDir = pkiDir
+
+    def __del__(self):
+        pass
+
+    def genReq(self, name):
+        # generates private key and request, this is the slow part
+        shell().command(self.getCmd("gen-req", name, "nopass"))
+
+    def genReqs(self, names, pool = None):
+        # key generation is independent per client, run one per cpu
+        # openssl directly, parallel easyrsa runs would share their temporary files in the pki
+        # pooled keys only need a request for their name
+        # returns the exception or None per name
+        cmds = []
+        for name in names:
+            key = pool.take() if pool and pool.size > 0 else None
+            if key:
+                os.replace(key, self.getKey(name))
+                cmds.append(self.getReqCmd(name))
+            else:
+                cmds.append("umask 077 && {} && {}".format(" ".join(shlex.quote(arg) for arg in keypool().getCmd(self.getKey(name))),
+                                                           " ".join(shlex.quote(arg) for arg in self.getReqCmd(name))))
+        return [result if isinstance(result, Exception) else None for result in shell().commands(cmds, limit = os.cpu_count() or 1)]
+
+    def signReq(self, name, reqType = "client"):
+        # signing updates index and serial, so never run in parallel
+        shell().command(self.getCmd("sign-req", reqType, name))
+
+    def revoke(self, name):
+        shell().command(self.getCmd("revoke", name))
+
+    def genCrl(self, added = None):
+        # easyrsa always rebuilds the full list, added is for incremental backends
+        shell().command(self.getCmd("gen-crl"))
+
+    def getSerials(self):
+        # serial (hex) of the valid certificate per name
+        serials = {}
+        for entry in self.readIndex():
+            if entry[0] == "V" and entry[5].startswith("/CN="):
+                serials[entry[5][4:]] = entry[3]
+        return serials
+
+    def readIndex(self):
+        # openssl ca database: state, expiry, revocation, serial, file, subject
+        index = []
+        try:
+            with open(self.pkiDir + "/index.txt", "r") as file:
+                for line in file:
+                    entry = line.rstrip("\n").split("\t")
+                    if len(entry) >= 6:
+                        index.append(entry)
+        except FileNotFoundError:
+            pass
+        return index
+
+    def setup(self, hostname, dh = True, callback = None):
+        # returns (returncode, stdout, stderr) per step
+        return shell().runGraph(self.getSetupSteps(hostname, dh), callback)
+
+    def getSetupSteps(self, hostname, dh = True):
+        # dependency graph for a new pki, dh parameters don't depend on the ca
+        # and take longest, so they are generated next to the ca and server certificate
+        # dh = False when the parameters come from the pool or are not generated
+        steps = {}
+        steps['init-pki'] = ([], self.getCmd("init-pki"))
+        steps['build-ca'] = (['init-pki'], self.getCmd("build-ca", "nopass"))
+        steps['build-server-full'] = (['build-ca'], self.getCmd("build-server-full", hostname, "nopass"))
+        steps['gen-crl'] = (['build-server-full'], self.getCmd("gen-crl"))
+        if dh:
+            # openssl directly, like easyrsa gen-dh, without easyrsa touching its config next to the ca steps
+            steps['gen-dh'] = (['init-pki'], dhpool().getCmd(self.pkiDir + "/dh.pem"))
+        return steps
+
+    def removeCert(self, name):
+        self.removeReq(name)
+        file = self.pkiDir + "/issued/" + name + ".crt"
+        if os.path.isfile(file):
+            os.remove(file)
+
+    def removeReq(self, name):
+        files = [self.getKey(name), self.getReq(name)]
+        for file in files:
+            if os.path.isfile(file):
+                os.remove(file)
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getCmd(self, *args):
+        return [EASY_RSA_CMD, "--batch", "--pki-dir={}".format(self.pkiDir)] + list(args)
+
+    def getReqCmd(self, name):
+        return [OPENSSL_CMD, "req", "-new", "-batch", "-key", self.getKey(name),
+                "-subj", "/CN={}".format(name), "-out", self.getReq(name)]
+
+    def getKey(self, name):
+        return self.pkiDir + "/private/" + name + ".key"
+
+    def getReq(self, name):
+        return self.pkiDir + "/reqs/" + name + ".req"
+
+#########################################################
+
+#########################################################
+# Class : pythonpki                                     #
+#########################################################
+class pythonpki(easyrsa):
+    # in-process pki using the cryptography package, keeps the easyrsa layout
+    # (index.txt, serial, issued/, private/, reqs/, revoked/) so both can be mixed
+    def __init__(self, pkiDir = EASY_RSA_KEY_DIR):
+        super().__init__(pkiDir)
+        self.ca = None
+
+    @staticmethod
+    def available():
+        return x509 != None
+
+    @staticmethod
+    def genKey(keySize = EASY_RSA_KEY_SIZE):
+        # PEM of a new private key, runs in a worker process
+        key = rsa.generate_private_key(public_exponent = 65537, key_size = keySize)
+        return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+    def genReq(self, name, keyFile = None, keyData = None):
+        if keyFile:
+            with open(keyFile, "rb") as file:
+                key = serialization.load_pem_private_key(file.read(), password = None)
+            os.replace(keyFile, self.getKey(name))
+        else:
+            if not keyData:
+                keyData = self.genKey()
+            key = serialization.load_pem_private_key(keyData, password = None)
+            self.writeFile(self.getKey(name), keyData, 0o600)
+        req = x509.CertificateSigningRequestBuilder().subject_name(self.getName(name)).sign(key, hashes.SHA256())
+        self.writeFile(self.getReq(name), req.public_bytes(serialization.Encoding.PEM))
+
+    def genReqs(self, names, pool = None):
+        # key generation is independent per client, run one process per cpu,
+        # writing keys and requests is done here. Workers come from a forkserver,
+        # forking the threaded daemon could copy locks held by other threads.
+        keyFiles = [pool.take() if pool and pool.size > 0 else None for name in names]
+        if sum(keyFile == None for keyFile in keyFiles) < 2:
+            return [self.genReqError(name, keyFile) for name, keyFile in zip(names, keyFiles)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers = os.cpu_count() or 1,
+                                                    mp_context = multiprocessing.get_context("forkserver")) as executor:
+            futures = [None if keyFile else executor.submit(pythonpki.genKey, EASY_RSA_KEY_SIZE) for keyFile in keyFiles]
+            return [self.genReqError(name, keyFile, future) for name, keyFile, future in zip(names, keyFiles, futures)]
+
+    def signReq(self, name, reqType = "client"):
+        with open(self.getReq(name), "rb") as file:
+            req = x509.load_pem_x509_csr(file.read())
+        caCert, caKey = self.getCa()
+        self.issue(name, req.subject, req.public_key(), caCert, caKey, reqType)
+
+    def revoke(self, name):
+        with open(self.pkiDir + "/issued/" + name + ".crt", "rb") as file:
+            cert = x509.load_pem_x509_certificate(file.read())
+        serial = self.getSerial(cert.serial_number)
+        index = self.readIndex()
+        found = False
+        for entry in index:
+            if entry[3] == serial and entry[0] == "V":
+                entry[0] = "R"
+                entry[2] = self.getTime(datetime.datetime.now(datetime.timezone.utc))
+                found = True
+        if not found:
+            raise Exception("Certificate {} is not valid".format(name))
+        self.writeIndex(index)
+        # like easyrsa, keep the revoked files by serial
+        moves = [(self.pkiDir + "/issued/" + name + ".crt", "certs_by_serial", ".crt"),
+                 (self.getKey(name), "private_by_serial", ".key"),
+                 (self.getReq(name), "reqs_by_serial", ".req")]
+        for src, dest, ext in moves:
+            if os.path.isfile(src):
+                os.makedirs(self.pkiDir + "/revoked/" + dest, exist_ok = True)
+                os.replace(src, "{}/revoked/{}/{}{}".format(self.pkiDir, dest, serial, ext))
+
+    def genCrl(self, added = None):
+        # added: serials (hex) revoked since the last crl, these are added to the
+        # entries of the current crl instead of collecting all from the index
+        caCert, caKey = self.getCa()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        revoked = self.readCrl(caCert) if added != None else None
+        if revoked == None:
+            revoked = []
+            for entry in self.readIndex():
+                if entry[0] == "R":
+                    revoked.append(self.getRevoked(int(entry[3], 16), self.parseTime(entry[2].split(",")[0])))
+        else:
+            serials = set(item.serial_number for item in revoked)
+            for serial in added:
+                if int(serial, 16) not in serials:
+                    revoked.append(self.getRevoked(int(serial, 16), now))
+        number = self.nextNumber(self.pkiDir + "/crlnumber")
+        builder = x509.CertificateRevocationListBuilder().issuer_name(caCert.subject)
+        builder = builder.last_update(now).next_update(now + datetime.timedelta(days = EASY_RSA_CRL_DAYS))
+        builder = builder.add_extension(x509.CRLNumber(number), critical = False)
+        builder = builder.add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(caKey.public_key()), critical = False)
+        for item in revoked:
+            builder = builder.add_revoked_certificate(item)
+        crl = builder.sign(caKey, hashes.SHA256())
+        self.writeFile(self.pkiDir + "/crl.pem", crl.public_bytes(serialization.Encoding.PEM))
+
+    def setup(self, hostname, dh = True, callback = None):
+        # same steps as easyrsa, dh parameters are generated by openssl next to the ca
+        results = {}
+        dhThread = None
+        def run(step, func, *args):
+            if callback:
+                callback(step, "running", None, 0)
+            start = time.monotonic()
+            try:
+                func(*args)
+                results[step] = (0, "", "")
+            except Exception as e:
+                results[step] = (1, "", str(e))
+            if callback:
+                callback(step, "done" if results[step][0] == 0 else "failed", results[step][0], round(time.monotonic() - start, 3))
+            return results[step][0] == 0
+        steps = [('init-pki', self.initPki), ('build-ca', self.buildCa),
+                 ('build-server-full', self.buildFull, hostname, "server"), ('gen-crl', self.genCrl)]
+        for i, step in enumerate(steps):
+            if not run(*step):
+                for skipped in steps[i + 1:]:
+                    results[skipped[0]] = (CMDSKIPPED, "", "Skipped, {} failed".format(step[0]))
+                    if callback:
+                        callback(skipped[0], "skipped", CMDSKIPPED, 0)
+                break
+            if dh and step[0] == 'init-pki':
+                dhThread = threading.Thread(target = run, args = ('gen-dh', shell().command, dhpool().getCmd(self.pkiDir + "/dh.pem")))
+                dhThread.start()
+        if dhThread:
+            dhThread.join()
+        elif dh:
+            results['gen-dh'] = (CMDSKIPPED, "", "Skipped, init-pki failed")
+        return results
+
+    def initPki(self):
+        if os.path.isdir(self.pkiDir):
+            for item in os.listdir(self.pkiDir):
+                path = self.pkiDir + "/" + item
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        os.makedirs(self.pkiDir + "/private", mode = 0o700, exist_ok = True)
+        os.makedirs(self.pkiDir + "/reqs", exist_ok = True)
+        self.ca = None
+
+    def buildCa(self):
+        for folder in ["issued", "certs_by_serial", "revoked/certs_by_serial", "revoked/private_by_serial", "revoked/reqs_by_serial"]:
+            os.makedirs(self.pkiDir + "/" + folder, exist_ok = True)
+        self.writeFile(self.pkiDir + "/index.txt", b"")
+        self.writeFile(self.pkiDir + "/index.txt.attr", b"unique_subject = no\n")
+        self.writeFile(self.pkiDir + "/serial", b"01\n")
+        key = rsa.generate_private_key(public_exponent = 65537, key_size = EASY_RSA_KEY_SIZE)
+        subject = self.getName("Easy-RSA CA")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        builder = x509.CertificateBuilder().subject_name(subject).issuer_name(subject)
+        builder = builder.public_key(key.public_key()).serial_number(x509.random_serial_number())
+        builder = builder.not_valid_before(now).not_valid_after(now + datetime.timedelta(days = EASY_RSA_CA_DAYS))
+        builder = builder.add_extension(x509.BasicConstraints(ca = True, path_length = None), critical = False)
+        builder = builder.add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical = False)
+        builder = builder.add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(key.public_key()), critical = False)
+        builder = builder.add_extension(x509.KeyUsage(digital_signature = False, content_commitment = False, key_encipherment = False,
+                                                      data_encipherment = False, key_agreement = False, key_cert_sign = True,
+                                                      crl_sign = True, encipher_only = False, decipher_only = False), critical = False)
+        cert = builder.sign(key, hashes.SHA256())
+        self.writeFile(self.pkiDir + "/private/ca.key", self.keyBytes(key), 0o600)
+        self.writeFile(self.pkiDir + "/ca.crt", cert.public_bytes(serialization.Encoding.PEM))
+        self.ca = (cert, key)
+
+    def buildFull(self, name, reqType = "client"):
+        self.genReq(name)
+        self.signReq(name, reqType)
+
+################## INTERNAL FUNCTIONS ###################
+
+    def issue(self, name, subject, publicKey, caCert, caKey, reqType):
+        index = self.readIndex()
+        serials = set(entry[3] for entry in index)
+        serialNumber = x509.random_serial_number()
+        while self.getSerial(serialNumber) in serials:
+            serialNumber = x509.random_serial_number()
+        serial = self.getSerial(serialNumber)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expires = now + datetime.timedelta(days = EASY_RSA_CERT_DAYS)
+        builder = x509.CertificateBuilder().subject_name(subject).issuer_name(caCert.subject)
+        builder = builder.public_key(publicKey).serial_number(serialNumber)
+        builder = builder.not_valid_before(now).not_valid_after(expires)
+        builder = builder.add_extension(x509.BasicConstraints(ca = False, path_length = None), critical = False)
+        builder = builder.add_extension(x509.SubjectKeyIdentifier.from_public_key(publicKey), critical = False)
+        builder = builder.add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(caKey.public_key()), critical = False)
+        if reqType == "server":
+            usage = ExtendedKeyUsageOID.SERVER_AUTH
+            builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(name)]), critical = False)
+        else:
+            usage = ExtendedKeyUsageOID.CLIENT_AUTH
+        builder = builder.add_extension(x509.ExtendedKeyUsage([usage]), critical = False)
+        builder = builder.add_extension(x509.KeyUsage(digital_signature = True, content_commitment = False, key_encipherment = reqType == "server",
+                                                      data_encipherment = False, key_agreement = False, key_cert_sign = False,
+                                                      crl_sign = False, encipher_only = False, decipher_only = False), critical = False)
+        cert = builder.sign(caKey, hashes.SHA256())
+        data = cert.public_bytes(serialization.Encoding.PEM)
+        self.writeFile(self.pkiDir + "/issued/" + name + ".crt", data)
+        os.makedirs(self.pkiDir + "/certs_by_serial", exist_ok = True)
+        self.writeFile(self.pkiDir + "/certs_by_serial/" + serial + ".pem", data)
+        index.append(["V", self.getTime(expires), "", serial, "unknown", "/CN=" + name])
+        self.writeIndex(index)
+        self.writeFile(self.pkiDir + "/serial", (self.getSerial(serialNumber + 1) + "\n").encode())
+
+    def readCrl(self, caCert):
+        # revoked entries of the current crl, None when there is no valid crl
+        try:
+            with open(self.pkiDir + "/crl.pem", "rb") as file:
+                crl = x509.load_pem_x509_crl(file.read())
+        except (OSError, ValueError):
+            return None
+        if crl.issuer != caCert.subject or not crl.is_signature_valid(caCert.public_key()):
+            return None
+        return list(crl)
+
+    def getRevoked(self, serialNumber, date):
+        return x509.RevokedCertificateBuilder().serial_number(serialNumber).revocation_date(date).build()
+
+    def getCa(self):
+        if not self.ca:
+            with open(self.pkiDir + "/ca.crt", "rb") as file:
+                cert = x509.load_pem_x509_certificate(file.read())
+            with open(self.pkiDir + "/private/ca.key", "rb") as file:
+                key = serialization.load_pem_private_key(file.read(), password = None)
+            self.ca = (cert, key)
+        return self.ca
+
+    def writeIndex(self, index):
+        self.writeFile(self.pkiDir + "/index.txt", "".join("\t".join(entry) + "\n" for entry in index).encode())
+
+    def nextNumber(self, path):
+        number = 1
+        try:
+            with open(path, "r") as file:
+                number = int(file.read().strip(), 16)
+        except (OSError, ValueError):
+            pass
+        self.writeFile(path, "{:02X}\n".format(number + 1).encode())
+        return number
+
+    def writeFile(self, path, data, mode = 0o644):
+        # atomic, the daemon and the cli may read while writing
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def genReqError(self, name, keyFile, future = None):
+        # returns the exception or None
+        try:
+            self.genReq(name, keyFile, future.result() if future else None)
+        except Exception as e:
+            return e
+        return None
+
+    def keyBytes(self, key):
+        return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+    def getName(self, name):
+        return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+
+    def getSerial(self, serialNumber):
+        serial = "{:X}".format(serialNumber)
+        return serial if len(serial) % 2 == 0 else "0" + serial
+
+    def getTime(self, date):
+        # openssl ca database format
+        return date.strftime("%y%m%d%H%M%SZ")
+
+    def parseTime(self, value):
+        # UTCTime, GeneralizedTime after 2049
+        timeFormat = "%Y%m%d%H%M%SZ" if len(value) > 13 else "%y%m%d%H%M%SZ"
+        return datetime.datetime.strptime(value, timeFormat).replace(tzinfo = datetime.timezone.utc)
+
+#########################################################
+
+#########################################################
+# Class : crldir                                        #
+#########################################################
+class crldir(object):
+    # crl-verify <dir> dir layout, an (empty) file per revoked serial, named
+    # by the decimal serial number. OpenVPN checks for the file on every handshake,
+    # so revoking only adds files and doesn't need the server to reread a crl.
+    # OpenVPN opens the files after dropping privileges and a file it can't open
+    # counts as not revoked, so the directory and files are world readable.
+    def __init__(self, crlDir = CRL_DIR):
+        self.crlDir = crlDir
+
+    def __del__(self):
+        pass
+
+    def add(self, serials):
+        self.makeDir()
+        for serial in serials:
+            self.touch(self.getPath(serial))
+
+    def remove(self, serials):
+        for serial in serials:
+            path = self.getPath(serial)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def isRevoked(self, serial):
+        return os.path.isfile(self.getPath(serial))
+
+    def sync(self, index):
+        # make the directory match the revoked entries in the pki index
+        # returns the number of revoked serials
+        revoked = set(str(int(entry[3], 16)) for entry in index if entry[0] == "R")
+        self.makeDir()
+        current = set(os.listdir(self.crlDir))
+        for serial in current - revoked:
+            os.remove(self.crlDir + "/" + serial)
+        for serial in revoked - current:
+            self.touch(self.crlDir + "/" + serial)
+        return len(revoked)
+
+################## INTERNAL FUNCTIONS ###################
+
+    def makeDir(self):
+        if not os.path.isdir(self.crlDir):
+            os.makedirs(self.crlDir, mode = 0o755)
+        if os.stat(self.crlDir).st_mode & 0o777 != 0o755:
+            os.chmod(self.crlDir, 0o755) # makedirs mode is masked by the umask
+
+    def touch(self, path):
+        open(path, "a").close()
+        os.chmod(path, 0o644)
+
+    def getPath(self, serial):
+        # hex serial as in the pki index
+        return "{}/{}".format(self.crlDir, int(serial, 16))
+
+#########################################################
+
+#########################################################
+# Class : iptables                                      #
+#########################################################
+class iptables(object):
+    # a rule per ExecStart/ ExecStop line
+    def __init__(self):
+        self.iptablesPath = shutil.which("iptables") or "/usr/sbin/iptables"
+        self.ip6tablesPath = shutil.which("ip6tables") or "/usr/sbin/ip6tables"
+
+    def __del__(self):
+        pass
+
+    @staticmethod
+    def available():
+        return shutil.which("iptables") != None
+
+    def getUnit(self, rules):
+        unit = []
+        for net in rules['nets']:
+            if net['family'] == 4:
+                unit.extend(self.getRules(self.iptablesPath, net, rules['inputs']))
+            else:
+                unit.extend(self.getRules(self.ip6tablesPath, net, []))
+        return unit
+
+    def getFiles(self, rules):
+        return {}
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getRules(self, path, net, inputs):
+        starts = []
+        stops = []
+        rules = []
+        # explicit source ports only apply to protocols with ports, the rest is a fallback
+        # more addresses share the new connections equally, the nth rule of n takes every
+        # (n - i)th connection that passed the rules before it (nat only sees the first packet)
+        for proto in (SNAT_PROTOCOLS if net['ports'] else []) + [None]:
+            for i, address in enumerate(net['snat']):
+                match = "-s {} ! -d {}".format(net['network'], net['network'])
+                if proto:
+                    match += " -p {}".format(proto)
+                if i < len(net['snat']) - 1:
+                    match += " -m statistic --mode nth --every {} --packet 0".format(len(net['snat']) - i)
+                target = self.getTarget(net, address) if proto else address
+                rules.append(("-t nat -A POSTROUTING", "-t nat -D POSTROUTING", "{} -j SNAT --to {}".format(match, target)))
+        for proto, port in inputs:
+            rules.append(("-I INPUT", "-D INPUT", "-p {} --dport {} -j ACCEPT".format(proto, port)))
+        rules.append(("-I FORWARD", "-D FORWARD", "-s {} -j ACCEPT".format(net['network'])))
+        rules.append(("-I FORWARD", "-D FORWARD", "-m state --state RELATED,ESTABLISHED -j ACCEPT"))
+        for start, stop, rule in rules:
+            starts.append("ExecStart={} {} {}".format(path, start, rule))
+            stops.append("ExecStop={} {} {}".format(path, stop, rule))
+        return starts + stops
+
+    def getTarget(self, net, address):
+        if net['family'] == 6:
+            return "[{}]:{}".format(address, net['ports'])
+        return "{}:{}".format(address, net['ports'])
+
+#########################################################
+# Class : nftables                                      #
+#########################################################
+class nftables(object):
+    # all rules in one table, loaded as one transaction by nft -f and
+    # removed by deleting the table
+    def __init__(self, confFile = SERVICE_NFT_CONF, table = NFT_TABLE):
+        self.nftPath = shutil.which("nft") or "/usr/sbin/nft"
+        self.confFile = confFile
+        self.table = table
+
+    def __del__(self):
+        pass
+
+    @staticmethod
+    def available():
+        return shutil.which("nft") != None
+
+    def isFiltered(self):
+        # an accept in this table doesn't override a drop in another table, so
+        # other input/ forward base chains (docker, ufw, firewalld, iptables-nft)
+        # or legacy iptables rules need the rules in the host's own chains
+        try:
+            stdout = shell().command([self.nftPath, "-j", "list", "chains"])
+            for item in json.loads(stdout).get("nftables", []):
+                chain = item.get("chain")
+                if chain and chain.get("hook") in ["input", "forward"] and \
+                   "{} {}".format(chain.get("family"), chain.get("table")) != self.table:
+                    return True
+            legacy = shutil.which("iptables-legacy")
+            if legacy:
+                for chain in ["INPUT", "FORWARD"]:
+                    if shell().command([legacy, "-S", chain]).splitlines() != ["-P {} ACCEPT".format(chain)]:
+                        return True
+        except:
+            return True
+        return False
+
+    def getUnit(self, rules):
+        unit = []
+        unit.append("ExecStart={} -f {}".format(self.nftPath, self.confFile))
+        unit.append("ExecReload={} -f {}".format(self.nftPath, self.confFile))
+        unit.append("ExecStop={} delete table {}".format(self.nftPath, self.table))
+        return unit
+
+    def getFiles(self, rules):
+        conf = []
+        conf.append("#!{} -f".format(self.nftPath))
+        # create the table if it doesn't exist, so the delete never fails and the
+        # file replaces all rules atomically
+        conf.append("table {}".format(self.table))
+        conf.append("delete table {}".format(self.table))
+        conf.append("table {} {{".format(self.table))
+        conf.append("    chain input {")
+        conf.append("        type filter hook input priority filter; policy accept;")
+        for proto, port in rules['inputs']:
+            conf.append("        {} dport {} accept".format(proto, port))
+        conf.append("    }")
+        conf.append("    chain forward {")
+        conf.append("        type filter hook forward priority filter; policy accept;")
+        conf.append("        ct state related,established accept")
+        for net in rules['nets']:
+            conf.append("        {} saddr {} accept".format(self.getFamily(net), net['network']))
+        conf.append("    }")
+        conf.append("    chain postrouting {")
+        conf.append("        type nat hook postrouting priority srcnat; policy accept;")
+        for net in rules['nets']:
+            family = self.getFamily(net)
+            match = "{} saddr {} {} daddr != {}".format(family, net['network'], family, net['network'])
+            if len(net['snat']) == 1:
+                conf.extend(self.getSnat(net, match, net['snat'][0]))
+            else:
+                # clients are spread equally by a hash of their address, the seed is
+                # fixed so a client keeps its egress address when the rules are reloaded
+                verdicts = ", ".join("{} : jump {}".format(i, self.getChain(net, i)) for i in range(len(net['snat'])))
+                conf.append("        {} jhash {} saddr mod {} seed 0x0 vmap {{ {} }}".format(match, family, len(net['snat']), verdicts))
+        conf.append("    }")
+        for net in rules['nets']:
+            if len(net['snat']) > 1:
+                for i, address in enumerate(net['snat']):
+                    conf.append("    chain {} {{".format(self.getChain(net, i)))
+                    conf.extend(self.getSnat(net, "", address))
+                    conf.append("    }")
+        conf.append("}")
+        return {self.confFile: conf}
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getFamily(self, net):
+        return "ip" if net['family'] == 4 else "ip6"
+
+    def getChain(self, net, index):
+        return "snat_{}_{}".format(self.getFamily(net), index)
+
+    def getSnat(self, net, match, address):
+        snat = []
+        family = self.getFamily(net)
+        prefix = "        " + match + " " if match else "        "
+        if net['ports']:
+            snat.append("{}meta l4proto {{ {} }} snat {} to {}".format(prefix, ", ".join(SNAT_PROTOCOLS), family, self.getTarget(net, address)))
+        snat.append("{}snat {} to {}".format(prefix, family, address))
+        return snat
+
+    def getTarget(self, net, address):
+        if net['family'] == 6:
+            return "[{}]:{}".format(address, net['ports'])
+        return "{}:{}".format(address, net['ports'])
+
+#########################################################
+
+#########################################################
+# Class : addresspool                                   #
+#########################################################
+class addresspool(object):
+    # Static client addresses for one server network, a client-config-dir file
+    # (ifconfig-push) per client. Used addresses are kept in a bitmap, a bit per
+    # address, so allocating (next fit from the last allocation) and freeing
+    # don't depend on the number of clients. The bitmap is stored in the ccd
+    # directory and is rebuilt from the ccd files when missing or when the
+    # network changed.
+    def __init__(self, network, ccdDir = SERVICE_CCD_DIR):
+        self.network = network
+        self.ccdDir = ccdDir
+        self.bitmapFile = ccdDir + "/.bitmap"
+        self.bitmap = None
+        self.next = 0
+        self.lock = None
+        self.changed = False
+
+    def __del__(self):
+        pass
+
+    def __enter__(self):
+        if not os.path.isdir(self.ccdDir):
+            os.makedirs(self.ccdDir, mode = 0o755)
+        self.lock = open(self.ccdDir + "/.lock", "w")
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.load()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.changed:
+                self.save()
+        finally:
+            self.lock.close()
+            self.lock = None
+
+    def allocate(self, name):
+        # returns the address of the client, a new one when it has none
+        address = self.getAddress(name)
+        if address != None:
+            return address
+        offset = self.getFree()
+        if offset == None:
+            raise Exception("No free address in {}".format(self.network))
+        self.setBit(offset, True)
+        address = str(self.network.network_address + offset)
+        self.writeCcd(name, address)
+        return address
+
+    def free(self, name):
+        address = self.getAddress(name)
+        if address != None:
+            self.setBit(int(ipaddress.ip_address(address)) - int(self.network.network_address), False)
+        path = self.ccdDir + "/" + name
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def sync(self, names):
+        # allocate for all clients, remove files of clients that don't exist
+        # names is a set, it is looked up for every ccd file
+        for file in os.listdir(self.ccdDir):
+            if not file.startswith(".") and not file in names:
+                self.free(file)
+        for name in names:
+            self.allocate(name)
+
+    def count(self):
+        return sum(bin(byte).count("1") for byte in self.bitmap) - len(self.getReserved())
+
+################## INTERNAL FUNCTIONS ###################
+
+    def load(self):
+        header = self.getHeader()
+        try:
+            with open(self.bitmapFile, "rb") as file:
+                data = file.read()
+            if data.startswith(header) and len(data) == len(header) + self.getSize():
+                self.bitmap = bytearray(data[len(header):])
+                return
+        except OSError:
+            pass
+        self.rebuild()
+
+    def save(self):
+        fd, tmp = tempfile.mkstemp(dir = self.ccdDir, prefix = ".bitmap.")
+        with os.fdopen(fd, "wb") as file:
+            file.write(self.getHeader() + bytes(self.bitmap))
+        os.replace(tmp, self.bitmapFile)
+        self.changed = False
+
+    def rebuild(self):
+        # from the ccd files, files with an address outside the network are reallocated
+        self.bitmap = bytearray(self.getSize())
+        self.changed = True
+        for offset in self.getReserved():
+            self.setBit(offset, True)
+        for file in os.listdir(self.ccdDir):
+            if file.startswith("."):
+                continue
+            address = self.readCcd(file)
+            offset = int(ipaddress.ip_address(address)) - int(self.network.network_address) if address else -1
+            if offset in self.getReserved() or offset < 0 or offset >= self.network.num_addresses or self.getBit(offset):
+                os.remove(self.ccdDir + "/" + file)
+            else:
+                self.setBit(offset, True)
+
+    def getFree(self):
+        # first byte with a free bit from the last allocation, wraps around once
+        size = len(self.bitmap)
+        for start, end in [(self.next // 8, size), (0, size)]:
+            match = re.compile(b"[^\xff]").search(self.bitmap, start, end)
+            if match:
+                byte = match.start()
+                for bit in range(8):
+                    offset = byte * 8 + bit
+                    if offset < self.network.num_addresses and not self.getBit(offset):
+                        self.next = offset
+                        return offset
+        return None
+
+    def getAddress(self, name):
+        address = self.readCcd(name)
+        if address and ipaddress.ip_address(address) in self.network:
+            return address
+        return None
+
+    def readCcd(self, name):
+        try:
+            with open(self.ccdDir + "/" + name, "r") as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) >= 2 and fields[0] == "ifconfig-push":
+                        ipaddress.ip_address(fields[1])
+                        return fields[1]
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def writeCcd(self, name, address):
+        with open(self.ccdDir + "/" + name, "w") as file:
+            file.write("ifconfig-push {} {}\n".format(address, self.network.netmask))
+
+    def getHeader(self):
+        return "{}\n".format(self.network).encode()
+
+    def getSize(self):
+        return (self.network.num_addresses + 7) // 8
+
+    def getReserved(self):
+        # network, server (first host) and broadcast address
+        return [0, 1, self.network.num_addresses - 1]
+
+    def getBit(self, offset):
+        return self.bitmap[offset // 8] & (1 << (offset % 8)) != 0
+
+    def setBit(self, offset, value):
+        if value:
+            self.bitmap[offset // 8] |= 1 << (offset % 8)
+        else:
+            self.bitmap[offset // 8] &= ~(1 << (offset % 8)) & 0xff
+        self.changed = True
+
+#########################################################
+
+#########################################################
+# Class : filepool                                      #
+#########################################################
+class filepool(object):
+    # pool of files that are slow to generate, files are generated to a temporary
+    # file first and are moved in place when complete
+    def __init__(self, poolDir, size, name):
+        self.poolDir = poolDir
+        self.size = size
+        self.name = name
+
+    def __del__(self):
+        pass
+
+    def count(self):
+        return len(self.getFiles())
+
+    def take(self):
+        # reserves a pooled file, returns its path or None when the pool is empty
+        for file in self.getFiles():
+            taken = file + ".taken"
+            try:
+                os.rename(file, taken)
+                self.addStat("hits")
+                return taken
+            except OSError:
+                continue # taken by someone else
+        self.addStat("misses")
+        return None
+
+    def release(self, taken):
+        # returns a taken file that wasn't used to the pool
+        if taken and os.path.isfile(taken):
+            try:
+                os.rename(taken, taken[:-len(".taken")])
+            except OSError:
+                pass
+
+    def fill(self):
+        # generate until the pool is full, only one filler at a time
+        self.makeDir()
+        with open(self.poolDir + "/.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            while self.count() < self.size:
+                tmp = "{}/.{}-{}.tmp".format(self.poolDir, self.name, os.getpid())
+                try:
+                    shell().command(self.getCmd(tmp))
+                    os.chmod(tmp, 0o600)
+                except:
+                    if os.path.isfile(tmp):
+                        os.remove(tmp)
+                    return False
+                os.replace(tmp, "{}/{}-{}.pem".format(self.poolDir, self.name, time.time_ns()))
+        return True
+
+    def refill(self, daemon = False):
+        # fill in the background, a thread in the daemon, otherwise a detached process
+        if self.count() >= self.size:
+            return
+        if daemon:
+            threading.Thread(target = self.fill, daemon = True).start()
+        else:
+            try:
+                subprocess.Popen([sys.executable, os.path.realpath(__file__), self.name + "pool", "fill"],
+                                 stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL,
+                                 stderr = subprocess.DEVNULL, start_new_session = True)
+            except:
+                pass
+
+    def getStats(self):
+        vals = {}
+        vals['size'] = self.size
+        vals['ready'] = self.count()
+        vals['hits'] = 0
+        vals['misses'] = 0
+        try:
+            with open(self.poolDir + "/stats.json", "r") as file:
+                vals.update(json.load(file))
+        except:
+            pass
+        return vals
+
+    def getCmd(self, path):
+        return []
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getFiles(self):
+        try:
+            return sorted(self.poolDir + "/" + file for file in os.listdir(self.poolDir) if file.endswith(".pem"))
+        except OSError:
+            return []
+
+    def makeDir(self):
+        if not os.path.isdir(self.poolDir):
+            os.makedirs(self.poolDir, mode = 0o700)
+
+    def addStat(self, key):
+        try:
+            self.makeDir()
+            with open(self.poolDir + "/stats.json", "a+") as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                file.seek(0)
+                try:
+                    stats = json.load(file)
+                except ValueError:
+                    stats = {}
+                stats[key] = stats.get(key, 0) + 1
+                file.seek(0)
+                file.truncate()
+                json.dump(stats, file)
+        except OSError:
+            pass # statistics only
+
+#########################################################
+
+#########################################################
+# Class : dhpool                                        #
+#########################################################
+class dhpool(filepool):
+    def __init__(self, poolDir = DH_POOL_DIR, size = DH_POOL_SIZE):
+        super().__init__(poolDir, size, "dh")
+
+    def getPredefined(self, group, path):
+        # RFC 7919 groups are fixed constants
+        if not os.path.isfile(path):
+            with open(path, "w") as file:
+                file.write(FFDHE_GROUPS[group])
+        return path
+
+    def getCmd(self, path):
+        return [OPENSSL_CMD, "dhparam", "-out", path, str(EASY_RSA_DH_SIZE)]
+
+#########################################################
+
+#########################################################
+# Class : keypool                                       #
+#########################################################
+class keypool(filepool):
+    # private keys only, the request is made when the name is known
+    def __init__(self, poolDir = KEY_POOL_DIR, size = 0):
+        super().__init__(poolDir, size, "key")
+
+    def getCmd(self, path):
+        return [OPENSSL_CMD, "genpkey", "-algorithm", "RSA", "-pkeyopt",
+                "rsa_keygen_bits:{}".format(EASY_RSA_KEY_SIZE), "-out", path]
+
 #########################################################
 
 #########################################################
@@ -449,6 +2269,14 @@ class database(object):
 class sfccli(object):
     def __init__(self):
         self.name = ""
+        self.daemon = False
+        self.db = None
+        self.lock = None
+        self.dbLock = threading.RLock()
+        self.progress = False
+        self.local = threading.local()
+        self.cache = {}
+        self.ovpnStatus = {}
 
     def __del__(self):
         pass
@@ -465,7 +2293,9 @@ class sfccli(object):
         else:
             self.name = argv[0]
 
-        for arg in argv:
+        args = []
+        timing = False
+        for arg in argv[1:]:
             if arg[0] == "-":
                 if arg == "-h" or arg == "--help":
                     self.printHelp()
@@ -474,70 +2304,132 @@ class sfccli(object):
                     print(self)
                     print("Version: {}".format(VERSION))
                     exit()
+                elif arg == "-t" or arg == "--timing":
+                    timing = True
+                elif arg == "-p" or arg == "--progress":
+                    self.progress = True
                 else:
                     self.parseError(arg)
-        if len(argv) < 2:
+            else:
+                args.append(arg)
+        try:
+            self.execute(args)
+        finally:
+            if timing:
+                print(json.dumps(shell.getTimings()), file = sys.stderr)
+
+    def execute(self, args):
+        if len(args) < 1:
             self.lst()
-        elif argv[1] == "setup":
-            opt = argv[1]
-            if len(argv) < 3:
+        elif args[0] == "list":
+            opt = args[0]
+            if len(args) < 2:
+                self.lst()
+            else:
+                self.lst(args[1])
+        elif args[0] == "setup":
+            opt = args[0]
+            if len(args) < 2:
                 opt += " <json options>"
                 self.parseError(opt)
-            self.setup(argv[2])
-        elif argv[1] == "get":
-            opt = argv[1]
+            self.setup(args[1])
+        elif args[0] == "get":
+            opt = args[0]
             self.get()
-        elif argv[1] == "add":
-            opt = argv[1]
-            if len(argv) < 3:
+        elif args[0] == "add":
+            opt = args[0]
+            if len(args) < 2:
                 opt += " <json options>"
                 self.parseError(opt)
-            self.cadd(argv[2])
-        elif argv[1] == "del":
-            opt = argv[1]
-            if len(argv) < 3:
+            self.cadd(args[1])
+        elif args[0] == "del":
+            opt = args[0]
+            if len(args) < 2:
                 opt += " <json options>"
                 self.parseError(opt)
-            self.cdel(argv[2])
-        elif argv[1] == "download":
-            opt = argv[1]
-            if len(argv) < 3:
+            self.cdel(args[1])
+        elif args[0] == "download":
+            opt = args[0]
+            if len(args) < 2:
                 opt += " <json options>"
                 self.parseError(opt)
-            self.cdownload(argv[2])
-        elif argv[1] == "setup_cert":
-            opt = argv[1]
-            self.setup_cert()
-        elif argv[1] == "getopt":
-            opt = argv[1]
+            self.cdownload(args[1])
+        elif args[0] == "setup_cert":
+            opt = args[0]
+            self.setup_cert(progress = True)
+        elif args[0] == "getopt":
+            opt = args[0]
             self.getopt()
-        elif argv[1] == "ctl":
-            opt = argv[1]
-            if len(argv) < 3:
+        elif args[0] == "snapshot":
+            opt = args[0]
+            self.snapshot()
+        elif args[0] == "status":
+            opt = args[0]
+            if len(args) < 2:
+                self.status()
+            else:
+                self.status(args[1])
+        elif args[0] == "ctl":
+            opt = args[0]
+            if len(args) < 2:
                 opt += " <name>"
                 self.parseError(opt)
-            self.ctl(argv[2])
+            self.ctl(args[1])
+        elif args[0] == "dhpool":
+            opt = args[0]
+            if len(args) < 2:
+                self.dhpool()
+            else:
+                self.dhpool(args[1])
+        elif args[0] == "keypool":
+            opt = args[0]
+            if len(args) < 2:
+                self.keypool()
+            else:
+                self.keypool(args[1])
+        elif args[0] == "serve" and not self.daemon:
+            opt = args[0]
+            self.serve()
         else:
-            self.parseError(argv[1])
+            self.parseError(args[0])
 
     def printHelp(self):
         print(self)
         print("Usage:")
-        print("    {} {}".format(self.name, "<argument> <json options>"))
+        print("    {} {}".format(self.name, "[-t] [-p] <argument> <json options>"))
+        print("    -t, --timing      : print the timing of external commands (JSON) to stderr")
+        print("    -p, --progress    : print the progress of setup (JSON lines) before the result")
         print("    <arguments>")
-        print("        setup         : setup/ update openvpn with <json options>")
+        print("        setup         : setup/ update openvpn with <json options>, only changed files are")
+        print("                        written and services are only restarted when required")
         print("        get           : gets current settings")
         print("        add           : add an openvpn certificate <json options>")
         print("                        Options: name       : unique name for certificate")
         print("                                 users      : list of users allowed to download")
+        print("                        A list of options adds multiple certificates at once")
         print("        del           : deletes/ revokes an openvpn certificate <json options>")
         print("                        Options: name       : unique name for certificate")
+        print("                        A list of names deletes multiple certificates at once")
         print("        download      : downloads an openvpn certificate <json options>")
         print("                        Options: name       : unique name for certificate")
-        print("        setup_cert    : setup certificates only")
+        print("                                 names      : list of names to download in one archive")
+        print("                                 stream     : base64 (JSON) or raw, write the zip to stdout")
+        print("                                              instead of " + TMP_DIR)
+        print("        setup_cert    : setup certificates only, reports progress per step (JSON lines)")
         print("        getopt        : gets options specific for this server")
+        print("        snapshot      : gets settings (get), options (getopt) and certificates (list) at once")
+        print("        status        : gets connected clients and routing table <json options>")
+        print("                        Options: events     : seconds to collect live events (management)")
+        print("                                 interval   : byte count interval during events")
         print("        ctl           : controls daemon (start, stop, enable, disable, restart,")
-        print("                                         reload, isactive, isenabled)")
+        print("                                         reload, isactive, isenabled, show)")
+        print("        dhpool        : gets size, ready files and hits/ misses of the dh parameter pool")
+        print("                        fill       : generate until the pool is full")
+        print("        keypool       : gets size, ready keys and hits/ misses of the client key pool")
+        print("                        fill       : generate until the pool is full")
+        print("        serve         : runs as daemon, serving commands on {}".format(SERVICE_SOCKET))
+        print("        list          : lists current certificates <json options>")
+        print("                        Options: user       : only list certificates of this user")
         print("        <no arguments>: lists current certificates")
         print("")
         print("JSON options may be entered as single JSON string using full name, e.g.")
@@ -555,32 +2447,28 @@ class sfccli(object):
             print("Enter '{} -h' for help".format(self.name))
         exit(1)
 
-    def lst(self):
-        vals = []
+    def lst(self, opt = None):
+        opts = {}
         db = self.getdB()
-        #only show clients in this list
-        if 'clients' in db():
-            if not db()['clients']:
-                db()['clients'] = {}
-            for key, client in db()['clients'].items():
-                val = {}
-                val['name'] = client['name']
-                if client['users'] == "":
-                    val['users'] = []
-                else:
-                    val['users'] = client['users'].split(",")
-                vals.append(val)
-        print(json.dumps(vals))
+        if opt:
+            try:
+                opts = json.loads(opt)
+            except:
+                self.parseError("Invalid JSON format")
+        print(json.dumps(self.getClients(db, opts.get('user'))))
 
     def setup(self, opt):
         opts = {}
         db = self.getdB()
+        newCert = False
         if not self.certExists():
             self.setup_cert(db)
+            newCert = True
         try:
             opts = json.loads(opt)
         except:
             self.parseError("Invalid JSON format")
+        bundleSettings = [db().get(key) for key in BUNDLEKEYS]
         try:
             for key, value in opts.items():
                 if key in db():
@@ -593,26 +2481,67 @@ class sfccli(object):
             db.update()
         except:
             self.parseError("Invalid settings format")
+        if bundleSettings != [db().get(key) for key in BUNDLEKEYS]:
+            bundlecache().evict()
+        self.getKeyPool(db).refill(self.daemon)
+
+        notify = self.getNotify()
+        notify({'step': "configure", 'state': "running", 'time': 0})
+        changes = self.setupOpenVpn(db())
+        if newCert:
+            changes['server'] = dict.fromkeys(changes['server'], "restart")
+        notify({'step': "configure", 'state': "done", 'time': 0})
+        notify({'step': "services", 'state': "running", 'time': 0})
+        result = self.applySetup(changes)
+        notify({'step': "services", 'state': "done" if result['result'] else "failed", 'time': 0})
+        print(json.dumps(result))
 
-        if self.setupOpenVpn(db()):
-            self.ctl("enable")
-            self.ctl("restart")
+    def applySetup(self, changes):
+        # least disruptive action for what changed on disk
+        result = {}
+        result['result'] = True
+        result['changed'] = changes['files']
+        result['actions'] = []
+        sctl = systemdctl()
+        if not sctl.available():
+            result['result'] = False
+            return result
+        servers = changes['server']
+        if changes['remove']:
+            # instances no longer configured
+            result['result'] &= sctl.stop(changes['remove'])
+            result['result'] &= sctl.disable(changes['remove'])
+            result['actions'].append("remove " + " ".join(changes['remove']))
+        states = sctl.show(list(servers) + [DAEMONOVPNIPT])
+        if not all(state['enabled'] in SYSTEMDENABLED for state in states.values()):
+            result['result'] &= sctl.enable([DAEMONOVPN] + list(servers) + [DAEMONOVPNIPT])
+            result['actions'].append("enable")
+        firewall = changes['iptables']
+        if states[DAEMONOVPNIPT]['active'] != "active":
+            firewall = "start"
+        if firewall == "restart":
+            # stop with the loaded unit, it removes the rules of the previous backend
+            result['result'] &= sctl.stop(DAEMONOVPNIPT)
+            sctl.daemonReload()
+            result['result'] &= sctl.start(DAEMONOVPNIPT)
+            result['actions'].append("restart " + DAEMONOVPNIPT)
+        elif firewall == "start":
+            sctl.daemonReload()
+            result['result'] &= sctl.start(DAEMONOVPNIPT)
+            result['actions'].append("start " + DAEMONOVPNIPT)
+        elif firewall == "reload":
+            # nftables replaces the rules in one transaction
+            result['result'] &= sctl.reload(DAEMONOVPNIPT)
+            result['actions'].append("reload " + DAEMONOVPNIPT)
+        restart = [unit for unit, action in servers.items() if action == "restart" or states[unit]['active'] != "active"]
+        if restart:
+            result['result'] &= sctl.restart(restart)
+            result['actions'].append("restart " + " ".join(restart))
+        return result
 
     def get(self):
         db = self.getdB()
-        #don't show clients in this list
-        if 'clients' in db():
-            del db()['clients']
-        opts = {}
-        for key, value in db().items():
-            if key in LISTKEYS:
-                if value == "":
-                    opts[key] = []
-                else:
-                    opts[key] = value.split(',')
-            else:
-                opts[key] = value
-        print(json.dumps(opts))
+        print(json.dumps(self.getSettings(db)))
 
     def cadd(self, opt):
         opts = {}
@@ -623,41 +2552,85 @@ class sfccli(object):
             opts = json.loads(opt)
         except:
             self.parseError("Invalid JSON format")
-        nameExists = self.checkCertName(db(), opts)
+        if isinstance(opts, list):
+            print(json.dumps(self.caddBatch(db, opts)))
+            return
+        store = self.getClientStore(db)
+        nameExists = self.checkCertName(db, opts)
         if nameExists:
             #update users list only
-            for key, client in db()['clients'].items():
-                if 'name' in client and client['name'] == opts['name']:
-                    if 'users' in opts:
-                        if isinstance(opts['users'], list):
-                            client['users'] = ",".join(opts['users'])
-                        else:
-                            client['users'] = opts['users']
-                    else:
-                        client['users'] = ""
-                    break
+            store.setUsers(opts['name'], opts.get('users', ""))
             db.update()
         else:
-            #generate user
-            if not db()['clients']:
-                db()['clients'] = {}
-            key = self.getRandomString(16)
-            client={}
-            client['name'] = opts['name']
-            if 'users' in opts:
-                client['users'] = opts['users']
-            else:
-                client['users'] = ""
-            db()['clients'][key] = client
+            if not CERTNAME.match(str(opts['name'])):
+                self.parseError("Invalid certificate name", opt_msg = False, msg = False)
             # build-key for the client.
-            cmd = "{} --pki-dir={} build-client-full {} nopass".format(EASY_RSA_CMD, EASY_RSA_KEY_DIR, client['name'])
+            pki = self.getPki(db)
+            pool = self.getKeyPool(db)
             try:
-                shell().command(cmd)
+                error = pki.genReqs([opts['name']], pool)[0]
+                if error:
+                    raise error
+                pki.signReq(opts['name'])
             except:
+                pki.removeReq(opts['name'])
                 self.parseError("Error executing build client command", opt_msg = False, msg = False)
+            #generate user
+            store.add(opts['name'], opts.get('users', ""))
             db.update()
+            self.allocateAddresses(db(), [opts['name']])
+            if pool.size > 0:
+                pool.refill(self.daemon)
         return
 
+    def caddBatch(self, db, entries):
+        results = []
+        newNames = []
+        newEntries = []
+        store = self.getClientStore(db)
+        for entry in entries:
+            result = {}
+            result['name'] = ""
+            result['result'] = False
+            if not isinstance(entry, dict) or not 'name' in entry:
+                result['error'] = "No certificate name given"
+            else:
+                result['name'] = str(entry['name'])
+                if store.exists(result['name']):
+                    #update users list only
+                    store.setUsers(result['name'], entry.get('users', ""))
+                    result['result'] = True
+                elif result['name'] in newNames:
+                    result['error'] = "Duplicate certificate name"
+                elif not CERTNAME.match(result['name']):
+                    result['error'] = "Invalid certificate name"
+                else:
+                    newNames.append(result['name'])
+                    newEntries.append((result, entry))
+            results.append(result)
+
+        # generating keys is independent per client, signing is not
+        pki = self.getPki(db)
+        pool = self.getKeyPool(db)
+        keyErrors = pki.genReqs(newNames, pool)
+        for (result, entry), error in zip(newEntries, keyErrors):
+            if not error:
+                try:
+                    pki.signReq(result['name'])
+                except Exception as e:
+                    error = e
+            if error:
+                pki.removeReq(result['name'])
+                result['error'] = "Error executing build client command: {}".format(error)
+            else:
+                store.add(result['name'], entry.get('users', ""))
+                result['result'] = True
+        db.update()
+        self.allocateAddresses(db(), [result['name'] for result, entry in newEntries if result['result']])
+        if newNames and pool.size > 0:
+            pool.refill(self.daemon)
+        return results
+
     def cdel(self, opt):
         opts = {}
         db = self.getdB()
@@ -667,38 +2640,74 @@ class sfccli(object):
             opts = json.loads(opt)
         except:
             self.parseError("Invalid JSON format")
-        if not self.checkCertName(db(), opts):
+        if isinstance(opts, list):
+            print(json.dumps(self.cdelBatch(db, opts)))
+            return
+        if not self.checkCertName(db, opts):
             self.parseError("Invalid name, certificate doesn't exist", opt_msg = False, msg = False)
 
-        for key, client in db()['clients'].items():
-            if 'name' in client and client['name'] == opts['name']:
-                db()['clients'].pop(key)
-                break
-        # revoke-full returns error code 23 when the certificate is revoked.
-        cmd = "{} --batch --pki-dir={} revoke {}".format(EASY_RSA_CMD, EASY_RSA_KEY_DIR, opts['name'])
-        try:
-            shell().command(cmd)
-        except:
-            pass # Nothing to be done when certificate is revoked
-
-        # Update the control revokation list
-        cmd = "{} --batch --pki-dir={} gen-crl".format(EASY_RSA_CMD, EASY_RSA_KEY_DIR)
-        try:
-            shell().command(cmd)
-        except:
-            pass # Nothing to be done when certificate is revoked
-
-        ## Delete the files associated with client
-        files = [EASY_RSA_KEY_DIR + "/pki/private/" + opts['name'] + ".key",
-                 EASY_RSA_KEY_DIR + "/pki/issued/" + opts['name'] + ".crt",
-                 EASY_RSA_KEY_DIR + "/pki/reqs/" + opts['name'] + ".req"]
-        for file in files:
-            if os.path.isfile(file):
-                os.remove(file)
-
-        db.update()
+        self.cdelBatch(db, [opts['name']])
         return
 
+    def cdelBatch(self, db, entries):
+        results = []
+        names = []
+        store = self.getClientStore(db)
+        pki = self.getPki(db)
+        serials = pki.getSerials()
+        revoked = []
+        for entry in entries:
+            result = {}
+            if isinstance(entry, dict):
+                result['name'] = str(entry.get('name', ""))
+            else:
+                result['name'] = str(entry)
+            result['result'] = False
+            if not store.exists(result['name']):
+                result['error'] = "Invalid name, certificate doesn't exist"
+            elif result['name'] in names:
+                result['error'] = "Duplicate certificate name"
+            else:
+                # revoke returns an error when the certificate is already revoked.
+                try:
+                    pki.revoke(result['name'])
+                    result['revoked'] = True
+                    if result['name'] in serials:
+                        revoked.append(serials[result['name']])
+                except:
+                    result['revoked'] = False # Nothing to be done when certificate is revoked
+                names.append(result['name'])
+                result['result'] = True
+            results.append(result)
+
+        if names:
+            # Update the revocation directory and the control revokation list once for all
+            # revoked certificates
+            try:
+                crldir().add(revoked)
+            except OSError:
+                pass # synced again on setup
+            try:
+                pki.genCrl(revoked)
+            except:
+                pass # Nothing to be done when certificate is revoked
+
+            # Disconnect sessions of revoked clients, the new CRL refuses reconnects
+            killed = self.killClients(names)
+            for result in results:
+                if result['name'] in killed and result['result']:
+                    result['disconnected'] = killed[result['name']]
+
+            ## Delete the clients and the files associated with them
+            cache = bundlecache()
+            for name in names:
+                store.remove(name)
+                pki.removeCert(name)
+                cache.evict(name)
+            db.update()
+            self.freeAddresses(db(), names)
+        return results
+
     def cdownload(self, opt):
         opts = {}
         db = self.getdB()
@@ -708,90 +2717,190 @@ class sfccli(object):
             opts = json.loads(opt)
         except:
             self.parseError("Invalid JSON format")
-        if not self.checkCertName(db(), opts):
-            self.parseError("Invalid name, certificate doesn't exist", opt_msg = False, msg = False)
+        if 'names' in opts:
+            names = opts['names']
+            if not isinstance(names, list) or not names:
+                self.parseError("Invalid names, list of names expected")
+            for name in names:
+                if not self.checkCertName(db, {'name': name}):
+                    self.parseError("Invalid name, certificate {} doesn't exist".format(name), opt_msg = False, msg = False)
+            zipName = "{}-clients.zip".format(OVPNNAME)
+        else:
+            if not self.checkCertName(db, opts):
+                self.parseError("Invalid name, certificate doesn't exist", opt_msg = False, msg = False)
+            names = [opts['name']]
+            zipName = "{}-client.zip".format(opts['name'])
+        stream = opts.get('stream', "")
+        if stream and not stream in ["base64", "raw"]:
+            self.parseError("Invalid stream option: {}".format(stream))
+        if stream == "raw" and self.daemon:
+            self.parseError("Raw stream not available on socket, use base64", opt_msg = False, msg = False)
+
+        try:
+            if len(names) == 1:
+                data = self.getBundle(db, names[0])
+            else:
+                data = self.getBundles(db, names)
+        except Exception as e:
+            self.parseError("Error generating client bundle: {}".format(e), opt_msg = False, msg = False)
 
-        name = opts['name']
-        ZipFileLocation = TMP_DIR + "/{}-client.zip".format(name)
+        vals = {}
+        if stream == "raw":
+            sys.stdout.flush()
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+            return
+        elif stream == "base64":
+            vals['name'] = zipName
+            vals['data'] = base64.b64encode(data).decode("ascii")
+        else:
+            ZipFileLocation = TMP_DIR + "/" + zipName
+            with open(ZipFileLocation, 'wb') as zip_file:
+                zip_file.write(data)
+            vals['zip'] = ZipFileLocation
+        print(json.dumps(vals))
 
+    def getBundle(self, db, name):
         ca = EASY_RSA_KEY_DIR + "/ca.crt";
         cert = EASY_RSA_KEY_DIR + "/issued/{}.crt".format(name);
         key = EASY_RSA_KEY_DIR + "/private/{}.key".format(name);
 
-        zipObj = ZipFile(ZipFileLocation, 'w')
+        cache = bundlecache()
+        cacheKey = cache.getKey(db(), [ca, cert, key])
+        data = cache.get(name, cacheKey)
+        if data:
+            return data
+
         with open(ca, 'r') as ca_file:
-            zipObj.writestr('{}-ca.crt'.format(name), ca_file.read())
+            caData = ca_file.read()
         with open(cert, 'r') as cert_file:
-            zipObj.writestr('{}-client.crt'.format(name), cert_file.read())
+            certData = cert_file.read()
         with open(key, 'r') as key_file:
-            zipObj.writestr('{}-client.key'.format(name), key_file.read())
-        zipObj.writestr('{}-client.conf'.format(name), "\n".join(self.generateClientConf(name, db())))
-        zipObj.writestr('{}-client.ovpn'.format(name), "\n".join(self.generateClientConf(name, db(), ca, cert, key)))
-        zipObj.close()
-
-        vals = {}
-        vals['zip'] = ZipFileLocation
-        print(json.dumps(vals))
-
-    def setup_cert(self, db = None):
+            keyData = key_file.read()
+
+        buffer = io.BytesIO()
+        with ZipFile(buffer, 'w') as zipObj:
+            zipObj.writestr('{}-ca.crt'.format(name), caData)
+            zipObj.writestr('{}-client.crt'.format(name), certData)
+            zipObj.writestr('{}-client.key'.format(name), keyData)
+            zipObj.writestr('{}-client.conf'.format(name), "\n".join(self.generateClientConf(name, db())))
+            zipObj.writestr('{}-client.ovpn'.format(name), "\n".join(self.generateClientConf(name, db(), caData, certData, keyData)))
+        data = buffer.getvalue()
+        cache.set(name, cacheKey, data)
+        return data
+
+    def getBundles(self, db, names):
+        # one archive, every client bundle in its own folder
+        buffer = io.BytesIO()
+        with ZipFile(buffer, 'w') as zipObj:
+            for name in names:
+                with ZipFile(io.BytesIO(self.getBundle(db, name)), 'r') as bundle:
+                    for item in bundle.namelist():
+                        zipObj.writestr("{}/{}".format(name, item), bundle.read(item))
+        return buffer.getvalue()
+
+    def setup_cert(self, db = None, progress = False):
         if not db:
             db = self.getdB()
-            db()["clients"] = {}
+            self.getClientStore(db).clear()
             db.update()
         else:
-            db()["clients"] = {}
+            self.getClientStore(db).clear()
+        bundlecache().evict()
+        pool = dhpool()
+        dhFile = None
+        if db().get('dh_params') == "Generated":
+            dhFile = pool.take()
 
         if not os.path.isdir(EASY_RSA_KEY_DIR):
             os.mkdir(EASY_RSA_KEY_DIR, mode=0o755)
 
-        # Clean the pki directory
-        cmd = "{} --batch --pki-dir={} init-pki".format(EASY_RSA_CMD, EASY_RSA_KEY_DIR)
-        try:
-            shell().command(cmd)
-        except:
-            self.parseError("Error executing init-pki command", opt_msg = False, msg = False)
-
-        # Build the CA root certificates
-        cmd = "{} --batch --pki-dir={} build-ca nopass".format(EASY_RSA_CMD, EASY_RSA_KEY_DIR)
+        # init-pki cleans the pki directory, then build the CA root certificates,
+        # the server certificate/key and initialize the CRL. Diffie Hellman
+        # parameters are generated in parallel when not taken from the pool or predefined.
+        notify = self.getNotify(progress)
+        def report(step, state, returncode, duration):
+            notify({'step': step, 'state': state, 'time': duration})
+        genDh = dhFile == None and db().get('dh_params') == "Generated"
         try:
-            shell().command(cmd)
-        except:
-            self.parseError("Error executing building ca command", opt_msg = False, msg = False)
-
-        # Create the server certificate/key
-        cmd = "{} --batch --pki-dir={} build-server-full {} nopass".format(EASY_RSA_CMD, EASY_RSA_KEY_DIR, self.getHostname())
-        try:
-            shell().command(cmd)
-        except:
-            self.parseError("Error executing building server command", opt_msg = False, msg = False)
+            results = self.getPki(db).setup(self.getHostname(), dh = genDh, callback = report)
+
+            errors = {'init-pki': "Error executing init-pki command",
+                      'build-ca': "Error executing building ca command",
+                      'build-server-full': "Error executing building server command",
+                      'gen-dh': "Error executing generating dh parameter command"}
+            # gen-crl errors are ignored, nothing to be done
+            for step, error in errors.items():
+                if step in results and results[step][0] != 0:
+                    self.parseError(error, opt_msg = False, msg = False)
+
+            crldir().sync([])
+            if dhFile:
+                shutil.move(dhFile, EASY_RSA_KEY_DIR + "/dh.pem")
+                report("dh-pool", "done", 0, 0)
+        finally:
+            # pooled parameters go back when the pki failed
+            pool.release(dhFile)
+        pool.refill(self.daemon)
 
-        # Initialize the CRL by revoking a non-existant cert. Returns the error code
-        # 23 when the certificate is revoked.
-        cmd = "{} --pki-dir={} gen-crl".format(EASY_RSA_CMD, EASY_RSA_KEY_DIR)
-        try:
-            shell().command(cmd)
-        except:
-            pass # Nothing to be done when certificate is revoked
+        return
 
-        # Generate Diffie Hellman parameter for the server side.
-        cmd = "{} --pki-dir={} gen-dh".format(EASY_RSA_CMD, EASY_RSA_KEY_DIR)
-        try:
-            shell().command(cmd)
-        except:
-            self.parseError("Error executing generating dh parameter command", opt_msg = False, msg = False)
+    def dhpool(self, opt = None):
+        pool = dhpool()
+        if opt == "fill":
+            pool.fill()
+        print(json.dumps(pool.getStats()))
 
-        return
+    def keypool(self, opt = None):
+        pool = self.getKeyPool(self.getdB())
+        if opt == "fill":
+            pool.fill()
+        print(json.dumps(pool.getStats()))
 
     def getopt(self):
+        print(json.dumps(self.getOptions()))
+
+    def snapshot(self):
+        db = self.getdB()
         vals = {}
-        vals['protocol'] = OVPN_PROTOCOL
-        vals['device'] = OVPN_DEVICE
-        vals['loglevel'] = list(OVPN_LOGLEVEL.values())
-        vals['DNS_server'] = list(OVPN_DNS.keys())
-        vals['gateway'] = self.getGateways()
-        vals['users'] = self.getLinuxUsers()
+        vals['settings'] = self.getSettings(db)
+        vals['options'] = self.getOptions()
+        vals['clients'] = self.getClients(db)
         print(json.dumps(vals))
 
+    def status(self, opt = None):
+        opts = {}
+        if opt:
+            try:
+                opts = json.loads(opt)
+            except:
+                self.parseError("Invalid JSON format")
+        instances = self.getInstances(self.getdB()())
+        statuses = [None] * len(instances)
+        def getStatus(i, instance):
+            statuses[i] = self.getStatus(instance, opts)
+        # events are collected for the same period on all instances
+        threads = [threading.Thread(target = getStatus, args = (i, instance)) for i, instance in enumerate(instances)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        status = ovpnstatus().newStatus()
+        sources = []
+        for instance, instanceStatus in zip(instances, statuses):
+            for client in instanceStatus['clients']:
+                client['instance'] = instance['name']
+            status['clients'].extend(instanceStatus['clients'])
+            status['routes'].extend(instanceStatus['routes'])
+            status['updated'] = max(status['updated'], instanceStatus['updated'])
+            if 'events' in instanceStatus:
+                status.setdefault('events', []).extend(instanceStatus['events'])
+            sources.append(instanceStatus['source'])
+        status['source'] = sources[0] if len(set(sources)) == 1 else "mixed"
+        if len(instances) > 1:
+            status['instances'] = [{'name': instance['name'], 'source': source} for instance, source in zip(instances, sources)]
+        print(json.dumps(status))
+
     def ctl(self, opt):
         result = {}
         sctl = systemdctl()
@@ -800,62 +2909,152 @@ class sfccli(object):
             print("{} cannot automatically restart the {} service".format(self.name, DAEMONOVPN))
             print("You can try it yourself using a command like 'service {} restart'".format(DAEMONOVPN))
             self.parseError()
+        instances = self.getInstances(self.getdB()())
+        services = [DAEMONOVPN] + [instance['unit'] for instance in instances] + [DAEMONOVPNIPT]
         if opt == "start":
-            result['result'] = sctl.start(DAEMONOVPN)
-            if result['result']:
-                result['result'] = sctl.start(DAEMONOVPNSRV)
-            if result['result']:
-                result['result'] = sctl.start(DAEMONOVPNIPT)
+            result['result'] = sctl.start(services)
         elif opt == "stop":
-            result['result'] = sctl.stop(DAEMONOVPN)
-            if result['result']:
-                result['result'] = sctl.stop(DAEMONOVPNSRV)
-            if result['result']:
-                result['result'] = sctl.stop(DAEMONOVPNIPT)
+            result['result'] = sctl.stop(services)
         elif opt == "restart":
-            result['result'] = sctl.restart(DAEMONOVPN)
-            if result['result']:
-                result['result'] = sctl.restart(DAEMONOVPNSRV)
-            if result['result']:
-                result['result'] = sctl.restart(DAEMONOVPNIPT)
+            result['result'] = sctl.restart(services)
         elif opt == "reload":
             result['result'] = sctl.reload(DAEMONOVPN)
             if result['result']:
-                result['result'] = sctl.reload(DAEMONOVPNSRV)
+                result['result'] = self.reloadServer(sctl, instances)
             if result['result']:
                 result['result'] = sctl.reload(DAEMONOVPNIPT)
         elif opt == "enable":
-            result['result'] = sctl.enable(DAEMONOVPN)
-            if result['result']:
-                result['result'] = sctl.enable(DAEMONOVPNSRV)
-            if result['result']:
-                result['result'] = sctl.enable(DAEMONOVPNIPT)
+            result['result'] = sctl.enable(services)
         elif opt == "disable":
-            result['result'] = sctl.disable(DAEMONOVPN)
-            if result['result']:
-                result['result'] = sctl.disable(DAEMONOVPNSRV)
-            if result['result']:
-                result['result'] = sctl.disable(DAEMONOVPNIPT)
+            result['result'] = sctl.disable(services)
         elif opt == "isactive":
-            result['result'] = sctl.isActive(DAEMONOVPN)
-            if result['result']:
-                result['result'] &= sctl.isActive(DAEMONOVPNSRV)
-            if result['result']:
-                result['result'] &= sctl.isActive(DAEMONOVPNIPT)
+            result['units'] = sctl.show(services)
+            result['result'] = all(state['active'] == "active" for state in result['units'].values())
         elif opt == "isenabled":
-            result['result'] = sctl.isEnabled(DAEMONOVPN)
-            if result['result']:
-                result['result'] &= sctl.isEnabled(DAEMONOVPNSRV)
-            if result['result']:
-                result['result'] &= sctl.isActive(DAEMONOVPNIPT)
+            result['units'] = sctl.show(services)
+            result['result'] = all(state['enabled'] in SYSTEMDENABLED for state in result['units'].values())
+        elif opt == "show":
+            result['units'] = sctl.show(services)
+            result['result'] = True
         else:
             self.parseError("Invalid ctl option: {}".format(opt))
         print(json.dumps(result))
 
+    def serve(self):
+        self.daemon = True
+        if os.path.exists(SERVICE_SOCKET):
+            os.remove(SERVICE_SOCKET)
+        try:
+            server = cliserver(SERVICE_SOCKET, clihandler)
+        except Exception as e:
+            self.parseError("Error opening socket: {}".format(e), opt_msg = False, msg = False)
+        server.cli = self
+        # requests are threaded, commands that change data run one at a time,
+        # reads run together but never next to a change
+        self.lock = rwlock()
+        sys.stdout = threadstdout(sys.stdout)
+        os.chmod(SERVICE_SOCKET, 0o600)
+        dhpool().refill(self.daemon)
+        self.getKeyPool(self.getdB()).refill(self.daemon)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if os.path.exists(SERVICE_SOCKET):
+                os.remove(SERVICE_SOCKET)
+
+    def request(self, line, notify = None):
+        # JSON-RPC 2.0 request, params are the command line arguments after the method
+        response = {"jsonrpc": "2.0", "id": None}
+        try:
+            req = json.loads(line)
+            response["id"] = req.get("id")
+            method = str(req.get("method", ""))
+            params = req.get("params", [])
+            if not isinstance(params, list):
+                params = [params]
+        except:
+            response["error"] = {"code": -32700, "message": "Parse error"}
+            return response
+        if method in NOSOCKETCMDS or method.startswith("-"):
+            response["error"] = {"code": -32601, "message": "Method not found: {}".format(method)}
+            return response
+        if " ".join([method] + [str(param) for param in params[:1]]) in NOSOCKETCMDS:
+            response["error"] = {"code": -32601, "message": "Not available on the socket: {} {}".format(method, params[0])}
+            return response
+        args = []
+        if method:
+            args.append(method)
+        for param in params:
+            if isinstance(param, str):
+                args.append(param)
+            else:
+                args.append(json.dumps(param))
+        code = 0
+        out = io.StringIO()
+        shell.resetTimings()
+        if not self.lock:
+            lock = nullcontext()
+        elif method in SOCKETREADCMDS:
+            lock = self.lock.read()
+        else:
+            lock = self.lock.write()
+        self.local.notify = notify
+        with self.redirectOutput(out), lock:
+            try:
+                self.execute(args)
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    code = e.code
+                elif e.code:
+                    print(e.code)
+                    code = 1
+            except Exception as e:
+                print(e)
+                code = 1
+        self.local.notify = None
+        if code and not method in SOCKETREADCMDS:
+            # command may have left the cached database half updated
+            with self.dbLock:
+                self.db = None
+        if code:
+            response["error"] = {"code": code, "message": out.getvalue()}
+        else:
+            response["result"] = out.getvalue()
+        if req.get("timing"):
+            response["timing"] = list(shell.getTimings())
+        return response
+
 ################## INTERNAL FUNCTIONS ###################
 
+    def getNotify(self, progress = False):
+        # progress of a long command: a notification on the socket of the request,
+        # a JSON line with --progress (or progress), otherwise nothing
+        # taken once per command, the callback may be called from other threads
+        notify = getattr(self.local, "notify", None)
+        if notify:
+            return notify
+        if self.progress or progress:
+            return lambda event: print(json.dumps(event), flush = True)
+        return lambda event: None
+
+    def redirectOutput(self, out):
+        if isinstance(sys.stdout, threadstdout):
+            return sys.stdout.redirect(out)
+        return redirect_stdout(out)
+
     def getdB(self):
+        # loading may migrate and write the database, concurrent reads load it once
+        with self.dbLock:
+            return self.loaddB()
+
+    def loaddB(self):
+        if self.db and not self.db.changed():
+            return self.db
         db = database()
+        self.db = db
         if not db():
             newDb = {}
             newDb["enable_ipv6"] = True
@@ -878,6 +3077,20 @@ class sfccli(object):
             newDb["dns_domains"] = ""
             newDb["wins"] = ""
             newDb["public_address"] = ""
+            newDb["public_addresses"] = ""
+            newDb["remote_random"] = True
+            newDb["server_poll_timeout"] = 10
+            newDb["egress_addresses"] = ""
+            newDb["snat_ports"] = ""
+            newDb["static_addresses"] = False
+            newDb["vpn_network6"] = ""
+            newDb["dh_params"] = "Generated"
+            newDb["key_pool_size"] = 0
+            newDb["pki_backend"] = OVPN_PKI["easyrsa"]
+            newDb["crl_mode"] = "CRL file"
+            newDb["firewall"] = OVPN_FIREWALL[0]
+            newDb["instances"] = 1
+            newDb["instance_mode"] = OVPN_INSTANCES[0]
             newDb["clients"] = ""
             db().update(newDb)
             db.update()
@@ -885,8 +3098,236 @@ class sfccli(object):
             if not "enable_ipv6" in db():
                 db()["enable_ipv6"] = True
                 db.update()
+            if not "dh_params" in db():
+                db()["dh_params"] = "Generated"
+                db.update()
+            if not "key_pool_size" in db():
+                db()["key_pool_size"] = 0
+                db.update()
+            if not "pki_backend" in db():
+                db()["pki_backend"] = OVPN_PKI["easyrsa"]
+                db.update()
+            if not "crl_mode" in db():
+                db()["crl_mode"] = "CRL file"
+                db.update()
+            if not "firewall" in db():
+                # existing installs keep their rules in the host's iptables chains
+                db()["firewall"] = "iptables"
+                db.update()
+            if not "instances" in db():
+                db()["instances"] = 1
+                db()["instance_mode"] = OVPN_INSTANCES[0]
+                db.update()
+            if not "public_addresses" in db():
+                db()["public_addresses"] = ""
+                db()["remote_random"] = True
+                db()["server_poll_timeout"] = 10
+                db.update()
+            if not "egress_addresses" in db():
+                db()["egress_addresses"] = ""
+                db()["snat_ports"] = ""
+                db.update()
+            if not "static_addresses" in db():
+                db()["static_addresses"] = False
+                db()["vpn_network6"] = ""
+                db.update()
         return db
 
+    def getClients(self, db, user = None):
+        #only show clients in this list
+        return self.getClientStore(db).list(user)
+
+    def getPki(self, db):
+        # python backend when selected and available, easyrsa otherwise
+        if db().get('pki_backend') == OVPN_PKI["python"] and pythonpki.available():
+            return pythonpki()
+        return easyrsa()
+
+    def getKeyPool(self, db):
+        try:
+            size = max(int(db().get('key_pool_size', 0)), 0)
+        except ValueError:
+            size = 0
+        return keypool(size = size)
+
+    def getClientStore(self, db):
+        if db.clients == None:
+            db.clients = clientstore(db)
+        return db.clients
+
+    def getSettings(self, db):
+        opts = {}
+        for key, value in db().items():
+            #don't show clients in this list
+            if key == 'clients':
+                continue
+            if key in LISTKEYS:
+                if value == "":
+                    opts[key] = []
+                else:
+                    opts[key] = value.split(',')
+            else:
+                opts[key] = value
+        return opts
+
+    def getOptions(self):
+        vals = {}
+        vals['protocol'] = OVPN_PROTOCOL
+        vals['device'] = OVPN_DEVICE
+        vals['loglevel'] = list(OVPN_LOGLEVEL.values())
+        vals['DNS_server'] = list(OVPN_DNS.keys())
+        vals['dh_params'] = list(OVPN_DH.keys())
+        vals['crl_mode'] = list(OVPN_CRL.keys())
+        vals['firewall'] = OVPN_FIREWALL
+        vals['instance_mode'] = OVPN_INSTANCES
+        vals['cpus'] = os.cpu_count() or 1
+        vals['pki_backend'] = [OVPN_PKI["easyrsa"]]
+        if pythonpki.available():
+            vals['pki_backend'].append(OVPN_PKI["python"])
+        vals['gateway'] = self.getGateways()
+        vals['users'] = self.getLinuxUsers()
+        return vals
+
+    def killClients(self, names):
+        # a client may be connected to any instance
+        killed = {}
+        for instance in self.getInstances(self.getdB()()):
+            mgmt = management(instance['management'])
+            if mgmt.available():
+                try:
+                    with mgmt:
+                        for name in names:
+                            try:
+                                mgmt.kill(name)
+                                killed[name] = True
+                            except:
+                                killed[name] = killed.get(name, False) # not connected
+                except:
+                    pass
+        return killed
+
+    def reloadServer(self, sctl, instances):
+        # SIGHUP through the management interface, saves a systemctl call
+        # for openvpn SIGHUP is a restart in the same process, all clients are disconnected
+        fallback = []
+        for instance in instances:
+            mgmt = management(instance['management'])
+            try:
+                if not mgmt.available():
+                    raise Exception("No management interface")
+                with mgmt:
+                    mgmt.signal("SIGHUP")
+            except:
+                fallback.append(instance['unit'])
+        if fallback:
+            return sctl.reload(fallback)
+        return True
+
+    def getStatus(self, instance, opts):
+        status = None
+        mgmt = management(instance['management'])
+        if mgmt.available():
+            # live data from the management interface, status file is only updated every minute
+            try:
+                with mgmt:
+                    status = mgmt.status()
+                    if opts.get('events'):
+                        mgmt.bytecount(max(int(opts.get('interval', 1)), 1))
+                        status['events'] = mgmt.listen(float(opts['events']))
+                        mgmt.bytecount(0)
+            except:
+                status = None
+        if status == None:
+            if not instance['status'] in self.ovpnStatus:
+                self.ovpnStatus[instance['status']] = ovpnstatus(instance['status'], instance['cache'])
+            status = dict(self.ovpnStatus[instance['status']].get())
+            status['source'] = "file"
+        return status
+
+    def getInstances(self, db):
+        # instance 0 is openvpn@server with the original file names, instance i
+        # is openvpn@server<i>. The vpn network is split in equal slices.
+        count = self.getInstanceCount(db)
+        network = self.getVpnNetwork(db)
+        network6 = self.getVpnNetwork6(db) if db.get('enable_ipv6') else None
+        bits = (count - 1).bit_length()
+        if network.prefixlen + bits > OVPN_MIN_PREFIX:
+            self.parseError("VPN network too small for {} instances".format(count), opt_msg = False, msg = False)
+        slices = list(network.subnets(prefixlen_diff = bits))
+        slices6 = list(network6.subnets(prefixlen_diff = bits)) if network6 else [None] * count
+        protocols = [db['protocol']] + [protocol for protocol in OVPN_PROTOCOL if protocol != db['protocol']]
+        instances = []
+        for i in range(count):
+            instance = {}
+            suffix = str(i) if i else ""
+            instance['index'] = i
+            instance['name'] = "server" + suffix
+            instance['unit'] = DAEMONOVPNSRV + suffix
+            instance['conf'] = "{}/{}.conf".format(os.path.dirname(SERVICE_OPENVPN_CONF), instance['name'])
+            if db.get('instance_mode') == OVPN_INSTANCES[1]:
+                instance['protocol'] = protocols[i % 2]
+                instance['port'] = int(db['port']) + i // 2
+            else:
+                instance['protocol'] = db['protocol']
+                instance['port'] = int(db['port']) + i
+            instance['network'] = str(slices[i].network_address)
+            instance['mask'] = str(slices[i].netmask)
+            instance['network6'] = str(slices6[i]) if slices6[i] else ""
+            instance['management'] = SERVICE_MANAGEMENT.replace(".sock", suffix + ".sock")
+            instance['status'] = SERVICE_STATUS_LOG.replace(".log", suffix + ".log")
+            instance['cache'] = CACHE_STATUS.replace(".json", suffix + ".json")
+            instance['log'] = SERVICE_LOG.replace(".log", suffix + ".log")
+            instance['ipp'] = "ipp{}.txt".format(suffix)
+            instance['ccd'] = SERVICE_CCD_DIR + suffix
+            instances.append(instance)
+        return instances
+
+    def getVpnNetwork(self, db):
+        try:
+            return ipaddress.IPv4Network("{}/{}".format(db['vpn_network'], db['vpn_mask']), strict = False)
+        except ValueError:
+            self.parseError("Invalid VPN network {}/{}".format(db['vpn_network'], db['vpn_mask']), opt_msg = False, msg = False)
+
+    def getVpnNetwork6(self, db):
+        # derived from the port when not set, ports from 10000 don't fit a group
+        # written in decimal, so they are written in hex
+        port = int(db['port'])
+        group = str(port) if port < 10000 else "{:x}".format(port)
+        network6 = db.get('vpn_network6') or "fddd:{}:{}:{}::/64".format(group, group, group)
+        try:
+            return ipaddress.IPv6Network(network6, strict = False)
+        except ValueError:
+            self.parseError("Invalid VPN IPv6 network {}".format(network6), opt_msg = False, msg = False)
+
+    def getAddressPools(self, db):
+        # static addresses per instance, not possible with duplicate CNs
+        if not db.get('static_addresses') or db['duplicate_cn']:
+            return []
+        return [addresspool(ipaddress.IPv4Network("{}/{}".format(instance['network'], instance['mask'])), instance['ccd'])
+                for instance in self.getInstances(db)]
+
+    def allocateAddresses(self, db, names):
+        for pool in self.getAddressPools(db):
+            with pool:
+                for name in names:
+                    pool.allocate(name)
+
+    def freeAddresses(self, db, names):
+        for pool in self.getAddressPools(db):
+            with pool:
+                for name in names:
+                    pool.free(name)
+
+    def getInstanceCount(self, db):
+        # 0 is an instance per cpu core
+        try:
+            count = int(db.get('instances', 1))
+        except ValueError:
+            count = 1
+        if count < 1:
+            count = os.cpu_count() or 1
+        return count
+
     def getLog(self, lvalue):
         level = 0
         for key, value in OVPN_LOGLEVEL.items():
@@ -943,6 +3384,18 @@ class sfccli(object):
             pass
         return ip6
 
+    def getIps(self, gateway, family = 4):
+        # all addresses, except IPv6 link local addresses
+        ips = []
+        try:
+            for addr in netifaces.ifaddresses(gateway)[netifaces.AF_INET if family == 4 else netifaces.AF_INET6]:
+                ip = addr['addr'].split('%')[0]
+                if family == 4 or not ipaddress.ip_address(ip).is_link_local:
+                    ips.append(ip)
+        except:
+            pass
+        return ips
+
     def getMask(self, gateway):
         mask = ""
         try:
@@ -978,26 +3431,20 @@ class sfccli(object):
         return retval
 
     def checkCertName(self, db, opts):
-        retval = False
         if not 'name' in opts:
             self.parseError("No certificate name given")
-        try:
-            for key, client in db['clients'].items():
-                if 'name' in client and client['name'] == opts['name']:
-                    retval = True
-                    break
-        except:
-            pass #empty list
-        return retval
+        return self.getClientStore(db).exists(opts['name'])
 
     def getLinuxUsers(self):
-        #only lists normal users
-        cmd = "grep -E '^UID_MIN|^UID_MAX' /etc/login.defs"
+        stamp = self.getFileStamp(["/etc/login.defs", "/etc/passwd"])
+        if 'users' in self.cache and self.cache['users'][0] == stamp:
+            return list(self.cache['users'][1])
+        #only lists normal users, both files are read concurrently
+        cmds = [["grep", "-E", "^UID_MIN|^UID_MAX", "/etc/login.defs"], ["cat", "/etc/passwd"]]
+        loginDefs, passwd = shell().commands(cmds)
         lines = []
-        try:
-            lines = shell().command(cmd).splitlines()
-        except:
-            pass
+        if not isinstance(loginDefs, Exception):
+            lines = loginDefs.splitlines()
         uidsel = {}
         for line in lines:
             try:
@@ -1010,12 +3457,9 @@ class sfccli(object):
         if not 'UID_MAX' in uidsel:
             uidsel['UID_MAX'] = 60000
 
-        cmd = "cat /etc/passwd"
         lines = []
-        try:
-            lines = shell().command(cmd).splitlines()
-        except:
-            pass
+        if not isinstance(passwd, Exception):
+            lines = passwd.splitlines()
         users = []
         for line in lines:
             l = line.split(":")
@@ -1027,63 +3471,99 @@ class sfccli(object):
             except:
                 pass
 
-        return users
+        self.cache['users'] = (stamp, users)
+        return list(users)
 
-    def getRandomString(self, length):
-        # Random string with the combination of lower and upper case
-        letters = string.ascii_letters
-        return ''.join(random.choice(letters) for i in range(length))
+    def getFileStamp(self, files):
+        stamp = []
+        for file in files:
+            try:
+                st = os.stat(file)
+                stamp.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except:
+                stamp.append(None)
+        return stamp
 
     def setupIpTables(self, db, ip, ip6):
-        retval = True
-        iptablesPath = "/usr/sbin/iptables"
-        ip6tablesPath = "/usr/sbin/ip6tables"
-
-        #get path
-        cmd = "command -v iptables"
-        try:
-            iptablesPath = shell().command(cmd).splitlines()[0]
-        except:
-            pass
-        cmd = "command -v ip6tables"
-        try:
-            ip6tablesPath = shell().command(cmd).splitlines()[0]
-        except:
-            pass
+        # returns the action needed for the firewall unit: none, reload or restart
+        fw = self.getFirewall(db)
+        rules = self.getFirewallRules(db, ip, ip6)
 
         ipTablesConf = []
         ipTablesConf.append("[Unit]")
         ipTablesConf.append("Before=network.target")
         ipTablesConf.append("[Service]")
         ipTablesConf.append("Type=oneshot")
-        ipTablesConf.append("ExecStart={} -t nat -A POSTROUTING -s {}/24 ! -d {}/24 -j SNAT --to {}".format(iptablesPath, db['vpn_network'], db['vpn_network'], ip))
-        ipTablesConf.append("ExecStart={} -I INPUT -p {} --dport {} -j ACCEPT".format(iptablesPath, db['protocol'], db['port']))
-        ipTablesConf.append("ExecStart={} -I FORWARD -s {}/24 -j ACCEPT".format(iptablesPath, db['vpn_network']))
-        ipTablesConf.append("ExecStart={} -I FORWARD -m state --state RELATED,ESTABLISHED -j ACCEPT".format(iptablesPath))
-        ipTablesConf.append("ExecStop={} -t nat -D POSTROUTING -s {}/24 ! -d {}/24 -j SNAT --to {}".format(iptablesPath, db['vpn_network'], db['vpn_network'], ip))
-        ipTablesConf.append("ExecStop={} -D INPUT -p {} --dport {} -j ACCEPT".format(iptablesPath, db['protocol'], db['port']))
-        ipTablesConf.append("ExecStop={} -D FORWARD -s {}/24 -j ACCEPT".format(iptablesPath, db['vpn_network']))
-        ipTablesConf.append("ExecStop={} -D FORWARD -m state --state RELATED,ESTABLISHED -j ACCEPT".format(iptablesPath))
-        if ip6:
-            v6vpn = "fddd:{}:{}:{}::/64".format(db['port'],db['port'],db['port'])
-            ipTablesConf.append("ExecStart={} -t nat -A POSTROUTING -s {} ! -d {} -j SNAT --to {}".format(ip6tablesPath, v6vpn, v6vpn, ip6))
-            ipTablesConf.append("ExecStart={} -I FORWARD -s {} -j ACCEPT".format(ip6tablesPath, v6vpn))
-            ipTablesConf.append("ExecStart={} -I FORWARD -m state --state RELATED,ESTABLISHED -j ACCEPT".format(ip6tablesPath))
-            ipTablesConf.append("ExecStop={} -t nat -D POSTROUTING -s {} ! -d {} -j SNAT --to {}".format(ip6tablesPath, v6vpn, v6vpn, ip6))
-            ipTablesConf.append("ExecStop={} -D FORWARD -s {} -j ACCEPT".format(ip6tablesPath, v6vpn))
-            ipTablesConf.append("ExecStop={} -D FORWARD -m state --state RELATED,ESTABLISHED -j ACCEPT".format(ip6tablesPath))
+        ipTablesConf.extend(fw.getUnit(rules))
         ipTablesConf.append("RemainAfterExit=yes")
         ipTablesConf.append("[Install]")
         ipTablesConf.append("WantedBy=multi-user.target")
 
-        with open(SYSTEMDOVPNIPT, "w") as iptables_file:
-            for line in ipTablesConf:
-                iptables_file.write(line + "\n")
+        action = "none"
+        for path, lines in fw.getFiles(rules).items():
+            if self.writeConf(path, lines) != None:
+                action = "reload"
         # enabling and restarting is done automatically when finished all
-        return retval
+        if self.writeConf(SYSTEMDOVPNIPT, ipTablesConf) != None:
+            action = "restart"
+        return action
+
+    def getFirewall(self, db):
+        # automatic: nftables when available and no other firewall filters input or forward
+        setting = db.get('firewall', OVPN_FIREWALL[0])
+        if setting == "iptables":
+            return iptables()
+        if setting != "nftables" and (not nftables.available() or nftables().isFiltered()):
+            return iptables()
+        return nftables()
+
+    def getFirewallRules(self, db, ip, ip6):
+        # backend independent description of the rules
+        rules = {}
+        rules['inputs'] = [(instance['protocol'], instance['port']) for instance in self.getInstances(db)]
+        rules['nets'] = [self.getNatRules(db, 4, str(self.getVpnNetwork(db)), ip)]
+        if ip6:
+            rules['nets'].append(self.getNatRules(db, 6, str(self.getVpnNetwork6(db)), ip6))
+        return rules
+
+    def getNatRules(self, db, family, network, ip):
+        # egress addresses for the network, the firewall backend spreads the
+        # clients (nftables) or connections (iptables) equally over them
+        addresses = self.getEgress(db, family) or [ip]
+        net = {}
+        net['family'] = family
+        net['network'] = network
+        net['ports'] = str(db.get('snat_ports', "")).strip()
+        if net['ports'] and not re.match(r"^[0-9]+(-[0-9]+)?$", net['ports']):
+            self.parseError("Invalid egress port range: {}".format(net['ports']), opt_msg = False, msg = False)
+        if len(addresses) > 1 and not net['ports']:
+            net['ports'] = SNAT_PORTS
+        net['snat'] = addresses
+        return net
+
+    def getEgress(self, db, family):
+        # egress addresses of this family, empty for the first address of the gateway interface
+        addresses = []
+        for entry in db.get('egress_addresses', "").split(','):
+            entry = entry.strip()
+            if entry == SNAT_ALL:
+                candidates = self.getIps(db['gateway_interface'], family)
+            else:
+                candidates = [entry]
+            for address in candidates:
+                try:
+                    if ipaddress.ip_address(address).version == family and not address in addresses:
+                        addresses.append(address)
+                except ValueError:
+                    pass
+        return addresses
 
     def setupOpenVpn(self, db):
-        retval = True
+        changes = {}
+        changes['files'] = []
+        changes['server'] = {}
+        changes['remove'] = []
+        instances = self.getInstances(db)
 
         ip = self.getIp(db['gateway_interface'])
         ip6 = ""
@@ -1124,77 +3604,200 @@ class sfccli(object):
         if db['deviceovpn'] != "tun":
             persist_tun = ";" + persist_tun
 
+        pools = self.getAddressPools(db)
         if db['duplicate_cn']:
             duplicate_cn = "duplicate-cn"
+        elif pools:
+            duplicate_cn = "client-config-dir {}"
         else:
-            duplicate_cn = "ifconfig-pool-persist ipp.txt"
+            duplicate_cn = "ifconfig-pool-persist {}"
 
         # Enable net.ipv4.ip_forward and net.ipv6.conf.all.forwarding.
-        with open(SERVICE_SYSCTL_CONF, "w") as sysctl_file:
-            sysctl_file.write("net.ipv4.ip_forward=1")
-            if ip6:
-                sysctl_file.write("\nnet.ipv6.conf.all.forwarding=1")
-        with open(SERVICE_FORWARD_PROC, "w") as ipfwd_proc:
-            ipfwd_proc.write("1")
+        sysctlConf = ["net.ipv4.ip_forward=1"]
         if ip6:
-            with open(SERVICE_FORWARD_PROC_IP6, "w") as ipfwd_proc:
-                ipfwd_proc.write("1")
-
-        self.setupIpTables(db, ip, ip6)
-
-        openVpnConf = []
-        openVpnConf.append("port {}".format(db['port']))
-        openVpnConf.append("proto {}".format(db['protocol']))
-        openVpnConf.append("dev {}".format(db['deviceovpn']))
-        openVpnConf.append("ca \"{}/ca.crt\"".format(EASY_RSA_KEY_DIR))
-        openVpnConf.append("cert \"{}/issued/{}.crt\"".format(EASY_RSA_KEY_DIR, self.getHostname()))
-        openVpnConf.append("key \"{}/private/{}.key\" # This file should be kept secret".format(EASY_RSA_KEY_DIR, self.getHostname()))
-        openVpnConf.append("dh \"{}/dh.pem\"".format(EASY_RSA_KEY_DIR))
-        openVpnConf.append("topology subnet")
-        openVpnConf.append("server {} {}".format(db['vpn_network'], db['vpn_mask']))
-        openVpnConf.append(duplicate_cn)
-        openVpnConf.append(static_route)
+            sysctlConf.append("net.ipv6.conf.all.forwarding=1")
+        if self.writeConf(SERVICE_SYSCTL_CONF, sysctlConf) != None:
+            changes['files'].append(SERVICE_SYSCTL_CONF)
+        self.setProc(SERVICE_FORWARD_PROC, "1")
         if ip6:
-            openVpnConf.append("server-ipv6 fddd:{}:{}:{}::/64".format(db['port'],db['port'],db['port']))
-        openVpnConf.append(default_gateway)
-
-        dns = self.getDns(db['dns_server'])
-        if db['dns']:
-            dns.extend(db['dns'].split(','))
-        for address in dns:
-            openVpnConf.append("push \"dhcp-option DNS {}\"".format(address))
-        if db['dns_domains']:
-            for address in db['dns_domains'].split(','):
-                openVpnConf.append("push \"dhcp-option DOMAIN {}\"".format(address))
-        if db['wins']:
-            for address in db['wins'].split(','):
-                openVpnConf.append("push \"dhcp-option WINS {}\"".format(address))
-
-        openVpnConf.append(client_to_client)
-        openVpnConf.append("keepalive 10 120")
-        openVpnConf.append(compression)
-        openVpnConf.append(pam_authentication)
-        openVpnConf.append("user nobody")
-        openVpnConf.append("group nogroup")
-        openVpnConf.append("persist-key")
-        openVpnConf.append(persist_tun)
-        openVpnConf.append("status /var/log/openvpn-status.log")
-        openVpnConf.append("log /var/log/openvpn.log")
-        openVpnConf.append("verb {}".format(self.getLog(db['loglevel'])))
-        openVpnConf.append("mute 10")
-        openVpnConf.append("crl-verify \"{}/crl.pem\"".format(EASY_RSA_KEY_DIR))
-        openVpnConf.append("")
-        if db['extra_options']:
-            openVpnConf.append("# Extra options")
-            for extra_option in db['extra_options'].split(','):
-                openVpnConf.append(extra_option)
+            self.setProc(SERVICE_FORWARD_PROC_IP6, "1")
+
+        changes['iptables'] = self.setupIpTables(db, ip, ip6)
+        if changes['iptables'] == "restart":
+            changes['files'].append(SYSTEMDOVPNIPT)
+        elif changes['iptables'] == "reload":
+            changes['files'].append(SERVICE_NFT_CONF)
+
+        if pools:
+            names = set(self.getClientStore(self.getdB()).names)
+            for pool in pools:
+                with pool:
+                    pool.sync(names)
+
+        dhConf = self.getDhConf(db['dh_params'])
+        crlConf = self.getCrlConf(db['crl_mode'])
+        for instance in instances:
+            openVpnConf = []
+            openVpnConf.append("port {}".format(instance['port']))
+            openVpnConf.append("proto {}".format(instance['protocol']))
+            openVpnConf.append("dev {}".format(db['deviceovpn']))
+            openVpnConf.append("ca \"{}/ca.crt\"".format(EASY_RSA_KEY_DIR))
+            openVpnConf.append("cert \"{}/issued/{}.crt\"".format(EASY_RSA_KEY_DIR, self.getHostname()))
+            openVpnConf.append("key \"{}/private/{}.key\" # This file should be kept secret".format(EASY_RSA_KEY_DIR, self.getHostname()))
+            openVpnConf.append(dhConf)
+            openVpnConf.append("topology subnet")
+            if pools:
+                # every client has a static address in the client-config-dir
+                openVpnConf.append("server {} {} nopool".format(instance['network'], instance['mask']))
+                openVpnConf.append(duplicate_cn.format(instance['ccd']))
+            else:
+                openVpnConf.append("server {} {}".format(instance['network'], instance['mask']))
+                openVpnConf.append(duplicate_cn.format(instance['ipp']))
+            openVpnConf.append(static_route)
+            if ip6:
+                openVpnConf.append("server-ipv6 {}".format(instance['network6']))
+            openVpnConf.append(default_gateway)
+
+            dns = self.getDns(db['dns_server'])
+            if db['dns']:
+                dns.extend(db['dns'].split(','))
+            for address in dns:
+                openVpnConf.append("push \"dhcp-option DNS {}\"".format(address))
+            if db['dns_domains']:
+                for address in db['dns_domains'].split(','):
+                    openVpnConf.append("push \"dhcp-option DOMAIN {}\"".format(address))
+            if db['wins']:
+                for address in db['wins'].split(','):
+                    openVpnConf.append("push \"dhcp-option WINS {}\"".format(address))
+
+            openVpnConf.append(client_to_client)
+            openVpnConf.append("keepalive 10 120")
+            openVpnConf.append(compression)
+            openVpnConf.append(pam_authentication)
+            openVpnConf.append("user nobody")
+            openVpnConf.append("group nogroup")
+            openVpnConf.append("persist-key")
+            openVpnConf.append(persist_tun)
+            openVpnConf.append("status {}".format(instance['status']))
+            openVpnConf.append("management {} unix".format(instance['management']))
+            openVpnConf.append("log {}".format(instance['log']))
+            openVpnConf.append("verb {}".format(self.getLog(db['loglevel'])))
+            openVpnConf.append("mute 10")
+            openVpnConf.append(crlConf)
             openVpnConf.append("")
+            if db['extra_options']:
+                openVpnConf.append("# Extra options")
+                for extra_option in db['extra_options'].split(','):
+                    openVpnConf.append(extra_option)
+                openVpnConf.append("")
+
+            changes['server'][instance['unit']] = "none"
+            oldConf = self.writeConf(instance['conf'], openVpnConf)
+            if oldConf != None:
+                changes['files'].append(instance['conf'])
+                changes['server'][instance['unit']] = self.getServerAction(oldConf.splitlines(), openVpnConf)
+
+        # configs of instances that are no longer used
+        for file in os.listdir(os.path.dirname(SERVICE_OPENVPN_CONF)):
+            match = re.match(r"^server([0-9]+)\.conf$", file)
+            if match and int(match.group(1)) >= len(instances):
+                os.remove(os.path.dirname(SERVICE_OPENVPN_CONF) + "/" + file)
+                changes['files'].append(os.path.dirname(SERVICE_OPENVPN_CONF) + "/" + file)
+                changes['remove'].append(DAEMONOVPNSRV + match.group(1))
+
+        return changes
+
+    def getCrlConf(self, setting):
+        # the directory is kept up to date in both modes, so switching doesn't need a rebuild
+        try:
+            crldir().sync(easyrsa().readIndex())
+        except OSError:
+            pass
+        if OVPN_CRL.get(setting) == "dir":
+            return "crl-verify \"{}\" dir".format(CRL_DIR)
+        return "crl-verify \"{}/crl.pem\"".format(EASY_RSA_KEY_DIR)
+
+    def getDhConf(self, setting):
+        dh = OVPN_DH.get(setting, OVPN_DH["Generated"])
+        if dh == "none":
+            return "dh none" # ECDHE only
+        pool = dhpool()
+        if dh == OVPN_DH["Generated"]:
+            path = EASY_RSA_KEY_DIR + "/" + dh
+            if not os.path.isfile(path):
+                dhFile = pool.take()
+                try:
+                    if dhFile:
+                        shutil.move(dhFile, path)
+                    else:
+                        shell().command(pool.getCmd(path))
+                except:
+                    self.parseError("Error executing generating dh parameter command", opt_msg = False, msg = False)
+                pool.refill(self.daemon)
+        else:
+            path = "{}/{}.pem".format(SERVICE_OPENVPN_DIR, dh)
+            try:
+                pool.getPredefined(dh, path)
+            except:
+                self.parseError("Error writing predefined dh parameters {}".format(dh), opt_msg = False, msg = False)
+        return "dh \"{}\"".format(path)
+
+    def getServerAction(self, oldConf, newConf):
+        # openvpn has no reload that keeps clients connected (SIGHUP restarts the
+        # server and rereads the key after dropping privileges), so any option
+        # change is a restart, only comments and empty lines don't need one
+        retval = "none"
+        for line in set(oldConf).symmetric_difference(set(newConf)):
+            option = line.strip()
+            if option and not option.startswith("#") and not option.startswith(";"):
+                retval = "restart"
+                break
+        return retval
 
-        with open(SERVICE_OPENVPN_CONF, "w") as openvpnconf_file:
-            for line in openVpnConf:
-                openvpnconf_file.write(line + "\n")
+    def writeConf(self, path, lines):
+        # only writes when the content changed, returns the old content or None if unchanged
+        content = "\n".join(lines) + "\n"
+        oldContent = ""
+        try:
+            with open(path, "r") as conf_file:
+                oldContent = conf_file.read()
+        except:
+            pass
+        if oldContent == content:
+            return None
+        with open(path, "w") as conf_file:
+            conf_file.write(content)
+        return oldContent
 
-        return retval
+    def setProc(self, path, value):
+        try:
+            with open(path, "r") as proc_file:
+                if proc_file.read().strip() == value:
+                    return
+        except:
+            pass
+        with open(path, "w") as proc_file:
+            proc_file.write(value)
+
+    def getRemotes(self, db):
+        # all server instances on all public addresses. Extra addresses are entered
+        # like the remote option: "host", "host port" or "host port protocol"
+        # a single remote is written without protocol, like before
+        instances = self.getInstances(db)
+        remotes = []
+        if db['public_address'] or not db.get('public_addresses'):
+            remotes = [[db['public_address'], str(instance['port']), instance['protocol']] for instance in instances]
+        for address in db.get('public_addresses', "").split(','):
+            fields = address.split()
+            if len(fields) == 1:
+                remotes.extend([[fields[0], str(instance['port']), instance['protocol']] for instance in instances])
+            elif len(fields) == 2:
+                remotes.append([fields[0], fields[1], db['protocol']])
+            elif len(fields) >= 3:
+                remotes.append(fields[:3])
+        if len(remotes) == 1:
+            remotes[0] = remotes[0][:2]
+        return remotes
 
     def generateClientConf(self, name, db, ca = None, cert = None, key = None):
         clientConf = []
@@ -1212,7 +3815,14 @@ class sfccli(object):
             pam_authentication = ";" + pam_authentication
 
         clientConf.append("client")
-        clientConf.append("remote {} {}".format(db['public_address'], db['port']))
+        remotes = self.getRemotes(db)
+        for remote in remotes:
+            clientConf.append("remote {}".format(" ".join(remote)))
+        if len(remotes) > 1:
+            # spread clients over the remotes and fail over fast
+            if db.get('remote_random', True):
+                clientConf.append("remote-random")
+            clientConf.append("server-poll-timeout {}".format(db.get('server_poll_timeout', 10)))
         clientConf.append("proto {}".format(db['protocol']))
         clientConf.append("dev {}".format(db['deviceovpn']))
         clientConf.append("remote-cert-tls server")
@@ -1228,24 +3838,21 @@ class sfccli(object):
 
         if ca:
             clientConf.append("<ca>")
-            with open(ca, 'r') as ca_file:
-                clientConf.append(ca_file.read())
+            clientConf.append(ca)
             clientConf.append("</ca>")
         else:
             clientConf.append("ca   {}-ca.crt".format(name))
 
         if cert:
             clientConf.append("<cert>")
-            with open(cert, 'r') as cert_file:
-                clientConf.append(cert_file.read())
+            clientConf.append(cert)
             clientConf.append("</cert>")
         else:
             clientConf.append("cert {}-client.crt".format(name))
 
         if key:
             clientConf.append("<key>")
-            with open(key, 'r') as key_file:
-                clientConf.append(key_file.read())
+            clientConf.append(key)
             clientConf.append("</key>")
         else:
             clientConf.append("key  {}-client.key".format(name))
@@ -1255,6 +3862,114 @@ class sfccli(object):
 
         return clientConf
 
+#########################################################
+# Class : threadstdout                                  #
+#########################################################
+class threadstdout(object):
+    # stdout of the daemon, output of every request thread goes to its own buffer
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __del__(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, data):
+        return self.getStream().write(data)
+
+    def flush(self):
+        return self.getStream().flush()
+
+    @contextmanager
+    def redirect(self, out):
+        self.local.out = out
+        try:
+            yield out
+        finally:
+            self.local.out = None
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getStream(self):
+        out = getattr(self.local, "out", None)
+        return out if out != None else self.stream
+
+#########################################################
+# Class : rwlock                                        #
+#########################################################
+class rwlock(object):
+    # any number of readers or one writer, a waiting writer blocks new readers
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting = 0
+
+    def __del__(self):
+        pass
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writing or self.waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.waiting += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.waiting -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+#########################################################
+# Class : cliserver                                     #
+#########################################################
+class cliserver(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # a long request (setup, batch add, status events) doesn't block the others
+    daemon_threads = True
+
+#########################################################
+# Class : clihandler                                    #
+#########################################################
+class clihandler(socketserver.StreamRequestHandler):
+    # progress is sent as JSON-RPC notifications before the response
+    def handle(self):
+        self.lock = threading.Lock()
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.cli.request(line.decode(ENCODING), self.notify)
+            self.send(response)
+
+    def notify(self, event):
+        try:
+            self.send({"jsonrpc": "2.0", "method": "progress", "params": event})
+        except OSError:
+            pass # client is gone, the command still finishes
+
+    def send(self, message):
+        with self.lock:
+            self.wfile.write((json.dumps(message) + "\n").encode(ENCODING))
+            self.wfile.flush()
+
 ######################### MAIN ##########################
 if __name__ == "__main__":
     sfccli().run(sys.argv)
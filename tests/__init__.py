@@ -0,0 +1,25 @@
+#########################################################
+# Tests for openvpn-cli, run from the repository root:  #
+#   python3 -m unittest                                 #
+# They use temporary directories, a fake management     #
+# interface and a stub systemd bus, nothing in /etc,    #
+# /var or systemd is touched.                           #
+#########################################################
+
+import os
+import sys
+import importlib.util
+
+CLI_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "opt", "openvpn", "openvpn-cli.py")
+CLI_NAME = "openvpncli"
+
+def loadCli():
+    # openvpn-cli.py isn't importable by name
+    if not CLI_NAME in sys.modules:
+        spec = importlib.util.spec_from_file_location(CLI_NAME, CLI_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[CLI_NAME] = module
+        spec.loader.exec_module(module)
+    return sys.modules[CLI_NAME]
+
+cli = loadCli()
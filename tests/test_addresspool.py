@@ -0,0 +1,100 @@
+import os
+import ipaddress
+import tempfile
+import unittest
+
+from . import cli
+
+class addresspoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ccdDir = os.path.join(self.tmp.name, "ccd")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def getPool(self, network = "10.8.0.0/24"):
+        return cli.addresspool(ipaddress.IPv4Network(network), self.ccdDir)
+
+    def readCcd(self, name):
+        with open(os.path.join(self.ccdDir, name)) as ccd_file:
+            return ccd_file.read()
+
+    def testAllocate(self):
+        with self.getPool() as pool:
+            # network and server address are reserved
+            self.assertEqual(pool.allocate("client1"), "10.8.0.2")
+            self.assertEqual(pool.allocate("client2"), "10.8.0.3")
+            # a client keeps its address
+            self.assertEqual(pool.allocate("client1"), "10.8.0.2")
+            self.assertEqual(pool.count(), 2)
+        self.assertEqual(self.readCcd("client1"), "ifconfig-push 10.8.0.2 255.255.255.0\n")
+        self.assertTrue(os.path.isfile(os.path.join(self.ccdDir, ".bitmap")))
+
+    def testFree(self):
+        with self.getPool() as pool:
+            for i in range(3):
+                pool.allocate("client{}".format(i))
+            pool.free("client1")
+            pool.free("unknown")
+            self.assertFalse(os.path.exists(os.path.join(self.ccdDir, "client1")))
+            self.assertEqual(pool.count(), 2)
+            # the freed address is in the byte of the last allocation
+            self.assertEqual(pool.allocate("client3"), "10.8.0.3")
+
+    def testExhausted(self):
+        with self.getPool("10.8.0.0/29") as pool:
+            addresses = [pool.allocate("client{}".format(i)) for i in range(5)]
+            self.assertEqual(addresses, ["10.8.0.{}".format(i) for i in range(2, 7)])
+            with self.assertRaises(Exception):
+                pool.allocate("client5")
+            pool.free("client2")
+            self.assertEqual(pool.allocate("client5"), "10.8.0.4")
+
+    def testPersistent(self):
+        with self.getPool() as pool:
+            pool.allocate("client1")
+            pool.allocate("client2")
+        with self.getPool() as pool:
+            self.assertEqual(pool.count(), 2)
+            self.assertEqual(pool.allocate("client3"), "10.8.0.4")
+
+    def testRebuild(self):
+        with self.getPool() as pool:
+            pool.allocate("client1")
+            pool.allocate("client2")
+        os.remove(os.path.join(self.ccdDir, ".bitmap"))
+        # an address outside the hosts and a duplicate address are dropped
+        with open(os.path.join(self.ccdDir, "client3"), "w") as ccd_file:
+            ccd_file.write("ifconfig-push 10.8.0.255 255.255.255.0\n")
+        with open(os.path.join(self.ccdDir, "client4"), "w") as ccd_file:
+            ccd_file.write("ifconfig-push 10.8.0.2 255.255.255.0\n")
+        with self.getPool() as pool:
+            self.assertEqual(pool.count(), 2)
+            files = [file for file in os.listdir(self.ccdDir) if not file.startswith(".")]
+            self.assertEqual(len(files), 2)
+            self.assertIn("client2", files)
+            self.assertNotIn("client3", files)
+
+    def testNetworkChange(self):
+        with self.getPool() as pool:
+            pool.allocate("client1")
+        with self.getPool("10.9.0.0/24") as pool:
+            self.assertEqual(pool.count(), 0)
+            self.assertEqual(pool.allocate("client1"), "10.9.0.2")
+        self.assertEqual(self.readCcd("client1"), "ifconfig-push 10.9.0.2 255.255.255.0\n")
+
+    def testSync(self):
+        with self.getPool() as pool:
+            pool.allocate("client1")
+            pool.allocate("client2")
+        with self.getPool() as pool:
+            pool.sync(set(["client2", "client3"]))
+            self.assertEqual(pool.count(), 2)
+            self.assertFalse(os.path.exists(os.path.join(self.ccdDir, "client1")))
+            self.assertEqual(pool.allocate("client2"), "10.8.0.3")
+            # allocated after client1 was freed
+            self.assertEqual(pool.allocate("client3"), "10.8.0.2")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from . import cli
+
+class testdatabase(cli.database):
+    # database with the XML file in a temporary directory instead of /etc
+    xmlPath = ""
+
+    def getXMLpath(self, doexit = True, dowrite = False):
+        return self.xmlPath if os.path.isfile(self.xmlPath) else ""
+
+    def getNewXMLpath(self):
+        return self.xmlPath
+
+    def getXMLstat(self):
+        retval = None
+        try:
+            st = os.stat(self.xmlPath)
+            retval = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except:
+            pass
+        return retval
+
+class databaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        testdatabase.xmlPath = os.path.join(self.tmp.name, cli.XML_FILENAME)
+        cacheDir = os.path.join(self.tmp.name, "cache")
+        self.cacheXml = os.path.join(cacheDir, "openvpn.json")
+        self.patches = [mock.patch.object(cli, "CACHE_DIR", cacheDir), mock.patch.object(cli, "CACHE_XML", self.cacheXml)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def readXml(self):
+        with open(testdatabase.xmlPath) as xml_file:
+            return xml_file.read()
+
+    def testCreate(self):
+        db = testdatabase()
+        self.assertEqual(db(), {})
+        self.assertIn("Do not edit this file manually", self.readXml())
+        # the comment survives the first update of a fresh install
+        db()['port'] = 1194
+        db.update()
+        content = self.readXml()
+        self.assertIn("Do not edit this file manually", content)
+        self.assertIn("<port>1194</port>", content)
+
+    def testCache(self):
+        db = testdatabase()
+        db()['port'] = 1194
+        db()['clients'] = {'client1': {'revoked': False}}
+        db.update()
+        with open(self.cacheXml) as cache_file:
+            cache = json.load(cache_file)
+        self.assertEqual(cache['db'], db())
+        self.assertEqual(cache['stat'], list(db.getXMLstat()))
+
+        # an unchanged file is read from the cache, not parsed
+        with mock.patch.object(cli.ET, "fromstring", side_effect = AssertionError("xml parsed")):
+            self.assertEqual(testdatabase()(), {'port': 1194, 'clients': {'client1': {'revoked': False}}})
+
+    def testInvalidate(self):
+        db = testdatabase()
+        db()['port'] = 1194
+        db.update()
+        self.assertFalse(db.changed())
+        # edited by another process, the stat no longer matches the cache
+        content = self.readXml()
+        with open(testdatabase.xmlPath, "w") as xml_file:
+            xml_file.write(content.replace("1194", "11940"))
+        self.assertTrue(db.changed())
+        self.assertEqual(testdatabase()()['port'], 11940)
+        db.reload()
+        self.assertEqual(db()['port'], 11940)
+
+    def testSkipWrite(self):
+        db = testdatabase()
+        db()['port'] = 1194
+        db.update()
+        stat = db.getXMLstat()
+        db.update()
+        self.assertEqual(db.getXMLstat(), stat)
+
+class bundlecacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = cli.bundlecache(os.path.join(self.tmp.name, "bundles"))
+        self.certFile = os.path.join(self.tmp.name, "client1.crt")
+        with open(self.certFile, "w") as cert_file:
+            cert_file.write("cert")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testCache(self):
+        db = {key: "" for key in cli.BUNDLEKEYS}
+        key = self.cache.getKey(db, [self.certFile])
+        self.assertEqual(self.cache.get("client1", key), None)
+        self.cache.set("client1", key, b"zip")
+        self.assertEqual(self.cache.get("client1", key), b"zip")
+
+        # a new certificate or changed settings give a new key, the old bundle is evicted
+        os.utime(self.certFile, ns = (0, 0))
+        newKey = self.cache.getKey(db, [self.certFile])
+        self.assertNotEqual(newKey, key)
+        db[cli.BUNDLEKEYS[0]] = "changed"
+        self.assertNotEqual(self.cache.getKey(db, [self.certFile]), newKey)
+        self.cache.set("client1", newKey, b"zip2")
+        self.assertEqual(self.cache.get("client1", key), None)
+        self.assertEqual(os.listdir(self.cache.cacheDir), ["client1-{}.zip".format(newKey)])
+
+class crldirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.crlDir = os.path.join(self.tmp.name, "crl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testSync(self):
+        crl = cli.crldir(self.crlDir)
+        crl.add(["0A"])
+        self.assertTrue(crl.isRevoked("0A"))
+        index = [["R", "", "", "1F"], ["V", "", "", "20"], ["R", "", "", "21"]]
+        self.assertEqual(crl.sync(index), 2)
+        self.assertEqual(sorted(os.listdir(self.crlDir)), ["31", "33"])
+        crl.remove(["21"])
+        self.assertFalse(crl.isRevoked("21"))
+        # readable by openvpn after dropping privileges
+        self.assertEqual(os.stat(self.crlDir).st_mode & 0o777, 0o755)
+        self.assertEqual(os.stat(os.path.join(self.crlDir, "31")).st_mode & 0o777, 0o644)
+
+if __name__ == "__main__":
+    unittest.main()
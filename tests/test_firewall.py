@@ -0,0 +1,107 @@
+import unittest
+
+from . import cli
+
+class firewallTest(unittest.TestCase):
+    def setUp(self):
+        self.cli = cli.sfccli()
+        self.cli.parseError = self.parseError
+        self.db = {'port': 1194, 'protocol': "udp", 'vpn_network': "10.8.0.0", 'vpn_mask': "255.255.255.0",
+                   'enable_ipv6': True, 'instances': 1, 'egress_addresses': "", 'snat_ports': ""}
+
+    def parseError(self, opt = "", opt_msg = True, msg = True):
+        raise ValueError(opt)
+
+    def getRules(self, egress = "", egress6 = ""):
+        self.db['egress_addresses'] = ",".join(address for address in [egress, egress6] if address)
+        return self.cli.getFirewallRules(self.db, "192.168.1.10", "2001:db8::10")
+
+    def getIptables(self, rules):
+        fw = cli.iptables()
+        fw.iptablesPath = "iptables"
+        fw.ip6tablesPath = "ip6tables"
+        return fw.getUnit(rules)
+
+    def getNftables(self, rules):
+        fw = cli.nftables("/tmp/openvpn.nft", "inet openvpn")
+        fw.nftPath = "nft"
+        return fw.getFiles(rules)["/tmp/openvpn.nft"]
+
+    def testRules(self):
+        rules = self.getRules()
+        self.assertEqual(rules['inputs'], [("udp", 1194)])
+        self.assertEqual(rules['nets'], [
+            {'family': 4, 'network': "10.8.0.0/24", 'ports': "", 'snat': ["192.168.1.10"]},
+            {'family': 6, 'network': "fddd:1194:1194:1194::/64", 'ports': "", 'snat': ["2001:db8::10"]}])
+
+    def testEgress(self):
+        rules = self.getRules("192.168.1.11, 192.168.1.12, 2001:db8::11, invalid, 192.168.1.11")
+        self.assertEqual(rules['nets'][0]['snat'], ["192.168.1.11", "192.168.1.12"])
+        self.assertEqual(rules['nets'][0]['ports'], cli.SNAT_PORTS)
+        self.assertEqual(rules['nets'][1]['snat'], ["2001:db8::11"])
+        self.assertEqual(rules['nets'][1]['ports'], "")
+
+    def testPorts(self):
+        self.db['snat_ports'] = "20000-29999"
+        self.assertEqual(self.getRules()['nets'][0]['ports'], "20000-29999")
+        self.db['snat_ports'] = "1024-"
+        with self.assertRaises(ValueError):
+            self.getRules()
+
+    def testIptables(self):
+        unit = self.getIptables(self.getRules())
+        self.assertIn("ExecStart=iptables -t nat -A POSTROUTING -s 10.8.0.0/24 ! -d 10.8.0.0/24 -j SNAT --to 192.168.1.10", unit)
+        self.assertIn("ExecStart=iptables -I INPUT -p udp --dport 1194 -j ACCEPT", unit)
+        self.assertIn("ExecStart=ip6tables -I FORWARD -s fddd:1194:1194:1194::/64 -j ACCEPT", unit)
+        self.assertIn("ExecStop=ip6tables -t nat -D POSTROUTING -s fddd:1194:1194:1194::/64 ! -d fddd:1194:1194:1194::/64 -j SNAT --to 2001:db8::10", unit)
+        starts = [line for line in unit if line.startswith("ExecStart=")]
+        self.assertEqual(len(starts) * 2, len(unit))
+        self.assertFalse(any("statistic" in line for line in unit))
+
+    def testIptablesEqual(self):
+        # the nth rule of n takes every (n - i)th connection, the last one the rest
+        unit = self.getIptables(self.getRules("192.168.1.11,192.168.1.12,192.168.1.13"))
+        snat = [line for line in unit if line.startswith("ExecStart=iptables -t nat")]
+        match = "ExecStart=iptables -t nat -A POSTROUTING -s 10.8.0.0/24 ! -d 10.8.0.0/24"
+        self.assertEqual(snat, [
+            match + " -p tcp -m statistic --mode nth --every 3 --packet 0 -j SNAT --to 192.168.1.11:1024-65535",
+            match + " -p tcp -m statistic --mode nth --every 2 --packet 0 -j SNAT --to 192.168.1.12:1024-65535",
+            match + " -p tcp -j SNAT --to 192.168.1.13:1024-65535",
+            match + " -p udp -m statistic --mode nth --every 3 --packet 0 -j SNAT --to 192.168.1.11:1024-65535",
+            match + " -p udp -m statistic --mode nth --every 2 --packet 0 -j SNAT --to 192.168.1.12:1024-65535",
+            match + " -p udp -j SNAT --to 192.168.1.13:1024-65535",
+            match + " -m statistic --mode nth --every 3 --packet 0 -j SNAT --to 192.168.1.11",
+            match + " -m statistic --mode nth --every 2 --packet 0 -j SNAT --to 192.168.1.12",
+            match + " -j SNAT --to 192.168.1.13"])
+
+    def testNftables(self):
+        conf = self.getNftables(self.getRules())
+        self.assertEqual(conf[:4], ["#!nft -f", "table inet openvpn", "delete table inet openvpn", "table inet openvpn {"])
+        self.assertIn("        udp dport 1194 accept", conf)
+        self.assertIn("        ip saddr 10.8.0.0/24 ip daddr != 10.8.0.0/24 snat ip to 192.168.1.10", conf)
+        self.assertIn("        ip6 saddr fddd:1194:1194:1194::/64 ip6 daddr != fddd:1194:1194:1194::/64 snat ip6 to 2001:db8::10", conf)
+        self.assertEqual(conf[-1], "}")
+        self.assertEqual(conf.count("    }"), 3)
+
+    def testNftablesEqual(self):
+        # clients are spread by a hash of the source address over a chain per address
+        conf = self.getNftables(self.getRules("192.168.1.11,192.168.1.12", "2001:db8::11,2001:db8::12"))
+        self.assertIn("        ip saddr 10.8.0.0/24 ip daddr != 10.8.0.0/24 jhash ip saddr mod 2 seed 0x0 "
+                      "vmap { 0 : jump snat_ip_0, 1 : jump snat_ip_1 }", conf)
+        self.assertIn("        ip6 saddr fddd:1194:1194:1194::/64 ip6 daddr != fddd:1194:1194:1194::/64 jhash ip6 saddr mod 2 seed 0x0 "
+                      "vmap { 0 : jump snat_ip6_0, 1 : jump snat_ip6_1 }", conf)
+        chain = conf.index("    chain snat_ip_1 {")
+        self.assertEqual(conf[chain + 1:chain + 4], [
+            "        meta l4proto { tcp, udp } snat ip to 192.168.1.12:1024-65535",
+            "        snat ip to 192.168.1.12",
+            "    }"])
+        chain = conf.index("    chain snat_ip6_0 {")
+        self.assertEqual(conf[chain + 1], "        meta l4proto { tcp, udp } snat ip6 to [2001:db8::11]:1024-65535")
+
+    def testNftablesUnit(self):
+        unit = cli.nftables("/tmp/openvpn.nft", "inet openvpn").getUnit(self.getRules())
+        self.assertTrue(unit[0].endswith(" -f /tmp/openvpn.nft"))
+        self.assertTrue(unit[-1].endswith(" delete table inet openvpn"))
+
+if __name__ == "__main__":
+    unittest.main()
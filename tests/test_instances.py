@@ -0,0 +1,72 @@
+import unittest
+
+from . import cli
+
+class instancesTest(unittest.TestCase):
+    def setUp(self):
+        self.cli = cli.sfccli()
+        self.cli.parseError = self.parseError
+        self.db = {'port': 1194, 'protocol': "udp", 'vpn_network': "10.8.0.0", 'vpn_mask': "255.255.255.0",
+                   'enable_ipv6': True, 'instances': 1, 'instance_mode': cli.OVPN_INSTANCES[0]}
+
+    def parseError(self, opt = "", opt_msg = True, msg = True):
+        raise ValueError(opt)
+
+    def getSlices(self, key):
+        return [instance[key] for instance in self.cli.getInstances(self.db)]
+
+    def testSingle(self):
+        instances = self.cli.getInstances(self.db)
+        self.assertEqual(len(instances), 1)
+        instance = instances[0]
+        self.assertEqual(instance['name'], "server")
+        self.assertEqual(instance['unit'], cli.DAEMONOVPNSRV)
+        self.assertEqual(instance['network'], "10.8.0.0")
+        self.assertEqual(instance['mask'], "255.255.255.0")
+        self.assertEqual(instance['network6'], "fddd:1194:1194:1194::/64")
+        self.assertEqual(instance['management'], cli.SERVICE_MANAGEMENT)
+        self.assertEqual(instance['ccd'], cli.SERVICE_CCD_DIR)
+
+    def testSlices(self):
+        self.db['instances'] = 3
+        self.assertEqual(self.getSlices('network'), ["10.8.0.0", "10.8.0.64", "10.8.0.128"])
+        self.assertEqual(self.getSlices('mask'), ["255.255.255.192"] * 3)
+        self.assertEqual(self.getSlices('network6'), ["fddd:1194:1194:1194::/66", "fddd:1194:1194:1194:4000::/66",
+                                                      "fddd:1194:1194:1194:8000::/66"])
+        self.assertEqual(self.getSlices('port'), [1194, 1195, 1196])
+        self.assertEqual(self.getSlices('name'), ["server", "server1", "server2"])
+        self.assertEqual(len(set(self.getSlices('status'))), 3)
+
+    def testProtocols(self):
+        self.db['instances'] = 4
+        self.db['instance_mode'] = cli.OVPN_INSTANCES[1]
+        self.assertEqual(self.getSlices('protocol'), ["udp", "tcp", "udp", "tcp"])
+        self.assertEqual(self.getSlices('port'), [1194, 1194, 1195, 1195])
+
+    def testTooSmall(self):
+        self.db['vpn_mask'] = "255.255.255.248"
+        self.db['instances'] = 2
+        with self.assertRaises(ValueError):
+            self.cli.getInstances(self.db)
+
+    def testNetwork6(self):
+        self.db['port'] = 10000
+        self.assertEqual(self.getSlices('network6'), ["fddd:2710:2710:2710::/64"])
+        self.db['port'] = 65535
+        self.assertEqual(self.getSlices('network6'), ["fddd:ffff:ffff:ffff::/64"])
+        self.db['vpn_network6'] = "fd00:1::/48"
+        self.assertEqual(self.getSlices('network6'), ["fd00:1::/48"])
+        self.db['vpn_network6'] = "invalid"
+        with self.assertRaises(ValueError):
+            self.cli.getInstances(self.db)
+
+    def testNetwork6Disabled(self):
+        # not derived at all, so an invalid value doesn't matter
+        self.db['enable_ipv6'] = False
+        self.db['port'] = 10000
+        self.db['vpn_network6'] = "invalid"
+        self.db['instances'] = 2
+        self.assertEqual(self.getSlices('network6'), ["", ""])
+
+if __name__ == "__main__":
+    unittest.main()
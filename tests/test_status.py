@@ -0,0 +1,195 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from . import cli
+
+STATUS_V1 = """OpenVPN CLIENT LIST
+Updated,2024-01-01 12:00:00
+Common Name,Real Address,Bytes Received,Bytes Sent,Connected Since
+client1,1.2.3.4:5555,1234,5678,2024-01-01 11:00:00
+client2,5.6.7.8:6666,10,20,2024-01-01 11:30:00
+ROUTING TABLE
+Virtual Address,Common Name,Real Address,Last Ref
+10.8.0.2,client1,1.2.3.4:5555,2024-01-01 12:00:00
+fddd:1194:1194:1194::1000,client1,1.2.3.4:5555,2024-01-01 12:00:00
+10.8.0.3,client2,5.6.7.8:6666,2024-01-01 12:00:00
+GLOBAL STATS
+Max bcast/mcast queue length,0
+END
+"""
+
+STATUS_V2 = """TITLE,OpenVPN 2.5.1
+TIME,2024-01-01 12:00:00,1704110400
+HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,Virtual IPv6 Address,Bytes Received,Bytes Sent,Connected Since,Connected Since (time_t),Username,Client ID,Peer ID,Data Channel Cipher
+CLIENT_LIST,client1,1.2.3.4:5555,10.8.0.2,fddd:1194:1194:1194::1000,1234,5678,2024-01-01 11:00:00,1704106800,UNDEF,0,0,AES-256-GCM
+HEADER,ROUTING_TABLE,Virtual Address,Common Name,Real Address,Last Ref,Last Ref (time_t)
+ROUTING_TABLE,10.8.0.2,client1,1.2.3.4:5555,2024-01-01 12:00:00,1704110400
+GLOBAL_STATS,Max bcast/mcast queue length,0
+END
+"""
+
+class ovpnstatusTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.statusFile = os.path.join(self.tmp.name, "status.log")
+        self.cacheFile = os.path.join(self.tmp.name, "cache", "status.json")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeStatus(self, content):
+        with open(self.statusFile, "w") as status_file:
+            status_file.write(content)
+
+    def testVersion1(self):
+        status = cli.ovpnstatus().parse(STATUS_V1.splitlines(True))
+        self.assertEqual(status['updated'], "2024-01-01 12:00:00")
+        self.assertEqual([client['name'] for client in status['clients']], ["client1", "client2"])
+        client = status['clients'][0]
+        self.assertEqual(client['real_address'], "1.2.3.4:5555")
+        self.assertEqual(client['bytes_received'], 1234)
+        self.assertEqual(client['bytes_sent'], 5678)
+        # virtual addresses come from the routing table, the IPv6 route isn't used
+        self.assertEqual(client['virtual_address'], "10.8.0.2")
+        self.assertEqual(status['clients'][1]['virtual_address'], "10.8.0.3")
+        self.assertEqual(len(status['routes']), 3)
+
+    def testVersion2(self):
+        status = cli.ovpnstatus().parse(STATUS_V2.splitlines(True))
+        self.assertEqual(status['updated'], "2024-01-01 12:00:00")
+        self.assertEqual(len(status['clients']), 1)
+        client = status['clients'][0]
+        self.assertEqual(client['name'], "client1")
+        self.assertEqual(client['virtual_address'], "10.8.0.2")
+        self.assertEqual(client['virtual_address6'], "fddd:1194:1194:1194::1000")
+        self.assertEqual(client['bytes_received'], 1234)
+        self.assertEqual(client['connected_since'], "2024-01-01 11:00:00")
+        self.assertEqual(status['routes'][0]['name'], "client1")
+
+    def testVersion3(self):
+        # tab separated, fields may contain commas
+        content = STATUS_V2.replace(",", "\t").replace("UNDEF", "user,name")
+        status = cli.ovpnstatus().parse(content.splitlines(True))
+        self.assertEqual(status, cli.ovpnstatus().parse(STATUS_V2.splitlines(True)))
+
+    def testMissingFile(self):
+        status = cli.ovpnstatus(self.statusFile, self.cacheFile).get()
+        self.assertEqual(status['clients'], [])
+        self.assertFalse(os.path.exists(self.cacheFile))
+
+    def testCache(self):
+        self.writeStatus(STATUS_V2)
+        status = cli.ovpnstatus(self.statusFile, self.cacheFile).get()
+        self.assertEqual(len(status['clients']), 1)
+        self.assertTrue(os.path.isfile(self.cacheFile))
+
+        # an unchanged file is read from the disk cache by a new instance
+        reader = cli.ovpnstatus(self.statusFile, self.cacheFile)
+        reader.parseFile = lambda: self.fail("status file parsed again")
+        self.assertEqual(reader.get(), status)
+
+        # a changed file invalidates the disk and memory cache
+        self.writeStatus(STATUS_V1)
+        os.utime(self.statusFile, ns = (0, 0))
+        del reader.parseFile
+        self.assertEqual(len(reader.get()['clients']), 2)
+        self.assertEqual(len(cli.ovpnstatus(self.statusFile, self.cacheFile).get()['clients']), 2)
+
+#########################################################
+
+class fakemanagement(object):
+    # Minimal openvpn management interface on a unix socket, one client at a time
+    def __init__(self, path):
+        self.path = path
+        self.commands = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def close(self):
+        self.server.close()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            with conn:
+                self.handle(conn)
+
+    def handle(self, conn):
+        # a notification before the greeting is kept as an event
+        conn.sendall(b">HOLD:Waiting for hold release\r\n")
+        conn.sendall(b">INFO:OpenVPN Management Interface Version 3 -- type 'help' for more info\r\n")
+        for line in conn.makefile("rb"):
+            cmd = line.decode().strip()
+            self.commands.append(cmd)
+            if cmd == "status 2":
+                conn.sendall(STATUS_V2.replace("\n", "\r\n").encode())
+            elif cmd.startswith("bytecount"):
+                conn.sendall(b"SUCCESS: bytecount interval changed\r\n")
+                if cmd != "bytecount 0":
+                    conn.sendall(b">CLIENT:ESTABLISHED,0\r\n>CLIENT:ENV,common_name=client1\r\n"
+                                 b">CLIENT:ENV,tls_id_0=CN=client1,O=test\r\n>CLIENT:ENV,END\r\n"
+                                 b">BYTECOUNT_CLI:0,100,200\r\n")
+            elif cmd == "kill client1":
+                conn.sendall(b"SUCCESS: common name 'client1' found, 1 client(s) killed\r\n")
+            elif cmd.startswith("kill "):
+                conn.sendall("ERROR: common name '{}' not found\r\n".format(cmd[5:]).encode())
+            elif cmd.startswith("signal "):
+                conn.sendall("SUCCESS: signal {} thrown\r\n".format(cmd[7:]).encode())
+            elif cmd == "quit":
+                return
+
+class managementTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.socketPath = os.path.join(self.tmp.name, "management.sock")
+        self.server = fakemanagement(self.socketPath)
+
+    def tearDown(self):
+        self.server.close()
+        self.tmp.cleanup()
+
+    def testAvailable(self):
+        self.assertTrue(cli.management(self.socketPath).available())
+        self.assertFalse(cli.management(self.socketPath + ".none").available())
+
+    def testStatus(self):
+        with cli.management(self.socketPath, timeout = 2) as mgmt:
+            status = mgmt.status()
+            self.assertEqual(mgmt.events, [{'type': "hold", 'data': "Waiting for hold release"}])
+        self.assertEqual(status['source'], "management")
+        self.assertEqual(status['clients'][0]['virtual_address'], "10.8.0.2")
+        self.assertEqual(status['clients'][0]['bytes_sent'], 5678)
+
+    def testKill(self):
+        with cli.management(self.socketPath, timeout = 2) as mgmt:
+            self.assertIn("1 client(s) killed", mgmt.kill("client1"))
+            with self.assertRaises(Exception) as context:
+                mgmt.kill("client2")
+            self.assertIn("not found", str(context.exception))
+            # the connection is still usable after an error
+            self.assertEqual(mgmt.signal("SIGHUP"), "signal SIGHUP thrown")
+        self.assertEqual(self.server.commands[:3], ["kill client1", "kill client2", "signal SIGHUP"])
+
+    def testEvents(self):
+        with cli.management(self.socketPath, timeout = 2) as mgmt:
+            mgmt.events = []
+            mgmt.bytecount(1)
+            events = mgmt.listen(0.2)
+            mgmt.bytecount(0)
+        self.assertEqual(events[0]['type'], "client")
+        self.assertEqual(events[0]['event'], "established")
+        self.assertEqual(events[0]['cid'], "0")
+        self.assertEqual(events[0]['env'], {'common_name': "client1", 'tls_id_0': "CN=client1,O=test"})
+        self.assertEqual(events[1], {'type': "bytecount", 'cid': "0", 'bytes_received': 100, 'bytes_sent': 200})
+
+if __name__ == "__main__":
+    unittest.main()
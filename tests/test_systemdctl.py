@@ -0,0 +1,127 @@
+import unittest
+
+from . import cli
+
+class stubunit(object):
+    # unit object, properties by dbus.PROPERTIES_IFACE Get
+    def __init__(self, properties):
+        self.properties = properties
+
+    def Get(self, interface, prop, dbus_interface = None):
+        if interface != cli.SYSTEMDUNIT or dbus_interface != cli.DBUSPROPERTIES:
+            raise Exception("Unknown interface")
+        return self.properties[prop]
+
+class stubmanager(object):
+    # systemd manager, records the calls
+    def __init__(self, units):
+        self.units = units
+        self.calls = []
+        self.fail = False
+
+    def call(self, method, args, dbus_interface):
+        if dbus_interface != cli.SYSTEMDMANAGER:
+            raise Exception("Unknown interface")
+        if self.fail:
+            raise Exception("Access denied")
+        self.calls.append((method,) + args)
+
+    def StartUnit(self, name, mode, dbus_interface = None):
+        self.call("StartUnit", (name, mode), dbus_interface)
+
+    def StopUnit(self, name, mode, dbus_interface = None):
+        self.call("StopUnit", (name, mode), dbus_interface)
+
+    def RestartUnit(self, name, mode, dbus_interface = None):
+        self.call("RestartUnit", (name, mode), dbus_interface)
+
+    def ReloadUnit(self, name, mode, dbus_interface = None):
+        self.call("ReloadUnit", (name, mode), dbus_interface)
+
+    def EnableUnitFiles(self, names, runtime, force, dbus_interface = None):
+        self.call("EnableUnitFiles", (names, runtime, force), dbus_interface)
+
+    def DisableUnitFiles(self, names, runtime, dbus_interface = None):
+        self.call("DisableUnitFiles", (names, runtime), dbus_interface)
+
+    def Reload(self, dbus_interface = None):
+        self.call("Reload", (), dbus_interface)
+
+    def LoadUnit(self, name, dbus_interface = None):
+        self.call("LoadUnit", (name,), dbus_interface)
+        # systemd only knows full unit names
+        if not name in self.units:
+            raise Exception("Unit {} not found".format(name))
+        return "/org/freedesktop/systemd1/unit/" + name
+
+class stubbus(object):
+    # system bus with get_object, as dbus.SystemBus
+    def __init__(self, units):
+        self.units = units
+        self.manager = stubmanager(units)
+
+    def get_object(self, service, path):
+        if service != cli.SYSTEMDBUS:
+            raise Exception("Unknown service")
+        if path == cli.SYSTEMDPATH:
+            return self.manager
+        return stubunit(self.units[path.rsplit("/", 1)[1]])
+
+class systemdctlTest(unittest.TestCase):
+    def setUp(self):
+        self.units = {}
+        self.units["openvpn@server.service"] = {'ActiveState': "active", 'SubState': "running", 'UnitFileState': "enabled"}
+        self.units["openvpn@server1.service"] = {'ActiveState': "inactive", 'SubState': "dead", 'UnitFileState': "disabled"}
+        self.units["openvpn.timer"] = {'ActiveState': "active", 'SubState': "waiting", 'UnitFileState': "static"}
+        self.bus = stubbus(self.units)
+        self.ctl = cli.systemdctl(self.bus)
+
+    def testAvailable(self):
+        self.assertTrue(self.ctl.available())
+        self.assertEqual(self.ctl.manager, self.bus.manager)
+
+    def testControl(self):
+        # bare names get .service, the D-Bus api doesn't add it
+        self.assertTrue(self.ctl.start(["openvpn@server", "openvpn@server1"]))
+        self.assertTrue(self.ctl.restart("openvpn.timer"))
+        self.assertTrue(self.ctl.stop("openvpn@server.service"))
+        self.assertEqual(self.bus.manager.calls, [
+            ("StartUnit", "openvpn@server.service", "replace"),
+            ("StartUnit", "openvpn@server1.service", "replace"),
+            ("RestartUnit", "openvpn.timer", "replace"),
+            ("StopUnit", "openvpn@server.service", "replace")])
+
+    def testEnable(self):
+        # unit files are changed in one call, followed by a daemon reload
+        self.assertTrue(self.ctl.enable(["openvpn@server", "openvpn@server1"]))
+        self.assertTrue(self.ctl.disable("openvpn@server1"))
+        self.assertEqual(self.bus.manager.calls, [
+            ("EnableUnitFiles", ["openvpn@server.service", "openvpn@server1.service"], False, True),
+            ("Reload",),
+            ("DisableUnitFiles", ["openvpn@server1.service"], False),
+            ("Reload",)])
+
+    def testFailure(self):
+        self.bus.manager.fail = True
+        self.assertFalse(self.ctl.start("openvpn@server"))
+        self.assertFalse(self.ctl.enable("openvpn@server"))
+        self.assertFalse(self.ctl.daemonReload())
+
+    def testShow(self):
+        # states are keyed by the names asked for
+        states = self.ctl.show(["openvpn@server", "openvpn@server1.service", "openvpn.timer"])
+        self.assertEqual(states, {
+            "openvpn@server": {'active': "active", 'sub': "running", 'enabled': "enabled"},
+            "openvpn@server1.service": {'active': "inactive", 'sub': "dead", 'enabled': "disabled"},
+            "openvpn.timer": {'active': "active", 'sub': "waiting", 'enabled': "static"}})
+        self.assertTrue(self.ctl.isActive("openvpn@server"))
+        self.assertFalse(self.ctl.isActive(["openvpn@server", "openvpn@server1"]))
+        self.assertTrue(self.ctl.isEnabled(["openvpn@server", "openvpn.timer"]))
+        self.assertFalse(self.ctl.isEnabled("openvpn@server1"))
+
+    def testShowUnknown(self):
+        states = self.ctl.show("unknown")
+        self.assertEqual(states, {"unknown": {'active': "unknown", 'sub': "unknown", 'enabled': "unknown"}})
+
+if __name__ == "__main__":
+    unittest.main()